@@ -0,0 +1,68 @@
+"""Benchmark memory used by ConversationEvents.
+
+Compares keeping hangouts_pb2.Events in memory with the compact mode, which
+keeps them as serialized bytes.
+
+Usage: python benchmarks/event_memory.py [--events N]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from hangups import conversation_event, hangouts_pb2
+
+
+def make_event(i):
+    """Return a typical hangouts_pb2.Event containing a chat message."""
+    event = hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id='UgzJilj2Tg_oqkAaABAQ'),
+        sender_id=hangouts_pb2.ParticipantId(
+            gaia_id='1234567890123456789{}'.format(i % 10),
+            chat_id='1234567890123456789{}'.format(i % 10),
+        ),
+        timestamp=1400000000000000 + i * 1000000,
+        event_id='7-H0Z7-FkyB7-{:08d}'.format(i),
+        event_type=hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
+    )
+    event.chat_message.message_content.segment.add(
+        type=hangouts_pb2.SEGMENT_TYPE_TEXT,
+        text='Message number {} with some typical length text'.format(i),
+    )
+    return event
+
+
+def measure(num_events, compact):
+    """Return (bytes, seconds) used to wrap num_events events."""
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    events = [
+        conversation_event.ChatMessageEvent(make_event(i), compact=compact)
+        for i in range(num_events)
+    ]
+    duration = time.perf_counter() - start_time
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del events
+    return (size, duration)
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000000,
+                        help='number of events to create')
+    args = parser.parse_args()
+    print('Events: {}'.format(args.events))
+    for compact in [False, True]:
+        size, duration = measure(args.events, compact)
+        print('{:8} {:8.1f} MiB {:6.1f} bytes/event {:6.2f} s'.format(
+            'compact' if compact else 'default', size / 2 ** 20,
+            size / args.events, duration
+        ))
+
+
+if __name__ == '__main__':
+    main()
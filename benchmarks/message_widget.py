@@ -0,0 +1,73 @@
+"""Benchmark creating MessageWidgets from ConversationEvents.
+
+The UI creates a MessageWidget for an event whenever it is displayed, so
+events are typically converted many times while scrolling.
+
+Usage: python benchmarks/message_widget.py [--events N] [--passes N]
+"""
+
+import argparse
+import time
+
+from hangups import conversation_event, hangouts_pb2, user
+from hangups.ui.__main__ import MessageWidget
+
+
+class FakeConversation(object):
+
+    """Conversation returning the same User for every UserID."""
+
+    def __init__(self):
+        self._user = user.User(user.UserID(chat_id='1', gaia_id='1'),
+                               'Full Name', 'First', None, [], False)
+
+    def get_user(self, user_id):
+        return self._user
+
+
+def make_event(i):
+    """Return a ChatMessageEvent with a few segments."""
+    event = hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id='conv'),
+        sender_id=hangouts_pb2.ParticipantId(gaia_id='1', chat_id='1'),
+        timestamp=1400000000000000 + i * 60000000,
+        event_id='event{}'.format(i),
+    )
+    content = event.chat_message.message_content
+    content.segment.add(type=hangouts_pb2.SEGMENT_TYPE_TEXT,
+                        text='Message {} with a '.format(i))
+    content.segment.add(type=hangouts_pb2.SEGMENT_TYPE_LINK,
+                        text='link', link_data=hangouts_pb2.LinkData(
+                            link_target='https://example.com/'))
+    content.segment.add(type=hangouts_pb2.SEGMENT_TYPE_LINE_BREAK,
+                        text='\n')
+    content.segment.add(type=hangouts_pb2.SEGMENT_TYPE_TEXT,
+                        text='and a second line')
+    return conversation_event.ChatMessageEvent(event)
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=10000,
+                        help='number of events to create')
+    parser.add_argument('--passes', type=int, default=10,
+                        help='number of times to create widgets for events')
+    args = parser.parse_args()
+    conversation = FakeConversation()
+    events = [make_event(i) for i in range(args.events)]
+    for pass_ in range(args.passes):
+        start_time = time.perf_counter()
+        prev_event = None
+        for conv_event in events:
+            MessageWidget.from_conversation_event(conversation, conv_event,
+                                                  prev_event)
+            prev_event = conv_event
+        duration = time.perf_counter() - start_time
+        print('Pass {}: {:.1f} us/event'.format(
+            pass_ + 1, duration / args.events * 1000000
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,11 @@ from .version import __version__
 from .client import Client
 from .user import UserList
 from .conversation import ConversationList, build_user_conversation_list
-from .auth import get_auth, get_auth_stdin, GoogleAuthError
-from .exceptions import HangupsError, NetworkError
+from .event_store import EventStore
+from .search import SearchIndex
+from .outbox import Outbox
+from .auth import get_auth, get_auth_async, get_auth_stdin, GoogleAuthError
+from .exceptions import HangupsError, NetworkError, AuthError
 from .conversation_event import (ChatMessageSegment, ConversationEvent,
                                  ChatMessageEvent, RenameEvent,
                                  MembershipChangeEvent)
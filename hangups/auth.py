@@ -13,15 +13,16 @@ This code may be debugged by invoking it directly:
     python -m hangups.auth
 """
 
-import requests
+import aiohttp
+import asyncio
+import http.cookiejar
+import json
 import logging
+import os
+import time
 import urllib.parse
 
 logger = logging.getLogger(__name__)
-# Set the logging level for requests to at least INFO, since the DEBUG level
-# will log sensitive data:
-if logging.getLogger('requests').isEnabledFor(logging.DEBUG):
-    logging.getLogger('requests').setLevel(logging.INFO)
 
 OAUTH2_SCOPE = 'https://www.google.com/accounts/OAuthLogin'
 OAUTH2_CLIENT_ID = '936475272427.apps.googleusercontent.com'
@@ -35,6 +36,18 @@ OAUTH2_LOGIN_URL = 'https://accounts.google.com/o/oauth2/auth?{}'.format(
     ))
 )
 OAUTH2_TOKEN_REQUEST_URL = 'https://accounts.google.com/o/oauth2/token'
+# Time in seconds allowed for each authentication request:
+REQUEST_TIMEOUT = 30
+# Maximum number of redirects to follow for each authentication request:
+MAX_REDIRECTS = 10
+# Statuses of redirect responses:
+REDIRECT_STATUSES = {301, 302, 303, 307}
+# Cached cookies are not used if they expire in less than this many seconds:
+COOKIES_EXPIRY_MARGIN_SECS = 300
+# Time in seconds to use cached cookies with an unknown expiry time for:
+COOKIES_MAX_AGE_SECS = 24 * 60 * 60
+# Cookies which must be set by logging in:
+REQUIRED_COOKIES = ['SAPISID', 'HSID', 'SSID', 'APISID', 'SID']
 
 
 class GoogleAuthError(Exception):
@@ -63,7 +76,66 @@ def _save_oauth2_refresh_token(refresh_token_filename, refresh_token):
     return refresh_token
 
 
-def get_auth(get_code_f, refresh_token_filename):
+def _get_cookies_filename(refresh_token_filename):
+    """Return the default cookies filename for a refresh token filename."""
+    return '{}.cookies'.format(refresh_token_filename)
+
+
+def _load_cookies(cookies_filename):
+    """Return (cookies, expires) loaded from file or None on failure.
+
+    Cookies with an unknown expiry time expire COOKIES_MAX_AGE_SECS after
+    they were saved. Returns None if the cookies have expired or will expire
+    soon.
+    """
+    logger.info('Loading cookies from \'%s\'', cookies_filename)
+    try:
+        with open(cookies_filename) as f:
+            cache = json.load(f)
+        cookies, expires = cache['cookies'], cache['expires']
+        if expires is None:
+            # Files saved without the time are treated as expired.
+            expires = cache.get('saved', 0) + COOKIES_MAX_AGE_SECS
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.info('Failed to load cookies: %s', e)
+        return None
+    if expires < time.time() + COOKIES_EXPIRY_MARGIN_SECS:
+        logger.info('Cached cookies have expired')
+        return None
+    return (cookies, expires)
+
+
+def _save_cookies(cookies_filename, cookies, expires):
+    """Save cookies and their expiry time to file, ignoring failure.
+
+    The time they were saved is also stored, for cookies whose expiry time
+    is unknown. The file is only readable by the current user, since the
+    cookies allow access to the account.
+    """
+    logger.info('Saving cookies to \'%s\'', cookies_filename)
+    try:
+        fd = os.open(cookies_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, 'w') as f:
+            json.dump({'cookies': cookies, 'expires': expires,
+                       'saved': time.time()}, f)
+    except IOError as e:
+        logger.warning('Failed to save cookies: %s', e)
+
+
+def _get_morsel_expiry(morsel):
+    """Return the expiry time of a cookie as a timestamp, or None."""
+    if morsel['max-age']:
+        try:
+            return time.time() + int(morsel['max-age'])
+        except ValueError:
+            pass
+    if morsel['expires']:
+        return http.cookiejar.http2time(morsel['expires'])
+    return None
+
+
+def get_auth(get_code_f, refresh_token_filename, cookies_filename=None):
     """Login into Google and return cookies as a dict.
 
     get_code_f() is called if authorization code is required to log in, and
@@ -72,20 +144,204 @@ def get_auth(get_code_f, refresh_token_filename):
     A refresh token is saved/loaded from refresh_token_filename if possible, so
     subsequent logins may not require re-authenticating.
 
+    The cookies are cached with their expiry time in cookies_filename, which
+    defaults to refresh_token_filename with '.cookies' appended. Cached
+    cookies are returned without logging in again until they expire. Pass
+    refresh_cookies and get_cookies_expiry to Client so it can log in again
+    before they expire, or if they become invalid earlier.
+
+    This blocks until authentication is complete, so it must not be called
+    while an event loop is running. Use get_auth_async instead.
+
+    Raises GoogleAuthError on failure.
+    """
+    return _run_in_new_event_loop(
+        get_auth_async(get_code_f, refresh_token_filename,
+                       cookies_filename=cookies_filename)
+    )
+
+
+@asyncio.coroutine
+def get_auth_async(get_code_f, refresh_token_filename, connector=None,
+                   cookies_filename=None):
+    """Login into Google and return cookies as a dict.
+
+    Coroutine version of get_auth. get_code_f may be a coroutine function;
+    otherwise it is run in an executor so it does not block the event loop.
+
+    connector is an optional aiohttp connector to make requests with. If not
+    provided, a new connector is created and closed when finished.
+
+    Raises GoogleAuthError on failure.
+    """
+    if cookies_filename is None:
+        cookies_filename = _get_cookies_filename(refresh_token_filename)
+    cached_cookies = _load_cookies(cookies_filename)
+    if cached_cookies is not None:
+        logger.info('Using cached cookies')
+        return cached_cookies[0]
+    cookies, _ = yield from _login(get_code_f, refresh_token_filename,
+                                   connector, cookies_filename)
+    return cookies
+
+
+def get_cookies_expiry(refresh_token_filename, cookies_filename=None):
+    """Return the expiry time of the cached cookies as a timestamp.
+
+    This may be passed to Client as cookies_expires along with the cookies
+    returned by get_auth. Returns None if there are no cached cookies which
+    are still valid.
+    """
+    if cookies_filename is None:
+        cookies_filename = _get_cookies_filename(refresh_token_filename)
+    cached_cookies = _load_cookies(cookies_filename)
+    return None if cached_cookies is None else cached_cookies[1]
+
+
+@asyncio.coroutine
+def _login(get_code_f, refresh_token_filename, connector, cookies_filename):
+    """Login into Google and save the cookies to cookies_filename.
+
+    Raises GoogleAuthError on failure.
+
+    Return (cookies, expires) tuple.
+    """
+    if connector is None:
+        connector = aiohttp.TCPConnector()
+        close_connector = True
+    else:
+        close_connector = False
+    try:
+        try:
+            logger.info('Authenticating with refresh token')
+            access_token = yield from _auth_with_refresh_token(
+                refresh_token_filename, connector
+            )
+        except GoogleAuthError as e:
+            logger.info('Failed to authenticate using refresh token: %s', e)
+            logger.info('Authenticating with authorization code')
+            access_token = yield from _auth_with_code(
+                get_code_f, refresh_token_filename, connector
+            )
+        logger.info('Authentication successful')
+        cookies, expires = yield from _get_session_cookies(access_token,
+                                                           connector)
+    finally:
+        if close_connector:
+            connector.close()
+    _save_cookies(cookies_filename, cookies, expires)
+    return (cookies, expires)
+
+
+@asyncio.coroutine
+def refresh_cookies(refresh_token_filename, connector=None,
+                    cookies_filename=None):
+    """Login into Google using the saved refresh token.
+
+    Unlike get_auth_async, cached cookies are ignored and replaced, and the
+    user is never prompted for an authorization code. This is suitable for
+    passing to Client as refresh_cookies, using functools.partial.
+
     Raises GoogleAuthError on failure.
+
+    Return (cookies, expires) tuple, where expires is the expiry time of the
+    cookies as a timestamp, or None if it is unknown.
     """
+    @asyncio.coroutine
+    def get_code_f():
+        """Fail since the user can not be prompted."""
+        raise GoogleAuthError('Refresh token is invalid')
+    if cookies_filename is None:
+        cookies_filename = _get_cookies_filename(refresh_token_filename)
+    return (yield from _login(get_code_f, refresh_token_filename, connector,
+                              cookies_filename))
+
+
+def _run_in_new_event_loop(coro):
+    """Run coroutine to completion in a new event loop and return its result.
+
+    The new event loop is set as the current event loop while it runs, and the
+    previous event loop is restored afterwards.
+    """
+    previous_loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
-        logger.info('Authenticating with refresh token')
-        access_token = _auth_with_refresh_token(refresh_token_filename)
-    except GoogleAuthError as e:
-        logger.info('Failed to authenticate using refresh token: %s', e)
-        logger.info('Authenticating with authorization code')
-        access_token = _auth_with_code(get_code_f, refresh_token_filename)
-    logger.info('Authentication successful')
-    return _get_session_cookies(access_token)
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(previous_loop)
+
+
+def _domain_matches(host, domain):
+    """Return True if a cookie for domain should be sent to host."""
+    domain = domain.lstrip('.')
+    return host == domain or host.endswith('.' + domain)
+
 
+@asyncio.coroutine
+def _request(method, url, connector, cookie_jar=None, headers=None,
+             data=None):
+    """Make an HTTP request, following redirects.
 
-def _auth_with_code(get_code_f, refresh_token_filename):
+    cookie_jar is an optional dict of {(domain, name): http.cookies.Morsel}
+    which is sent with each request and updated with the cookies set by
+    every response, including redirects.
+
+    Raises GoogleAuthError if the request fails.
+
+    Return (status, body) tuple, where body is a string.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        cookies = {}
+        if cookie_jar is not None:
+            host = urllib.parse.urlparse(url).hostname
+            cookies = {name: morsel.value for (domain, name), morsel
+                       in cookie_jar.items()
+                       if not domain or _domain_matches(host, domain)}
+        try:
+            res = yield from asyncio.wait_for(aiohttp.request(
+                method, url, headers=headers, cookies=cookies, data=data,
+                connector=connector, allow_redirects=False
+            ), REQUEST_TIMEOUT)
+            body = yield from asyncio.wait_for(res.read(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise GoogleAuthError('Request timed out')
+        except (aiohttp.ClientError, aiohttp.ServerDisconnectedError) as e:
+            raise GoogleAuthError('Request failed: {}'.format(e))
+        if cookie_jar is not None:
+            for name, morsel in res.cookies.items():
+                cookie_jar[(morsel['domain'], name)] = morsel
+        if res.status in REDIRECT_STATUSES and 'LOCATION' in res.headers:
+            url = urllib.parse.urljoin(url, res.headers['LOCATION'])
+            method, data = 'GET', None
+        else:
+            return (res.status, body.decode('utf-8', errors='replace'))
+    raise GoogleAuthError('Request exceeded maximum redirects')
+
+
+@asyncio.coroutine
+def _request_token(token_request_data, connector):
+    """Make a token request and return the response as a dict.
+
+    Raises GoogleAuthError if the request fails.
+    """
+    _, body = yield from _request('POST', OAUTH2_TOKEN_REQUEST_URL,
+                                  connector, data=token_request_data)
+    try:
+        res = json.loads(body)
+    except ValueError:
+        raise GoogleAuthError('Token request returned invalid JSON')
+
+    # If an error occurred, a key 'error' will contain an error code.
+    if 'error' in res:
+        raise GoogleAuthError('Authorization error: \'{}\''
+                              .format(res['error']))
+    return res
+
+
+@asyncio.coroutine
+def _auth_with_code(get_code_f, refresh_token_filename, connector):
     """Authenticate using OAuth authentication code.
 
     Raises GoogleAuthError authentication fails.
@@ -93,7 +349,12 @@ def _auth_with_code(get_code_f, refresh_token_filename):
     Return access token string.
     """
     # Get authentication code from user.
-    auth_code = get_code_f()
+    if asyncio.iscoroutinefunction(get_code_f):
+        auth_code = yield from get_code_f()
+    else:
+        auth_code = yield from asyncio.get_event_loop().run_in_executor(
+            None, get_code_f
+        )
 
     # Make a token request.
     token_request_data = {
@@ -103,13 +364,7 @@ def _auth_with_code(get_code_f, refresh_token_filename):
         'grant_type': 'authorization_code',
         'redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
     }
-    r = requests.post(OAUTH2_TOKEN_REQUEST_URL, data=token_request_data)
-    res = r.json()
-
-    # If an error occurred, a key 'error' will contain an error code.
-    if 'error' in res:
-        raise GoogleAuthError('Authorization error: \'{}\''
-                              .format(res['error']))
+    res = yield from _request_token(token_request_data, connector)
 
     # Save the refresh token.
     _save_oauth2_refresh_token(refresh_token_filename, res['refresh_token'])
@@ -117,7 +372,8 @@ def _auth_with_code(get_code_f, refresh_token_filename):
     return res['access_token']
 
 
-def _auth_with_refresh_token(refresh_token_filename):
+@asyncio.coroutine
+def _auth_with_refresh_token(refresh_token_filename, connector):
     """Authenticate using saved OAuth refresh token.
 
     Raises GoogleAuthError if refresh token is not found or authentication
@@ -137,37 +393,55 @@ def _auth_with_refresh_token(refresh_token_filename):
         'grant_type': 'refresh_token',
         'refresh_token': refresh_token,
     }
-    r = requests.post(OAUTH2_TOKEN_REQUEST_URL, data=token_request_data)
-    res = r.json()
-
-    # If an error occurred, a key 'error' will contain an error code.
-    if 'error' in res:
-        raise GoogleAuthError('Authorization error: \'{}\''
-                              .format(res['error']))
-
+    res = yield from _request_token(token_request_data, connector)
     return res['access_token']
 
 
-def _get_session_cookies(access_token):
+@asyncio.coroutine
+def _get_session_cookies(access_token, connector):
     """Use the access token to get session cookies.
 
-    Return dict of cookies.
+    Raises GoogleAuthError if a request fails or any of REQUIRED_COOKIES is
+    not set.
+
+    Return (cookies, expires) tuple, where cookies is a dict and expires is
+    the earliest expiry time of the cookies as a timestamp, or None if it is
+    unknown.
     """
-    # Prevent ResourceWarning by using context manager to close session
-    # connection.
-    with requests.Session() as session:
-        headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        r = session.get(('https://accounts.google.com/accounts/OAuthLogin'
-                         '?source=hangups&issueuberauth=1'), headers=headers)
-        uberauth = r.text
-        r = session.get(('https://accounts.google.com/MergeSession?'
-                         'service=mail&'
-                         'continue=http://www.google.com&uberauth={}')
-                        .format(uberauth), headers=headers)
-        return session.cookies.get_dict(domain='.google.com')
-
-
-def get_auth_stdin(refresh_token_filename):
+    headers = {'Authorization': 'Bearer {}'.format(access_token)}
+    cookie_jar = {}  # {(domain, name): http.cookies.Morsel}
+    status, uberauth = yield from _request(
+        'GET', ('https://accounts.google.com/accounts/OAuthLogin'
+                '?source=hangups&issueuberauth=1'),
+        connector, cookie_jar=cookie_jar, headers=headers
+    )
+    if status != 200:
+        raise GoogleAuthError('OAuthLogin request failed with status {}'
+                              .format(status))
+    status, _ = yield from _request(
+        'GET', ('https://accounts.google.com/MergeSession?'
+                'service=mail&'
+                'continue=http://www.google.com&uberauth={}')
+        .format(uberauth), connector, cookie_jar=cookie_jar, headers=headers
+    )
+    if status != 200:
+        raise GoogleAuthError('MergeSession request failed with status {}'
+                              .format(status))
+    morsels = {name: morsel for (domain, name), morsel in cookie_jar.items()
+               if domain == '.google.com'}
+    missing_cookies = [name for name in REQUIRED_COOKIES
+                       if name not in morsels]
+    if missing_cookies:
+        raise GoogleAuthError('Login did not set cookies: {}'
+                              .format(', '.join(missing_cookies)))
+    expiry_times = [expiry for expiry in map(_get_morsel_expiry,
+                                             morsels.values())
+                    if expiry is not None]
+    cookies = {name: morsel.value for name, morsel in morsels.items()}
+    return (cookies, min(expiry_times) if expiry_times else None)
+
+
+def get_auth_stdin(refresh_token_filename, cookies_filename=None):
     """Wrapper for get_auth that prompts the user on stdin."""
     def get_code_f():
         """Prompt for and return credentials."""
@@ -176,7 +450,8 @@ def get_auth_stdin(refresh_token_filename):
         print(OAUTH2_LOGIN_URL)
         auth_token = input('\nAuthorization Token: ')
         return auth_token
-    return get_auth(get_code_f, refresh_token_filename)
+    return get_auth(get_code_f, refresh_token_filename,
+                    cookies_filename=cookies_filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+"""Download the full event history of conversations.
+
+Backfill walks backwards through the history of many conversations at once,
+requesting pages of events with getconversation and following the event
+continuation token of each response. Requests are limited to a global rate,
+and each page is passed to a sink as soon as it arrives, so events are never
+accumulated in memory.
+
+After each page is handled by the sink, the continuation token is saved in a
+JSON checkpoint file for the conversation, so an interrupted backfill resumes
+where it stopped. Pages are delivered at least once: the last page before an
+interruption may be delivered again.
+"""
+
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import os
+
+from hangups import exceptions, hangouts_pb2, metrics, parsers
+
+logger = logging.getLogger(__name__)
+backfilled_events_counter = metrics.REGISTRY.counter(
+    'hangups_backfilled_events_total',
+    'Number of events downloaded by backfill.'
+)
+# Default number of events requested per page:
+PAGE_SIZE = 50
+# Default maximum number of conversations backfilled at the same time:
+CONCURRENCY = 4
+# Default maximum number of requests started per second:
+RATE = 5
+# Number of times to retry a failed request before giving up on a
+# conversation:
+MAX_RETRIES = 3
+# Delay in seconds before the first retry, which doubles for each retry:
+RETRY_DELAY_SECS = 1
+
+
+def _token_to_json(token):
+    """Return JSON-compatible dict from hangouts_pb2.EventContinuationToken."""
+    return {
+        'event_id': token.event_id,
+        'event_timestamp': token.event_timestamp,
+        'storage_continuation_token': base64.b64encode(
+            token.storage_continuation_token
+        ).decode('ascii'),
+    }
+
+
+def _token_from_json(token_dict):
+    """Return hangouts_pb2.EventContinuationToken from JSON dict."""
+    return hangouts_pb2.EventContinuationToken(
+        event_id=token_dict['event_id'],
+        event_timestamp=token_dict['event_timestamp'],
+        storage_continuation_token=base64.b64decode(
+            token_dict['storage_continuation_token']
+        ),
+    )
+
+
+class Backfill(object):
+
+    """Crawler for the full event history of conversations.
+
+    sink is called as sink(conversation_id, events) with each page of
+    hangouts_pb2.Events, ordered oldest to newest. Pages are delivered newest
+    first. If sink is a coroutine function, it is waited for. The value
+    returned by sink is saved in the checkpoint as sink_state, so the sink
+    can tell which pages it had handled when the checkpoint was saved.
+
+    checkpoint_dir is the directory where a checkpoint file is kept for each
+    conversation. It is created if it doesn't exist.
+
+    At most concurrency conversations are backfilled at once, and at most
+    rate requests are started per second (or any number if rate is None).
+    Raises ValueError if concurrency is less than 1, or rate is not positive
+    or None.
+    """
+
+    def __init__(self, client, sink, checkpoint_dir, page_size=PAGE_SIZE,
+                 concurrency=CONCURRENCY, rate=RATE):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive or None')
+        self._client = client
+        self._sink = sink
+        self._checkpoint_dir = checkpoint_dir
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._rate = rate
+        # Time the next request may be started at:
+        self._next_start_time = 0
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def _get_checkpoint_path(self, conversation_id):
+        """Return path of the checkpoint file for a conversation."""
+        return os.path.join(self._checkpoint_dir,
+                            '{}.json'.format(conversation_id))
+
+    def load_checkpoint(self, conversation_id):
+        """Return checkpoint dict for a conversation, or None if there's none.
+
+        The dict contains the number of events backfilled so far
+        (num_events), whether the beginning of the conversation was reached
+        (done), the continuation token to continue from (token), and the
+        value returned by the sink for the last page (sink_state).
+        """
+        try:
+            with open(self._get_checkpoint_path(conversation_id)) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint['token'] is not None:
+            checkpoint['token'] = _token_from_json(checkpoint['token'])
+        checkpoint.setdefault('sink_state', None)
+        return checkpoint
+
+    def _save_checkpoint(self, conversation_id, token, num_events, done,
+                         sink_state):
+        """Save a checkpoint for a conversation, replacing any previous one."""
+        path = self._get_checkpoint_path(conversation_id)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'token': None if token is None else _token_to_json(token),
+                'num_events': num_events,
+                'done': done,
+                'sink_state': sink_state,
+            }, f)
+        os.replace(tmp_path, path)
+
+    @asyncio.coroutine
+    def run(self, conversation_ids):
+        """Backfill the history of a list of conversations.
+
+        Conversations which were completely backfilled before are skipped.
+
+        Returns dict mapping the IDs of conversations which could not be
+        backfilled to hangups.NetworkErrors, including conversations whose
+        continuation token stopped going back in time. Progress for these
+        conversations is kept, so running again continues where they
+        stopped.
+        """
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        @asyncio.coroutine
+        def backfill(conversation_id):
+            """Backfill conversation and return (conversation_id, error)."""
+            with (yield from semaphore):
+                try:
+                    yield from self._backfill_conversation(conversation_id)
+                except exceptions.NetworkError as e:
+                    logger.warning('Failed to backfill conversation {}: {}'
+                                   .format(conversation_id, e))
+                    return (conversation_id, e)
+                return (conversation_id, None)
+
+        results = yield from asyncio.gather(
+            *[backfill(conversation_id) for conversation_id
+              in conversation_ids]
+        )
+        return {conversation_id: error for conversation_id, error in results
+                if error is not None}
+
+    @asyncio.coroutine
+    def _wait_for_rate_limit(self):
+        """Wait until another request may be started."""
+        if self._rate is None:
+            return
+        loop = asyncio.get_event_loop()
+        # Reserve the next start time before sleeping.
+        start_time = max(loop.time(), self._next_start_time)
+        self._next_start_time = start_time + 1 / self._rate
+        yield from asyncio.sleep(start_time - loop.time())
+
+    @asyncio.coroutine
+    def _get_page(self, conversation_id, token):
+        """Return hangouts_pb2.ConversationState for a page of events.
+
+        Failed requests are retried. Raises hangups.NetworkError if all
+        attempts fail.
+        """
+        for retry in range(MAX_RETRIES + 1):
+            yield from self._wait_for_rate_limit()
+            try:
+                response = yield from self._client.getconversation(
+                    conversation_id, None, self._page_size,
+                    event_continuation_token=token
+                )
+            except exceptions.NetworkError as e:
+                if retry == MAX_RETRIES:
+                    raise
+                delay = RETRY_DELAY_SECS * 2 ** retry
+                logger.info('Retrying backfill of conversation {} in {}s '
+                            'after error: {}'
+                            .format(conversation_id, delay, e))
+                yield from asyncio.sleep(delay)
+            else:
+                return response.conversation_state
+
+    @asyncio.coroutine
+    def _backfill_conversation(self, conversation_id):
+        """Backfill a conversation from its checkpoint until it's done."""
+        checkpoint = self.load_checkpoint(conversation_id)
+        if checkpoint is None:
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            token = hangouts_pb2.EventContinuationToken(
+                event_timestamp=parsers.to_timestamp(now)
+            )
+            num_events = 0
+            sink_state = None
+        elif checkpoint['done']:
+            logger.info('Conversation {} is already backfilled'
+                        .format(conversation_id))
+            return
+        else:
+            token = checkpoint['token']
+            num_events = checkpoint['num_events']
+            sink_state = checkpoint['sink_state']
+        logger.info('Backfilling conversation {} from {}'.format(
+            conversation_id, parsers.from_timestamp(token.event_timestamp)
+        ))
+
+        done = False
+        while not done:
+            conv_state = yield from self._get_page(conversation_id, token)
+            events = list(conv_state.event)
+            if events:
+                if asyncio.iscoroutinefunction(self._sink):
+                    sink_state = yield from self._sink(conversation_id,
+                                                       events)
+                else:
+                    sink_state = self._sink(conversation_id, events)
+                num_events += len(events)
+                backfilled_events_counter.inc(len(events))
+                if conv_state.HasField('event_continuation_token'):
+                    next_token = conv_state.event_continuation_token
+                else:
+                    next_token = hangouts_pb2.EventContinuationToken(
+                        event_id=events[0].event_id,
+                        event_timestamp=events[0].timestamp,
+                    )
+                if next_token.event_timestamp >= token.event_timestamp:
+                    # Keep the token which returned this page, so running
+                    # again retries it rather than finishing early.
+                    self._save_checkpoint(conversation_id, token, num_events,
+                                          False, sink_state)
+                    raise exceptions.NetworkError(
+                        'Backfill stopped making progress at {}'.format(
+                            parsers.from_timestamp(token.event_timestamp)
+                        )
+                    )
+                token = next_token
+            else:
+                done = True
+            self._save_checkpoint(conversation_id, token, num_events, done,
+                                  sink_state)
+        logger.info('Backfilled {} events for conversation {}'
+                    .format(num_events, conversation_id))
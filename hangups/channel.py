@@ -23,7 +23,7 @@ import logging
 import re
 import time
 
-from hangups import http_utils, event, exceptions
+from hangups import http_utils, event, exceptions, metrics
 
 logger = logging.getLogger(__name__)
 LEN_REGEX = re.compile(r'([0-9]+)\n', re.MULTILINE)
@@ -34,6 +34,22 @@ CONNECT_TIMEOUT = 30
 # a row, consider the connection dead.
 PUSH_TIMEOUT = 30
 MAX_READ_BYTES = 1024 * 1024
+received_bytes_counter = metrics.REGISTRY.counter(
+    'hangups_channel_received_bytes_total',
+    'Bytes received on the backward channel.'
+)
+received_chunks_counter = metrics.REGISTRY.counter(
+    'hangups_channel_received_chunks_total',
+    'Chunks received on the backward channel.'
+)
+received_arrays_counter = metrics.REGISTRY.counter(
+    'hangups_channel_received_arrays_total',
+    'Arrays received on the backward channel.'
+)
+reconnects_counter = metrics.REGISTRY.counter(
+    'hangups_channel_reconnects_total',
+    'Times the channel reconnected after being disconnected.'
+)
 
 
 class UnknownSIDError(exceptions.HangupsError):
@@ -150,8 +166,17 @@ class Channel(object):
     # Public methods
     ##########################################################################
 
-    def __init__(self, cookies, connector):
-        """Create a new channel."""
+    def __init__(self, cookies, connector, url_prefix=CHANNEL_URL_PREFIX,
+                 refresh_cookies=None):
+        """Create a new channel.
+
+        url_prefix is a format string for channel URLs, which may be changed to
+        connect to a different server.
+
+        refresh_cookies is an optional coroutine function called with no
+        arguments when a request fails with hangups.AuthError. It should
+        update the cookies dict in place, or raise hangups.NetworkError.
+        """
 
         # Event fired when channel connects with arguments ():
         self.on_connect = event.Event('Channel.on_connect')
@@ -172,6 +197,10 @@ class Channel(object):
         self._chunk_parser = None
         # aiohttp connector for keep-alive:
         self._connector = connector
+        # Format string for channel URLs:
+        self._url_prefix = url_prefix
+        # Coroutine function to refresh cookies, or None:
+        self._refresh_cookies = refresh_cookies
 
         # Discovered parameters:
         self._sid_param = None
@@ -202,15 +231,15 @@ class Channel(object):
                             .format(backoff_seconds))
                 yield from asyncio.sleep(backoff_seconds)
 
-            # Request a new SID if we don't have one yet, or the previous one
-            # became invalid.
-            if need_new_sid:
-                yield from self._fetch_channel_sid()
-                need_new_sid = False
-            # Clear any previous push data, since if there was an error it
-            # could contain garbage.
-            self._chunk_parser = ChunkParser()
             try:
+                # Request a new SID if we don't have one yet, or the previous
+                # one became invalid.
+                if need_new_sid:
+                    yield from self._fetch_channel_sid()
+                    need_new_sid = False
+                # Clear any previous push data, since if there was an error it
+                # could contain garbage.
+                self._chunk_parser = ChunkParser()
                 yield from self._longpoll_request()
             except (UnknownSIDError, exceptions.NetworkError) as e:
                 logger.warning('Long-polling request failed: {}'.format(e))
@@ -220,6 +249,14 @@ class Channel(object):
                     yield from self.on_disconnect.fire()
                 if isinstance(e, UnknownSIDError):
                     need_new_sid = True
+                elif (isinstance(e, exceptions.AuthError) and
+                      self._refresh_cookies is not None):
+                    try:
+                        yield from self._refresh_cookies()
+                    except exceptions.NetworkError as e:
+                        # Retry with the old cookies after backing off.
+                        logger.warning('Failed to refresh cookies: {}'
+                                       .format(e))
             else:
                 # The connection closed successfully, so reset the number of
                 # retries.
@@ -247,7 +284,7 @@ class Channel(object):
             for map_key, map_val in map_.items():
                 data_dict['req{}_{}'.format(map_num, map_key)] = map_val
         res = yield from http_utils.fetch(
-            'post', CHANNEL_URL_PREFIX.format('channel/bind'),
+            'post', self._url_prefix.format('channel/bind'),
             cookies=self._cookies, connector=self._connector,
             headers=get_authorization_headers(self._cookies['SAPISID']),
             params=params, data=data_dict,
@@ -298,7 +335,7 @@ class Channel(object):
         logger.info('Opening new long-polling request')
         try:
             res = yield from asyncio.wait_for(aiohttp.request(
-                'get', CHANNEL_URL_PREFIX.format('channel/bind'),
+                'get', self._url_prefix.format('channel/bind'),
                 params=params, cookies=self._cookies, headers=headers,
                 connector=self._connector
             ), CONNECT_TIMEOUT)
@@ -312,6 +349,11 @@ class Channel(object):
                                           .format(e))
         if res.status == 400 and res.reason == 'Unknown SID':
             raise UnknownSIDError('SID became invalid')
+        elif res.status in http_utils.AUTH_ERROR_STATUSES:
+            raise exceptions.AuthError(
+                'Request was not authorized: {}: {}'
+                .format(res.status, res.reason)
+            )
         elif res.status != 200:
             raise exceptions.NetworkError(
                 'Request return unexpected status: {}: {}'
@@ -346,12 +388,15 @@ class Channel(object):
     def _on_push_data(self, data_bytes):
         """Parse push data and trigger events."""
         logger.debug('Received chunk:\n{}'.format(data_bytes))
+        received_bytes_counter.inc(len(data_bytes))
         for chunk in self._chunk_parser.get_chunks(data_bytes):
+            received_chunks_counter.inc()
 
             # Consider the channel connected once the first chunk is received.
             if not self._is_connected:
                 if self._on_connect_called:
                     self._is_connected = True
+                    reconnects_counter.inc()
                     yield from self.on_reconnect.fire()
                 else:
                     self._on_connect_called = True
@@ -367,4 +412,5 @@ class Channel(object):
                 array_id, data_array = inner_array
                 logger.debug('Chunk contains data array with id %r:\n%r',
                              array_id, data_array)
+                received_arrays_counter.inc()
                 yield from self.on_receive_array.fire(data_array)
@@ -2,6 +2,8 @@
 
 import aiohttp
 import asyncio
+import collections
+import itertools
 import json
 import logging
 import random
@@ -10,15 +12,143 @@ import datetime
 import os
 
 from hangups import (javascript, parsers, exceptions, http_utils, channel,
-                     event, hangouts_pb2, pblite, __version__)
+                     event, hangouts_pb2, pblite, metrics, auth, __version__)
 
 logger = logging.getLogger(__name__)
+api_request_duration_histogram = metrics.REGISTRY.histogram(
+    'hangups_api_request_duration_seconds',
+    'Time taken by chat API requests, including retries.', ['endpoint']
+)
+state_updates_counter = metrics.REGISTRY.counter(
+    'hangups_state_updates_total',
+    'StateUpdates received, by notification type.', ['type']
+)
 ORIGIN_URL = 'https://talkgadget.google.com'
+API_ORIGIN_URL = 'https://clients6.google.com'
 IMAGE_UPLOAD_URL = 'http://docs.google.com/upload/photos/resumable'
+# Number of bytes of an image to read and upload per request:
+IMAGE_UPLOAD_CHUNK_SIZE = 256 * 1024
+# Maximum number of times to resume an interrupted image upload:
+IMAGE_UPLOAD_MAX_RESUMES = 3
 # Timeout to send for setactiveclient requests:
 ACTIVE_TIMEOUT_SECS = 120
 # Minimum timeout between subsequent setactiveclient requests:
 SETACTIVECLIENT_LIMIT_SECS = 60
+# Maximum number of simultaneous chat API requests, and so connections:
+API_MAX_CONNECTIONS = 10
+# Time in seconds to keep idle connections open for reuse:
+KEEPALIVE_TIMEOUT_SECS = 60
+# Time in seconds before the cookies expire to refresh them:
+COOKIES_REFRESH_MARGIN_SECS = 600
+# Minimum time in seconds between attempts to refresh the cookies:
+COOKIES_REFRESH_MIN_DELAY_SECS = 60
+# Chat API endpoints which are safe to retry because repeating a request has no
+# additional effect:
+IDEMPOTENT_ENDPOINTS = {
+    'clients/setactiveclient',
+    'contacts/getentitybyid',
+    'contacts/getselfinfo',
+    'contacts/searchentities',
+    'conversations/getconversation',
+    'conversations/setconversationnotificationlevel',
+    'conversations/setfocus',
+    'conversations/settyping',
+    'conversations/syncallnewevents',
+    'conversations/syncrecentconversations',
+    'conversations/updatewatermark',
+    'presence/querypresence',
+    'presence/setpresence',
+}
+# Latency-sensitive read endpoints which may be hedged:
+HEDGED_ENDPOINTS = {
+    'contacts/getentitybyid',
+    'conversations/getconversation',
+}
+# Percentile of recent latencies after which a hedged request is sent:
+HEDGE_PERCENTILE = 95
+# Number of recent latencies per endpoint used to compute the percentile:
+HEDGE_LATENCY_WINDOW = 100
+# Delay in seconds before hedging until there are enough latency samples:
+HEDGE_DEFAULT_DELAY_SECS = 1.0
+HEDGE_MIN_SAMPLES = 10
+# Maximum fraction of requests which may be hedged, and maximum number of
+# hedged requests which may be sent in a burst:
+HEDGE_MAX_RATIO = 0.05
+HEDGE_MAX_BURST = 5
+
+
+def _make_connector(keepalive_timeout):
+    """Return a new aiohttp connector, using HTTP_PROXY if it is set.
+
+    The connector caches DNS lookups. aiohttp connectors don't limit their
+    number of connections, so the limit is enforced by the callers.
+    """
+    kwargs = dict(keepalive_timeout=keepalive_timeout, resolve=True)
+    proxy = os.environ.get('HTTP_PROXY')
+    if proxy:
+        return aiohttp.ProxyConnector(proxy, **kwargs)
+    else:
+        return aiohttp.TCPConnector(**kwargs)
+
+
+class RequestHedger(object):
+    """Send a duplicate request if the original is slower than usual.
+
+    If a request hasn't finished within the HEDGE_PERCENTILE percentile of
+    recent latencies, a second identical request is sent, the first response
+    to arrive is returned and the other request is cancelled.
+
+    To cap the extra load, each request adds HEDGE_MAX_RATIO to a budget of
+    hedged requests, up to HEDGE_MAX_BURST, and each hedged request uses one.
+    """
+
+    def __init__(self):
+        self._latencies = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self._budget = 0.0
+
+    def get_delay(self):
+        """Return delay in seconds after which a request will be hedged."""
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECS
+        latencies = sorted(self._latencies)
+        index = round((len(latencies) - 1) * HEDGE_PERCENTILE / 100)
+        return latencies[index]
+
+    @asyncio.coroutine
+    def request(self, make_request):
+        """Return the result of make_request(), hedging it if it is slow.
+
+        make_request is a function returning a new coroutine for the request
+        each time it is called.
+        """
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+        self._budget = min(HEDGE_MAX_BURST, self._budget + HEDGE_MAX_RATIO)
+        pending = {asyncio.async(make_request())}
+        try:
+            done, pending = yield from asyncio.wait(pending,
+                                                    timeout=self.get_delay())
+            if not done and self._budget >= 1:
+                logger.info('Sending hedged request after {:.3f} seconds'
+                            .format(loop.time() - start_time))
+                self._budget -= 1
+                pending.add(asyncio.async(make_request()))
+            while True:
+                succeeded = [future for future in done
+                             if future.exception() is None]
+                if succeeded or not pending:
+                    break
+                # Wait for a request to finish, or if one request failed,
+                # for the other one.
+                done, pending = yield from asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+            result = (succeeded + list(done))[0].result()
+        finally:
+            for future in pending:
+                future.cancel()
+        self._latencies.append(loop.time() - start_time)
+        return result
 
 
 class Client(object):
@@ -27,10 +157,42 @@ class Client(object):
     Maintains a connections to the servers, emits events, and accepts commands.
     """
 
-    def __init__(self, cookies):
+    def __init__(self, cookies, api_max_connections=API_MAX_CONNECTIONS,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT_SECS,
+                 request_timeout=http_utils.DEFAULT_TIMEOUT,
+                 hedge_requests=False, api_origin_url=API_ORIGIN_URL,
+                 channel_url_prefix=channel.CHANNEL_URL_PREFIX,
+                 refresh_cookies=None, cookies_expires=None):
         """Create new client.
 
-        cookies is a dictionary of authentication cookies.
+        cookies is a dictionary of authentication cookies, and cookies_expires
+        is their expiry time as a timestamp, or None if it is unknown.
+
+        refresh_cookies is an optional coroutine function called with no
+        arguments to get new cookies, such as
+        functools.partial(hangups.auth.refresh_cookies,
+        refresh_token_filename). It should return a (cookies, expires) tuple
+        like cookies and cookies_expires. While connected, the cookies are
+        refreshed in the background COOKIES_REFRESH_MARGIN_SECS before they
+        expire. They are also refreshed when a request fails because they are
+        invalid, and the request is then retried with the new cookies.
+
+        The channel's long-polling requests and chat API requests use separate
+        connection pools, so API requests never wait behind the long-polling
+        connection. api_max_connections limits the number of API requests,
+        and so connections, at once (the channel never uses more than two
+        connections). keepalive_timeout is the time in seconds idle
+        connections are kept open for reuse.
+
+        request_timeout is the total time in seconds allowed for each API
+        request, including retries.
+
+        If hedge_requests is True, requests to HEDGED_ENDPOINTS which are
+        slower than usual will be duplicated, and the first response used (see
+        RequestHedger).
+
+        api_origin_url and channel_url_prefix may be changed to connect to a
+        different server, such as hangups.fake_server.
         """
 
         # Event fired when the client connects for the first time with
@@ -43,17 +205,47 @@ class Client(object):
         self.on_disconnect = event.Event('Client.on_disconnect')
         # Event fired when a StateUpdate arrives with arguments (state_update).
         self.on_state_update = event.Event('Client.on_state_update')
-
-        self._cookies = cookies
-        proxy = os.environ.get('HTTP_PROXY')
-        if proxy:
-            self._connector = aiohttp.ProxyConnector(proxy)
-        else:
-            self._connector = aiohttp.TCPConnector()
-
-        self._channel = channel.Channel(self._cookies, self._connector)
+        # Event fired at each stage of a chat API request with arguments
+        # (http_utils.RequestTrace). A hedged request is traced as a separate
+        # request. When this event has no observers, requests are not traced.
+        self.on_request_trace = event.Event('Client.on_request_trace')
+        # Iterator of IDs for traced requests:
+        self._request_ids = itertools.count()
+
+        # Copy the cookies since they are replaced in place when refreshed.
+        self._cookies = dict(cookies)
+        self._refresh_cookies_f = refresh_cookies
+        # Lock held while refreshing cookies:
+        self._refresh_cookies_lock = asyncio.Lock()
+        # Number of times the cookies have been refreshed:
+        self._cookies_version = 0
+        self._cookies_expires = cookies_expires
+        # Future for Client._refresh_cookies_before_expiry
+        self._refresh_cookies_future = None
+        self._request_timeout = request_timeout
+        self._api_origin_url = api_origin_url
+        # {endpoint: RequestHedger} for endpoints which should be hedged:
+        self._hedgers = ({endpoint: RequestHedger()
+                          for endpoint in HEDGED_ENDPOINTS}
+                         if hedge_requests else {})
+        # aiohttp connector for chat API requests:
+        self._connector = _make_connector(keepalive_timeout)
+        # Bounds the number of chat API requests in flight, and so the
+        # number of connections in the API pool:
+        self._api_semaphore = asyncio.Semaphore(api_max_connections)
+        # aiohttp connector for channel requests:
+        self._channel_connector = _make_connector(keepalive_timeout)
+
+        self._channel = channel.Channel(
+            self._cookies, self._channel_connector,
+            url_prefix=channel_url_prefix,
+            refresh_cookies=(self._refresh_cookies
+                             if refresh_cookies is not None else None)
+        )
         # Future for Channel.listen
         self._listen_future = None
+        # Future for Client._prewarm_connection
+        self._prewarm_future = None
 
         self._request_header = hangouts_pb2.RequestHeader(
             # Ignore most of the RequestHeader fields since they aren't
@@ -93,6 +285,14 @@ class Client(object):
         self._channel.on_disconnect.add_observer(self.on_disconnect.fire)
         self._channel.on_receive_array.add_observer(self._on_receive_array)
 
+        # Open a connection for API requests while the channel connects, so
+        # the first request doesn't have to wait for DNS and TLS setup.
+        self._prewarm_future = asyncio.async(self._prewarm_connection())
+        if self._refresh_cookies_f is not None:
+            self._refresh_cookies_future = asyncio.async(
+                self._refresh_cookies_before_expiry()
+            )
+
         # Listen for StateUpdate messages from the Channel until it
         # disconnects.
         self._listen_future = asyncio.async(self._channel.listen())
@@ -100,7 +300,11 @@ class Client(object):
             yield from self._listen_future
         except asyncio.CancelledError:
             pass
+        self._prewarm_future.cancel()
+        if self._refresh_cookies_future is not None:
+            self._refresh_cookies_future.cancel()
         self._connector.close()
+        self._channel_connector.close()
         logger.info('Client.connect returning because Channel.listen returned')
 
     @asyncio.coroutine
@@ -178,6 +382,25 @@ class Client(object):
         except KeyError:
             raise KeyError("Cookie '{}' is required".format(name))
 
+    @asyncio.coroutine
+    def _prewarm_connection(self):
+        """Open a keep-alive connection to the chat API host.
+
+        The response is discarded, but the connection is returned to the pool
+        for the next API request to reuse.
+        """
+        try:
+            yield from http_utils.fetch('head', self._api_origin_url,
+                                        connector=self._connector,
+                                        retry=False,
+                                        semaphore=self._api_semaphore)
+        except exceptions.NetworkError as e:
+            # Any response at all means the connection is ready.
+            logger.debug('Pre-warming connection returned: {}'.format(e))
+        else:
+            logger.debug('Pre-warmed connection to {}'
+                         .format(self._api_origin_url))
+
     @asyncio.coroutine
     def _on_receive_array(self, array):
         """Parse channel array and call the appropriate events."""
@@ -206,6 +429,9 @@ class Client(object):
                     for state_update in batch_update.state_update:
                         logger.debug('Received StateUpdate:\n%s', state_update)
                         header = state_update.state_update_header
+                        state_updates_counter.inc(type=(
+                            state_update.WhichOneof('state_update') or 'none'
+                        ))
                         self._active_client_state = header.active_client_state
                         yield from self.on_state_update.fire(state_update)
                 else:
@@ -231,27 +457,108 @@ class Client(object):
         logger.info('Channel services added')
 
     @asyncio.coroutine
-    def _pb_request(self, endpoint, request_pb, response_pb):
+    def _refresh_cookies(self):
+        """Replace the cookies using refresh_cookies.
+
+        The cookies are updated in place without yielding, so the Channel
+        also uses the new cookies for its next request, and no request is
+        made with a mix of old and new cookies. If several requests fail at
+        once, the cookies are only refreshed once.
+
+        Raises hangups.AuthError if the cookies can not be refreshed.
+        """
+        cookies_version = self._cookies_version
+        with (yield from self._refresh_cookies_lock):
+            if cookies_version != self._cookies_version:
+                return  # Another request already refreshed the cookies.
+            logger.info('Refreshing cookies')
+            try:
+                cookies, expires = yield from self._refresh_cookies_f()
+            except auth.GoogleAuthError as e:
+                raise exceptions.AuthError(
+                    'Failed to refresh cookies: {}'.format(e)
+                )
+            self._cookies.clear()
+            self._cookies.update(cookies)
+            self._cookies_expires = expires
+            self._cookies_version += 1
+            logger.info('Cookies refreshed')
+
+    @asyncio.coroutine
+    def _refresh_cookies_before_expiry(self):
+        """Refresh the cookies shortly before they expire, until cancelled.
+
+        The long-polling request is not interrupted, since the cookies are
+        only sent when a request is opened.
+        """
+        while self._cookies_expires is not None:
+            delay = max(COOKIES_REFRESH_MIN_DELAY_SECS,
+                        self._cookies_expires - COOKIES_REFRESH_MARGIN_SECS -
+                        time.time())
+            logger.info('Refreshing cookies in {:.0f} seconds'.format(delay))
+            yield from asyncio.sleep(delay)
+            try:
+                yield from self._refresh_cookies()
+            except exceptions.AuthError as e:
+                # Try again after the minimum delay.
+                logger.warning('Failed to refresh cookies: {}'.format(e))
+        logger.info('Not refreshing cookies since their expiry is unknown')
+
+    @asyncio.coroutine
+    def _pb_request(self, endpoint, request_pb, response_pb, timeout=None):
         """Send a Protocol Buffer formatted chat API request.
 
+        The request is only retried if the endpoint is in IDEMPOTENT_ENDPOINTS.
+
         Args:
             endpoint (str): The chat API endpoint to use.
             request_pb: The request body as a Protocol Buffer message.
             response_pb: The response body as a Protocol Buffer message.
+            timeout (float): Total time in seconds allowed for the request,
+                including retries. Defaults to the Client's request_timeout.
 
         Raises:
             NetworkError: If the request fails.
         """
         logger.debug('Sending Protocol Buffer request %s:\n%s', endpoint,
                      request_pb)
-        res = yield from self._base_request(
-            'https://clients6.google.com/chat/v1/{}'.format(endpoint),
-            'application/json+protobuf',  # The request body is pblite.
-            'protojson',  # The response should be pblite.
-            json.dumps(pblite.encode(request_pb))
-        )
+        request_data = json.dumps(pblite.encode(request_pb))
+
+        @asyncio.coroutine
+        def send_request():
+            """Send the request and return (response, trace) tuple.
+
+            Each request is traced separately, so a hedged request has its
+            own request_id.
+            """
+            trace = self._get_request_tracer(endpoint)
+            if trace is not None:
+                yield from trace(http_utils.TRACE_QUEUED,
+                                 size=len(request_data))
+            res = yield from self._base_request(
+                '{}/chat/v1/{}'.format(self._api_origin_url, endpoint),
+                'application/json+protobuf',  # The request body is pblite.
+                'protojson',  # The response should be pblite.
+                request_data, timeout=timeout,
+                retry=endpoint in IDEMPOTENT_ENDPOINTS, trace=trace
+            )
+            return (res, trace)
+        hedger = self._hedgers.get(endpoint)
+        start_time = time.monotonic()
+        try:
+            if hedger is not None:
+                res, trace = yield from hedger.request(send_request)
+            else:
+                res, trace = yield from send_request()
+        finally:
+            api_request_duration_histogram.observe(
+                time.monotonic() - start_time, endpoint=endpoint
+            )
         pblite.decode(response_pb, javascript.loads(res.body.decode()),
                       ignore_first_item=True)
+        if trace is not None:
+            yield from trace(http_utils.TRACE_DECODED,
+                             size=response_pb.ByteSize())
         logger.debug('Received Protocol Buffer response:\n%s', response_pb)
         status = response_pb.response_header.status
         if status != hangouts_pb2.RESPONSE_STATUS_OK:
@@ -262,7 +569,8 @@ class Client(object):
             )
 
     @asyncio.coroutine
-    def _base_request(self, url, content_type, response_type, data):
+    def _base_request(self, url, content_type, response_type, data,
+                      headers=None, timeout=None, retry=False, trace=None):
         """Send a generic authenticated POST request.
 
         Args:
@@ -273,28 +581,74 @@ class Client(object):
                 Protocol Buffer). 'proto' requires manually setting an extra
                 header 'X-Goog-Encode-Response-If-Executable: base64'.
             data (str): Request body data.
+            headers (dict): Optional extra request headers.
+            timeout (float): Total time in seconds allowed for the request,
+                including retries. Defaults to the Client's request_timeout.
+            retry (bool): Whether the request is safe to retry.
+            trace: Optional coroutine function passed to http_utils.fetch to
+                report the stages of the request.
 
         Returns:
             FetchResponse: Response containing HTTP code, cookies, and body.
 
         Raises:
             NetworkError: If the request fails.
+            AuthError: If the request is not authorized, and the cookies
+                could not be refreshed.
         """
-        sapisid_cookie = self._get_cookie('SAPISID')
-        headers = channel.get_authorization_headers(sapisid_cookie)
-        headers['content-type'] = content_type
-        required_cookies = ['SAPISID', 'HSID', 'SSID', 'APISID', 'SID']
-        cookies = {cookie: self._get_cookie(cookie)
-                   for cookie in required_cookies}
         params = {
             # "alternative representation type" (desired response format).
             'alt': response_type,
         }
-        res = yield from http_utils.fetch(
-            'post', url, headers=headers, cookies=cookies, params=params,
-            data=data, connector=self._connector
-        )
-        return res
+        if timeout is None:
+            timeout = self._request_timeout
+        extra_headers = headers
+        for attempt_num in range(2):
+            # Use the current cookies, since they may have been refreshed.
+            sapisid_cookie = self._get_cookie('SAPISID')
+            headers = channel.get_authorization_headers(sapisid_cookie)
+            if extra_headers is not None:
+                headers.update(extra_headers)
+            headers['content-type'] = content_type
+            required_cookies = ['SAPISID', 'HSID', 'SSID', 'APISID', 'SID']
+            cookies = {cookie: self._get_cookie(cookie)
+                       for cookie in required_cookies}
+            try:
+                return (yield from http_utils.fetch(
+                    'post', url, headers=headers, cookies=cookies,
+                    params=params, data=data, connector=self._connector,
+                    timeout=timeout, retry=retry, trace=trace,
+                    semaphore=self._api_semaphore
+                ))
+            except exceptions.AuthError:
+                if self._refresh_cookies_f is None or attempt_num > 0:
+                    raise
+            yield from self._refresh_cookies()
+
+    def _get_request_tracer(self, endpoint):
+        """Return coroutine function reporting stages of a request.
+
+        Returns None if on_request_trace has no observers, so untraced requests
+        have no extra overhead.
+        """
+        if not self.on_request_trace.has_observers:
+            return None
+        request_id = next(self._request_ids)
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+        # Time of the previous stage (in a list so it can be updated):
+        prev_stage_time = [start_time]
+
+        @asyncio.coroutine
+        def trace(stage, size=None):
+            """Fire on_request_trace for a stage of the request."""
+            now = loop.time()
+            duration = now - prev_stage_time[0]
+            prev_stage_time[0] = now
+            yield from self.on_request_trace.fire(http_utils.RequestTrace(
+                request_id, endpoint, stage, size, now - start_time, duration
+            ))
+        return trace
 
     def _get_request_header_pb(self):
         """Return populated RequestHeader message."""
@@ -313,7 +667,7 @@ class Client(object):
     ###########################################################################
 
     @asyncio.coroutine
-    def syncallnewevents(self, timestamp):
+    def syncallnewevents(self, timestamp, max_response_size_bytes=1048576):
         """List all events occurring at or after timestamp.
 
         This method requests protojson rather than json so we have one chat
@@ -322,6 +676,10 @@ class Client(object):
         timestamp: datetime.datetime instance specifying the time after
         which to return all events occurring in.
 
+        max_response_size_bytes: approximate maximum size of the response.
+        Larger responses are truncated, and the remaining events may be
+        requested again from the returned sync_timestamp.
+
         Raises hangups.NetworkError if the request fails.
 
         Returns SyncAllNewEventsResponse.
@@ -329,7 +687,7 @@ class Client(object):
         request = hangouts_pb2.SyncAllNewEventsRequest(
             request_header=self._get_request_header_pb(),
             last_sync_timestamp=parsers.to_timestamp(timestamp),
-            max_response_size_bytes=1048576,
+            max_response_size_bytes=max_response_size_bytes,
         )
         response = hangouts_pb2.SyncAllNewEventsResponse()
         yield from self._pb_request('conversations/syncallnewevents', request,
@@ -340,11 +698,12 @@ class Client(object):
     def sendchatmessage(
             self, conversation_id, segments, image_id=None,
             otr_status=hangouts_pb2.OFF_THE_RECORD_STATUS_ON_THE_RECORD,
-            delivery_medium=None):
+            delivery_medium=None, client_generated_id=None):
         """Send a chat message to a conversation.
 
         conversation_id must be a valid conversation ID. segments must be a
-        list of message segments to send, in pblite format.
+        list of message segments to send, either in pblite format or as
+        hangouts_pb2.Segment.
 
         otr_status determines whether the message will be saved in the server's
         chat history. Note that the OTR status of the conversation is
@@ -355,17 +714,26 @@ class Client(object):
         Client.upload_image. If provided, the image will be attached to the
         message.
 
+        client_generated_id is an optional ID for the new event. Resending a
+        request with the same ID allows the server to ignore the duplicate. If
+        not provided, a random ID is used.
+
         Raises hangups.NetworkError if the request fails.
         """
         segments_pb = []
-        for segment_pblite in segments:
-            segment_pb = hangouts_pb2.Segment()
-            pblite.decode(segment_pb, segment_pblite)
-            segments_pb.append(segment_pb)
+        for segment in segments:
+            if isinstance(segment, hangouts_pb2.Segment):
+                segments_pb.append(segment)
+            else:
+                segment_pb = hangouts_pb2.Segment()
+                pblite.decode(segment_pb, segment)
+                segments_pb.append(segment_pb)
         if delivery_medium is None:
             delivery_medium = hangouts_pb2.DeliveryMedium(
                 medium_type=hangouts_pb2.DELIVERY_MEDIUM_BABEL,
             )
+        if client_generated_id is None:
+            client_generated_id = self.get_client_generated_id()
 
         request = hangouts_pb2.SendChatMessageRequest(
             request_header=self._get_request_header_pb(),
@@ -376,7 +744,7 @@ class Client(object):
                 conversation_id=hangouts_pb2.ConversationId(
                     id=conversation_id,
                 ),
-                client_generated_id=self.get_client_generated_id(),
+                client_generated_id=client_generated_id,
                 expected_otr=otr_status,
                 delivery_medium=delivery_medium,
                 event_type=hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
@@ -467,15 +835,24 @@ class Client(object):
         return response
 
     @asyncio.coroutine
-    def getconversation(self, conversation_id, event_timestamp, max_events=50):
+    def getconversation(self, conversation_id, event_timestamp, max_events=50,
+                        event_continuation_token=None):
         """Return conversation events.
 
         This is mainly used for retrieving conversation scrollback. Events
         occurring before event_timestamp are returned, in order from oldest to
         newest.
 
+        If event_continuation_token (hangouts_pb2.EventContinuationToken) is
+        given, for example from a previous response, it is used instead of
+        event_timestamp.
+
         Raises hangups.NetworkError if the request fails.
         """
+        if event_continuation_token is None:
+            event_continuation_token = hangouts_pb2.EventContinuationToken(
+                event_timestamp=parsers.to_timestamp(event_timestamp)
+            )
         request = hangouts_pb2.GetConversationRequest(
             request_header=self._get_request_header_pb(),
             conversation_spec=hangouts_pb2.ConversationSpec(
@@ -483,9 +860,7 @@ class Client(object):
             ),
             include_event=True,
             max_events_per_conversation=max_events,
-            event_continuation_token=hangouts_pb2.EventContinuationToken(
-                event_timestamp=parsers.to_timestamp(event_timestamp)
-            ),
+            event_continuation_token=event_continuation_token,
         )
         response = hangouts_pb2.GetConversationResponse()
         yield from self._pb_request('conversations/getconversation', request,
@@ -493,21 +868,34 @@ class Client(object):
         return response
 
     @asyncio.coroutine
-    def upload_image(self, image_file, filename=None):
+    def upload_image(self, image_file, filename=None, progress_callback=None):
         """Upload an image that can be later attached to a chat message.
 
-        image_file is a file-like object containing an image.
+        image_file is a seekable file-like object containing an image. It is
+        read and uploaded IMAGE_UPLOAD_CHUNK_SIZE bytes at a time, so only one
+        chunk is held in memory. Reads are run in the default executor to
+        avoid blocking the event loop.
+
+        If uploading a chunk fails, the upload is resumed from the last byte
+        received by the server, up to IMAGE_UPLOAD_MAX_RESUMES times. Failing
+        to query that offset also counts as a resume.
 
         The name of the uploaded file may be changed by specifying the filename
         argument.
 
+        progress_callback is an optional function called with arguments
+        (bytes_uploaded, total_bytes) after each chunk is uploaded.
+
         Raises hangups.NetworkError if the request fails.
 
         Returns ID of uploaded image.
         """
+        loop = asyncio.get_event_loop()
         image_filename = (filename if filename
                           else os.path.basename(image_file.name))
-        image_data = image_file.read()
+        image_size = yield from loop.run_in_executor(
+            None, image_file.seek, 0, os.SEEK_END
+        )
 
         # Create image and request upload URL
         res1 = yield from self._base_request(
@@ -522,7 +910,7 @@ class Client(object):
                             "name": "file",
                             "filename": image_filename,
                             "put": {},
-                            "size": len(image_data),
+                            "size": image_size,
                         }
                     }]
                 }
@@ -530,15 +918,71 @@ class Client(object):
         upload_url = (json.loads(res1.body.decode())['sessionStatus']
                       ['externalFieldTransfers'][0]['putInfo']['url'])
 
-        # Upload image data and get image ID
-        res2 = yield from self._base_request(
-            upload_url, 'application/octet-stream', 'json', image_data
-        )
+        # Upload image data in chunks and get image ID
+        offset = 0
+        num_resumes = 0
+        while True:
+            yield from loop.run_in_executor(None, image_file.seek, offset)
+            chunk = yield from loop.run_in_executor(
+                None, image_file.read, IMAGE_UPLOAD_CHUNK_SIZE
+            )
+            is_last_chunk = offset + len(chunk) >= image_size
+            try:
+                res2 = yield from self._base_request(
+                    upload_url, 'application/octet-stream', 'json', chunk,
+                    headers={
+                        'X-Goog-Upload-Command': ('upload, finalize'
+                                                  if is_last_chunk
+                                                  else 'upload'),
+                        'X-Goog-Upload-Offset': str(offset),
+                    }
+                )
+            except exceptions.NetworkError as e:
+                error = e
+                # Querying the offset to resume from may also fail, which
+                # counts as another resume attempt.
+                while True:
+                    if num_resumes == IMAGE_UPLOAD_MAX_RESUMES:
+                        raise error
+                    num_resumes += 1
+                    logger.info('Image upload failed at offset {}, '
+                                'resuming: {}'.format(offset, error))
+                    try:
+                        offset = yield from self._get_upload_offset(
+                            upload_url
+                        )
+                    except exceptions.NetworkError as e:
+                        error = e
+                    else:
+                        break
+                continue
+            offset += len(chunk)
+            if progress_callback is not None:
+                progress_callback(offset, image_size)
+            if is_last_chunk:
+                break
         return (json.loads(res2.body.decode())['sessionStatus']
                 ['additionalInfo']
                 ['uploader_service.GoogleRupioAdditionalInfo']
                 ['completionInfo']['customerSpecificInfo']['photoid'])
 
+    @asyncio.coroutine
+    def _get_upload_offset(self, upload_url):
+        """Return number of bytes received so far by a resumable upload.
+
+        Raises hangups.NetworkError if the request fails.
+        """
+        res = yield from self._base_request(
+            upload_url, 'application/octet-stream', 'json', b'',
+            headers={'X-Goog-Upload-Command': 'query'}
+        )
+        try:
+            return int(res.headers['X-Goog-Upload-Size-Received'])
+        except (KeyError, ValueError) as e:
+            raise exceptions.NetworkError(
+                'Failed to query upload offset: {}'.format(e)
+            )
+
     ###########################################################################
     # UNUSED raw API request methods (by hangups itself) for reference
     ###########################################################################
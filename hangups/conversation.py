@@ -1,27 +1,121 @@
 """Conversation objects."""
 
 import asyncio
+import bisect
+import collections
 import logging
+import time
 
 from hangups import (parsers, event, user, conversation_event, exceptions,
-                     hangouts_pb2)
+                     hangouts_pb2, metrics, snapshot, timeline)
 
 logger = logging.getLogger(__name__)
+sync_duration_histogram = metrics.REGISTRY.histogram(
+    'hangups_sync_duration_seconds',
+    'Time taken to sync events after connecting or reconnecting.'
+)
+# Maximum number of sendchatmessage requests in flight at once per
+# conversation:
+MAX_MESSAGES_IN_FLIGHT = 4
+# Maximum number of images uploaded at once per conversation while sending
+# messages:
+MAX_IMAGE_UPLOADS = 4
+# Number of times to retry a failed sendchatmessage request:
+SEND_MESSAGE_RETRIES = 2
+# Default maximum number of messages in flight during a broadcast:
+BROADCAST_CONCURRENCY = 10
+# Default maximum number of messages started per second during a broadcast:
+BROADCAST_RATE = 10
+# Maximum size in bytes of each syncallnewevents response:
+SYNC_MAX_RESPONSE_SIZE_BYTES = 1048576
+# Fraction of SYNC_MAX_RESPONSE_SIZE_BYTES above which a syncallnewevents
+# response is assumed to be truncated, so the next page is requested:
+SYNC_TRUNCATED_RATIO = 0.9
+# Fraction of SYNC_MAX_RESPONSE_SIZE_BYTES above which the last
+# syncallnewevents response of a sync is logged, since it may have been
+# truncated below SYNC_TRUNCATED_RATIO:
+SYNC_WARNING_RATIO = 0.75
+# Maximum number of syncallnewevents pages requested by a single sync:
+SYNC_MAX_PAGES = 100
 
 
 @asyncio.coroutine
-def build_user_conversation_list(client):
+def build_user_conversation_list(client, outbox=None, snapshot_path=None,
+                                 event_store=None, event_budget=None,
+                                 compact_events=False, search_index=None):
     """Return UserList from initial contact data and an additional request.
 
     The initial data contains the user's contacts, but there may be conversions
     containing users that are not in the contacts. This function takes care of
     requesting data for those users and constructing the UserList.
+
+    outbox is an optional hangups.outbox.Outbox to store outgoing messages in
+    until they are sent.
+
+    event_store is an optional hangups.event_store.EventStore to store
+    conversation events in, which is used to load older events without
+    requesting them.
+
+    event_budget is an optional hangups.retention.EventBudget limiting the
+    events kept in memory.
+
+    If compact_events is True, conversation events are kept in memory as
+    serialized bytes and parsed when their properties are read, which uses
+    less memory but more CPU time.
+
+    search_index is an optional hangups.search.SearchIndex to add chat
+    messages to as they arrive or are loaded.
+
+    To reduce startup time, independent requests are made concurrently, and
+    the lists are returned before the participants' entities are loaded.
+    Until then, participants are represented by fallback Users, which are
+    upgraded in place when their entities arrive and
+    UserList.on_users_loaded is fired. UserList.entities_future may be
+    waited for to find out when they have arrived.
+
+    snapshot_path is an optional path to a snapshot saved by
+    hangups.snapshot.save. If it can be loaded, the lists are restored from
+    it, and only events since the snapshot are requested when the client
+    connects. Participants missing from the snapshot are loaded in the
+    background like above.
     """
+    if snapshot_path is not None:
+        try:
+            snapshot_ = snapshot.load(snapshot_path)
+        except snapshot.SnapshotError as e:
+            logger.info('Not restoring snapshot: {}'.format(e))
+        else:
+            logger.info('Restoring snapshot from {}'.format(snapshot_path))
+            conv_part_list = []
+            for conv_state in snapshot_.conv_states:
+                conv_part_list.extend(conv_state.conversation.participant_data)
+            user_list = user.UserList(client, snapshot_.self_entity,
+                                      snapshot_.entities, conv_part_list)
+            conversation_list = ConversationList(
+                client, snapshot_.conv_states, user_list,
+                snapshot_.sync_timestamp, outbox=outbox,
+                event_store=event_store, event_budget=event_budget,
+                compact_events=compact_events, search_index=search_index
+            )
+            # Events may have been missed since the snapshot was saved.
+            conversation_list._set_synced(False)
+            # Events since the snapshot are requested by the
+            # ConversationList when the client connects, so only the
+            # entities missing from the snapshot need to be requested.
+            required_gaia_ids = (
+                {part.id.gaia_id for part in conv_part_list} -
+                {entity.id.gaia_id for entity in snapshot_.entities} -
+                {snapshot_.self_entity.id.gaia_id}
+            )
+            if required_gaia_ids:
+                user_list.load_entities_in_background(required_gaia_ids)
+            return (user_list, conversation_list)
 
     # Retrieve recent conversations so we can preemptively look up their
-    # participants.
-    sync_recent_conversations_response = (
-        yield from client.syncrecentconversations()
+    # participants, and the self entity, at the same time.
+    sync_recent_conversations_response, get_self_info_response = (
+        yield from asyncio.gather(client.syncrecentconversations(),
+                                  client.getselfinfo())
     )
     conv_states = sync_recent_conversations_response.conversation_state
     sync_timestamp = parsers.from_timestamp(
@@ -31,39 +125,28 @@ def build_user_conversation_list(client):
         # current_server_time instead.
         sync_recent_conversations_response.response_header.current_server_time
     )
-
-    # Retrieve entities participating in all conversations.
-    required_user_ids = set()
-    for conv_state in conv_states:
-        required_user_ids |= {
-            user.UserID(chat_id=part.id.chat_id, gaia_id=part.id.gaia_id)
-            for part in conv_state.conversation.participant_data
-        }
-    required_entities = []
-    if required_user_ids:
-        logger.debug('Need to request additional users: {}'
-                     .format(required_user_ids))
-        try:
-            response = yield from client.getentitybyid(
-                [user_id.gaia_id for user_id in required_user_ids]
-            )
-            required_entities = list(response.entity)
-        except exceptions.NetworkError as e:
-            logger.warning('Failed to request missing users: {}'.format(e))
+    self_entity = get_self_info_response.self_entity
 
     # Build list of conversation participants.
     conv_part_list = []
     for conv_state in conv_states:
         conv_part_list.extend(conv_state.conversation.participant_data)
 
-    # Retrieve self entity.
-    get_self_info_response = yield from client.getselfinfo()
-    self_entity = get_self_info_response.self_entity
-
-    user_list = user.UserList(client, self_entity, required_entities,
-                              conv_part_list)
+    user_list = user.UserList(client, self_entity, [], conv_part_list)
     conversation_list = ConversationList(client, conv_states, user_list,
-                                         sync_timestamp)
+                                         sync_timestamp, outbox=outbox,
+                                         event_store=event_store,
+                                         event_budget=event_budget,
+                                         compact_events=compact_events,
+                                         search_index=search_index)
+
+    # Retrieve entities participating in all conversations in the
+    # background.
+    required_gaia_ids = {part.id.gaia_id for part in conv_part_list}
+    if required_gaia_ids:
+        logger.debug('Need to request additional users: {}'
+                     .format(required_gaia_ids))
+        user_list.load_entities_in_background(required_gaia_ids)
     return (user_list, conversation_list)
 
 
@@ -71,16 +154,66 @@ class Conversation(object):
 
     """Wrapper around Client for working with a single chat conversation."""
 
-    def __init__(self, client, user_list, conversation, events=[]):
+    def __init__(self, client, user_list, conversation, events=[],
+                 outbox=None, event_store=None, event_budget=None,
+                 compact_events=False, search_index=None):
         """Initialize a new Conversation."""
         self._client = client  # Client
         self._user_list = user_list  # UserList
+        self._outbox = outbox  # Outbox or None
+        # Whether to keep events as serialized bytes to save memory:
+        self._compact_events = compact_events
+        # EventStore, EventBudget and SearchIndex or None, set after adding
+        # the initial events so they can be handled at once:
+        self._event_store = None
+        self._event_budget = None
+        self._search_index = None
         self._conversation = conversation  # hangouts_pb2.Conversation
-        self._events = []  # [hangouts_pb2.Event]
-        self._events_dict = {}  # {event_id: ConversationEvent}
-        self._send_message_lock = asyncio.Lock()
+        self._events = timeline.Timeline()  # Timeline of ConversationEvent
+        # Bounds the number of sendchatmessage requests in flight, including
+        # their retries:
+        self._send_semaphore = asyncio.Semaphore(MAX_MESSAGES_IN_FLIGHT)
+        # Bounds the number of images being uploaded for messages:
+        self._upload_semaphore = asyncio.Semaphore(MAX_IMAGE_UPLOADS)
+        # Future resolved once the request for the last queued message has
+        # started, or the message has failed before then:
+        self._last_message_started = None
+        # client_generated_ids of the messages being sent by send_message,
+        # which are skipped when sending messages from the outbox:
+        self._sending_ids = set()
+        # Whether messages sent by send_message were left in the outbox by
+        # failures, and lock held while sending messages from the outbox:
+        self._has_unsent_messages = False
+        self._send_outbox_lock = asyncio.Lock()
+        self._last_client_generated_id = 0
+        # Number of unread events, and of unread chat messages from other
+        # users, which are updated as events and the read timestamp change:
+        self._num_unread_events = 0
+        self._num_unread_chat_messages = 0
+        # Sorted list of (timestamp, is chat message from another user)
+        # tuples of the unread events evicted from memory, which are still
+        # included in the unread counts:
+        self._evicted_unread = []
+        # Timestamp of the oldest event evicted from memory, or None. Events
+        # are evicted oldest first, so the evicted events are those between
+        # it and the oldest event in memory:
+        self._evicted_timestamp = None
+        # Whether events that arrive are known to follow the newest event
+        # without gaps, which ConversationList updates as it syncs:
+        self._is_synced = True
         for event_ in events:
             self.add_event(event_)
+        self._event_store = event_store
+        if self._event_store is not None and self._events:
+            self._event_store.store_events(
+                self.id_, [conv_event._event for conv_event in self._events]
+            )
+        self._event_budget = event_budget
+        if self._event_budget is not None:
+            self._event_budget.add(self, list(self._events))
+        self._search_index = search_index
+        if self._search_index is not None:
+            self._search_index.add_events(self._events)
 
         # Event fired when a user starts or stops typing with arguments
         # (typing_message).
@@ -102,12 +235,64 @@ class Conversation(object):
         if self.get_user(notif.user_id).is_self:
             logger.info('latest_read_timestamp for {} updated to {}'
                         .format(self.id_, notif.read_timestamp))
+            old_timestamp = self.latest_read_timestamp
             self_conversation_state = (
                 self._conversation.self_conversation_state
             )
             self_conversation_state.self_read_state.latest_read_timestamp = (
                 parsers.to_timestamp(notif.read_timestamp)
             )
+            self._on_latest_read_timestamp_changed(old_timestamp)
+
+    def _count_events(self, conv_events):
+        """Return (events, chat messages from other users) count tuple."""
+        self_user_id = self._user_list.get_self_user().id_
+        num_messages = sum(
+            1 for conv_event in conv_events
+            if isinstance(conv_event, conversation_event.ChatMessageEvent) and
+            conv_event.user_id != self_user_id
+        )
+        return (len(conv_events), num_messages)
+
+    def _update_unread_counts(self, conv_events):
+        """Update unread counts for ConversationEvents added."""
+        latest_read_timestamp = self.latest_read_timestamp
+        num_events, num_messages = self._count_events([
+            conv_event for conv_event in conv_events
+            if conv_event.timestamp > latest_read_timestamp
+        ])
+        self._num_unread_events += num_events
+        self._num_unread_chat_messages += num_messages
+
+    def _remove_evicted_unread(self, start, end=None):
+        """Stop counting the unread evicted events _evicted_unread[start:end].
+
+        This is used when they are read, or loaded into memory again.
+        """
+        removed = self._evicted_unread[start:end]
+        del self._evicted_unread[start:end]
+        self._num_unread_events -= len(removed)
+        self._num_unread_chat_messages -= sum(
+            1 for _, is_message in removed if is_message
+        )
+
+    def _on_latest_read_timestamp_changed(self, old_timestamp):
+        """Update unread counts after latest_read_timestamp changed.
+
+        Only the events between the old and new timestamps are counted.
+        """
+        new_timestamp = self.latest_read_timestamp
+        start = self._events.bisect(min(old_timestamp, new_timestamp))
+        end = self._events.bisect(max(old_timestamp, new_timestamp))
+        num_events, num_messages = self._count_events(self._events[start:end])
+        sign = -1 if new_timestamp > old_timestamp else 1
+        self._num_unread_events += sign * num_events
+        self._num_unread_chat_messages += sign * num_messages
+        if new_timestamp > old_timestamp and self._evicted_unread:
+            self._remove_evicted_unread(
+                bisect.bisect(self._evicted_unread, (old_timestamp, True)),
+                bisect.bisect(self._evicted_unread, (new_timestamp, True))
+            )
 
     def update_conversation(self, conversation):
         """Update the internal Conversation."""
@@ -134,18 +319,19 @@ class Conversation(object):
             self_conversation_state.self_read_state.latest_read_timestamp = (
                 parsers.to_timestamp(old_timestamp)
             )
+        self._on_latest_read_timestamp_changed(old_timestamp)
 
-    @staticmethod
-    def _wrap_event(event_):
+    def _wrap_event(self, event_):
         """Wrap hangouts_pb2.Event in ConversationEvent subclass."""
         if event_.HasField('chat_message'):
-            return conversation_event.ChatMessageEvent(event_)
+            cls = conversation_event.ChatMessageEvent
         elif event_.HasField('conversation_rename'):
-            return conversation_event.RenameEvent(event_)
+            cls = conversation_event.RenameEvent
         elif event_.HasField('membership_change'):
-            return conversation_event.MembershipChangeEvent(event_)
+            cls = conversation_event.MembershipChangeEvent
         else:
-            return conversation_event.ConversationEvent(event_)
+            cls = conversation_event.ConversationEvent
+        return cls(event_, compact=self._compact_events)
 
     def add_event(self, event_):
         """Add an Event to the Conversation.
@@ -153,16 +339,43 @@ class Conversation(object):
         Returns an instance of ConversationEvent or subclass.
         """
         conv_event = self._wrap_event(event_)
-        if conv_event.id_ not in self._events_dict:
-            self._events.append(conv_event)
-            self._events_dict[conv_event.id_] = conv_event
-        else:
+        newest_event = self._events[-1] if self._events else None
+        if not self._events.add(conv_event):
             # If this happens, there's probably a bug.
             logger.info('Conversation %s ignoring duplicate event %s',
                         self.id_, conv_event.id_)
             return None
+        if self._event_store is not None:
+            # Link the event to the newest one only if no events can have
+            # been missed since then, and it didn't arrive out of order.
+            previous_event_id = None
+            if (self._is_synced and newest_event is not None and
+                    self._events[-1] is conv_event):
+                previous_event_id = newest_event.id_
+            self._event_store.store_events(self.id_, [event_],
+                                           previous_event_id)
+        self._update_unread_counts([conv_event])
+        if self._event_budget is not None:
+            self._event_budget.add(self, [conv_event])
+        if self._search_index is not None:
+            self._search_index.add_events([conv_event])
         return conv_event
 
+    def get_conversation_state(self, max_events=None):
+        """Return hangouts_pb2.ConversationState for this conversation.
+
+        If max_events is not None, only include that many of the latest
+        events.
+        """
+        events = self._events
+        if max_events is not None:
+            events = events[-max_events:] if max_events > 0 else []
+        return hangouts_pb2.ConversationState(
+            conversation_id=self._conversation.conversation_id,
+            conversation=self._conversation,
+            event=[conv_event._event for conv_event in events],
+        )
+
     def get_user(self, user_id):
         """Return the User instance with the given UserID."""
         return self._user_list.get_user(user_id)
@@ -188,13 +401,39 @@ class Conversation(object):
                 default_medium = medium_option.delivery_medium
         return default_medium
 
-    @asyncio.coroutine
+    def _get_next_client_generated_id(self):
+        """Return a client_generated_id greater than any previous one.
+
+        IDs are based on the current time in microseconds, so they also
+        increase across restarts.
+        """
+        self._last_client_generated_id = max(
+            self._last_client_generated_id + 1, int(time.time() * 1000000)
+        )
+        return self._last_client_generated_id
+
     def send_message(self, segments, image_file=None, image_id=None):
         """Send a message to this conversation.
 
-        A per-conversation lock is acquired to ensure that messages are sent in
-        the correct order when this method is called multiple times
-        asynchronously.
+        Returns an asyncio.Future for sending the message, which may be
+        waited for with yield from.
+
+        Each message is given a client_generated_id when this method is
+        called, so messages are ordered by the server in the order this
+        method was called. Several sendchatmessage requests (up to
+        MAX_MESSAGES_IN_FLIGHT) may be in flight at once, and are started in
+        the same order. Images are uploaded (up to MAX_IMAGE_UPLOADS at once)
+        while earlier messages are being sent.
+
+        A failed request is retried up to SEND_MESSAGE_RETRIES times with the
+        same client_generated_id, so the server can ignore duplicates and
+        the message keeps its place. A failed message doesn't hold back
+        later messages.
+
+        If the conversation has an outbox, the message is stored in it before
+        it is sent. If sending fails, the message stays in the outbox and is
+        sent again when the client reconnects, or after the next message to
+        this conversation is sent, so it should not be resent by the caller.
 
         segments is a list of ChatMessageSegments to include in the message.
 
@@ -205,28 +444,141 @@ class Conversation(object):
         (if you specify both image_file and image_id together, image_file
         takes precedence and supplied image_id will be ignored)
 
-        Raises hangups.NetworkError if the message can not be sent.
+        The future raises hangups.NetworkError if the message can not be
+        sent.
+        """
+        return self._send_message(
+            [segment.to_pb() for segment in segments], image_file=image_file,
+            image_id=image_id
+        )
+
+    def _send_message(self, segments_pb, image_file=None, image_id=None):
+        """Send a message of hangouts_pb2.Segments to this conversation.
+
+        This reserves the message's place in the send order before returning
+        a future for sending it. See send_message.
+        """
+        client_generated_id = self._get_next_client_generated_id()
+        previous_started = self._last_message_started
+        started = asyncio.Future()
+        self._last_message_started = started
+        self._sending_ids.add(client_generated_id)
+        return asyncio.async(self._send_message_in_order(
+            segments_pb, image_file, image_id, client_generated_id,
+            previous_started, started
+        ))
+
+    @asyncio.coroutine
+    def _send_message_in_order(self, segments_pb, image_file, image_id,
+                               client_generated_id, previous_started,
+                               started):
+        """Send a message once the previous message's request has started.
+
+        started is resolved when the request for this message starts, or
+        this message fails before then.
         """
-        with (yield from self._send_message_lock):
+        try:
             # Send messages with OTR status matching the conversation's status.
             otr_status = (hangouts_pb2.OFF_THE_RECORD_STATUS_OFF_THE_RECORD
                           if self.is_off_the_record else
                           hangouts_pb2.OFF_THE_RECORD_STATUS_ON_THE_RECORD)
             if image_file:
+                # Images are uploaded while earlier messages are sent. Uploads
+                # don't wait for earlier messages, so they can't deadlock.
+                with (yield from self._upload_semaphore):
+                    try:
+                        image_id = yield from self._client.upload_image(
+                            image_file
+                        )
+                    except exceptions.NetworkError as e:
+                        logger.warning('Failed to upload image: {}'.format(e))
+                        raise
+            send_kwargs = dict(
+                image_id=image_id, otr_status=otr_status,
+                delivery_medium=self._get_default_delivery_medium(),
+                client_generated_id=client_generated_id,
+            )
+            if self._outbox is not None:
+                outbox_id = yield from self._outbox.add_message(
+                    self.id_, client_generated_id, segments_pb, image_id,
+                    otr_status, send_kwargs['delivery_medium']
+                )
+            if previous_started is not None:
+                # Start requests in order, while earlier ones are in flight.
+                yield from previous_started
+            with (yield from self._send_semaphore):
+                started.set_result(None)
                 try:
-                    image_id = yield from self._client.upload_image(image_file)
-                except exceptions.NetworkError as e:
-                    logger.warning('Failed to upload image: {}'.format(e))
+                    yield from self._send_chat_message(segments_pb,
+                                                       send_kwargs)
+                except exceptions.NetworkError:
+                    if self._outbox is not None:
+                        self._has_unsent_messages = True
                     raise
+            if self._outbox is not None:
+                self._outbox.mark_sent(outbox_id)
+        finally:
+            # Never block later messages, even if this one failed.
+            if not started.done():
+                started.set_result(None)
+            # Until now, the message may be in the outbox, but mustn't be
+            # sent from there.
+            self._sending_ids.discard(client_generated_id)
+        if self._outbox is not None:
+            if self._has_unsent_messages:
+                # Send messages left in the outbox by earlier failures, which
+                # keep their place since they keep their client_generated_id.
+                self._has_unsent_messages = False
+                try:
+                    yield from self._send_outbox_messages()
+                except exceptions.NetworkError:
+                    self._has_unsent_messages = True
+
+    @asyncio.coroutine
+    def _send_outbox_messages(self):
+        """Send the messages of this conversation in the outbox in order.
+
+        Messages being sent by send_message are skipped. Messages are removed
+        from the outbox once they are sent.
+
+        Raises hangups.NetworkError if a message can not be sent, leaving it
+        and the following messages in the outbox.
+        """
+        with (yield from self._send_outbox_lock):
+            messages = yield from self._outbox.load_messages(self.id_)
+            # Skip messages being sent when they were loaded. Ones that
+            # finish sending later are no longer in the outbox by then.
+            messages = [message for message in messages
+                        if message.client_generated_id not in
+                        self._sending_ids]
+            for message in messages:
+                yield from self._send_chat_message(message.segments, dict(
+                    image_id=message.image_id, otr_status=message.otr_status,
+                    delivery_medium=message.delivery_medium,
+                    client_generated_id=message.client_generated_id,
+                ))
+                self._outbox.mark_sent(message.id_)
+
+    @asyncio.coroutine
+    def _send_chat_message(self, segments_pb, send_kwargs):
+        """Make a sendchatmessage request, retrying it if it fails.
+
+        Raises hangups.NetworkError if the message can not be sent.
+        """
+        for retry_num in range(SEND_MESSAGE_RETRIES + 1):
+            if retry_num > 0:
+                logger.info('Retrying message after attempt {} failed: {}'
+                            .format(retry_num - 1, error))
             try:
                 yield from self._client.sendchatmessage(
-                    self.id_, [seg.serialize() for seg in segments],
-                    image_id=image_id, otr_status=otr_status,
-                    delivery_medium=self._get_default_delivery_medium()
+                    self.id_, segments_pb, **send_kwargs
                 )
             except exceptions.NetworkError as e:
-                logger.warning('Failed to send message: {}'.format(e))
-                raise
+                error = e
+            else:
+                return
+        logger.warning('Failed to send message: {}'.format(error))
+        raise error
 
     @asyncio.coroutine
     def leave(self):
@@ -294,17 +646,19 @@ class Conversation(object):
         Raises hangups.NetworkError if the timestamp can not be updated.
         """
         if read_timestamp is None:
-            read_timestamp = self.events[-1].timestamp
+            read_timestamp = self._events[-1].timestamp
         if read_timestamp > self.latest_read_timestamp:
             logger.info(
                 'Setting {} latest_read_timestamp from {} to {}'
                 .format(self.id_, self.latest_read_timestamp, read_timestamp)
             )
             # Prevent duplicate requests by updating the conversation now.
+            old_timestamp = self.latest_read_timestamp
             state = self._conversation.self_conversation_state
             state.self_read_state.latest_read_timestamp = (
                 parsers.to_timestamp(read_timestamp)
             )
+            self._on_latest_read_timestamp_changed(old_timestamp)
             try:
                 yield from self._client.updatewatermark(self.id_,
                                                         read_timestamp)
@@ -318,14 +672,18 @@ class Conversation(object):
 
         If event_id is specified, return events preceding this event.
 
-        This method will make an API request to load historical events if
-        necessary. If the beginning of the conversation is reached, an empty
-        list will be returned.
+        This method will load historical events from the event store, or make
+        an API request to load them if they are not stored. If the beginning
+        of the conversation is reached, an empty list will be returned. If
+        event_id was evicted from memory, older events are loaded again until
+        it is found.
 
         Raises KeyError if event_id does not correspond to a known event.
 
         Raises hangups.NetworkError if the events could not be requested.
         """
+        if self._event_budget is not None:
+            self._event_budget.touch(self)
         if event_id is None:
             # If no event_id is provided, return the newest events in this
             # conversation.
@@ -334,58 +692,151 @@ class Conversation(object):
             # If event_id is provided, return the events we have that are
             # older, or request older events if event_id corresponds to the
             # oldest event we have.
-            conv_event = self.get_event(event_id)
-            if self._events[0].id_ != event_id:
-                conv_events = self._events[self._events.index(conv_event) + 1:]
+            while (event_id not in self._events and self._events and
+                   self._evicted_timestamp is not None and
+                   self._events[0].timestamp > self._evicted_timestamp):
+                # The event may have been evicted, so load the events
+                # evicted before the oldest one we have.
+                loaded_events = yield from self._add_events_before_oldest(
+                    max_events
+                )
+                if not loaded_events:
+                    break
+            index = self._events.index(event_id)
+            if index > 0:
+                conv_events = self._events[max(index - max_events, 0):index]
             else:
-                logger.info('Loading events for conversation {} before {}'
-                            .format(self.id_, conv_event.timestamp))
-                res = yield from self._client.getconversation(
-                    self.id_, conv_event.timestamp, max_events
+                conv_events = yield from self._add_events_before_oldest(
+                    max_events
                 )
-                conv_events = [self._wrap_event(event) for event
-                               in res.conversation_state.event]
-                logger.info('Loaded {} events for conversation {}'
-                            .format(len(conv_events), self.id_))
-                # Iterate though the events newest to oldest.
-                for conv_event in reversed(conv_events):
-                    # Add event as the new oldest event, unless we already have
-                    # it.
-                    if conv_event.id_ not in self._events_dict:
-                        self._events.insert(0, conv_event)
-                        self._events_dict[conv_event.id_] = conv_event
-                    else:
-                        # If this happens, there's probably a bug.
-                        logger.info(
-                            'Conversation %s ignoring duplicate event %s',
-                            self.id_, conv_event.id_
-                        )
         return conv_events
 
+    @asyncio.coroutine
+    def _add_events_before_oldest(self, max_events):
+        """Load and add up to max_events events preceding the oldest one.
+
+        Returns list of the loaded ConversationEvents.
+        """
+        conv_events = yield from self._load_events_before(self._events[0],
+                                                          max_events)
+        # Iterate though the events newest to oldest.
+        added_events = []
+        for conv_event in reversed(conv_events):
+            # Add event as the new oldest event, unless we already have it.
+            if self._events.add(conv_event):
+                added_events.append(conv_event)
+            else:
+                # If this happens, there's probably a bug.
+                logger.info('Conversation %s ignoring duplicate event %s',
+                            self.id_, conv_event.id_)
+        if self._evicted_unread and self._events:
+            # Evicted events loaded again are counted as loaded events.
+            self._remove_evicted_unread(bisect.bisect_left(
+                self._evicted_unread, (self._events[0].timestamp,)
+            ))
+        self._update_unread_counts(added_events)
+        if self._event_budget is not None:
+            self._event_budget.add(self, added_events)
+        if self._search_index is not None:
+            self._search_index.add_events(added_events)
+        return conv_events
+
+    @asyncio.coroutine
+    def _load_events_before(self, conv_event, max_events):
+        """Return list of ConversationEvents preceding conv_event.
+
+        Events are loaded from the event store if possible, and otherwise
+        requested and added to the event store.
+        """
+        if self._event_store is not None:
+            events = yield from self._event_store.load_events_before(
+                self.id_, conv_event.id_, max_events
+            )
+            if events:
+                logger.info('Loaded {} stored events for conversation {}'
+                            .format(len(events), self.id_))
+                return [self._wrap_event(event_) for event_ in events]
+        logger.info('Loading events for conversation {} before {}'
+                    .format(self.id_, conv_event.timestamp))
+        res = yield from self._client.getconversation(
+            self.id_, conv_event.timestamp, max_events
+        )
+        events = list(res.conversation_state.event)
+        logger.info('Loaded {} events for conversation {}'
+                    .format(len(events), self.id_))
+        new_events = [event_ for event_ in events
+                      if event_.event_id not in self._events]
+        if self._event_store is not None and new_events:
+            # The loaded events immediately precede conv_event.
+            self._event_store.store_events(self.id_,
+                                           new_events + [conv_event._event])
+        return [self._wrap_event(event_) for event_ in events]
+
+    def evict_events(self, num_events=None, num_bytes=None, keep_events=0):
+        """Remove the oldest events from memory.
+
+        Events are removed until at least num_events events and num_bytes
+        bytes of serialized events have been removed, if not None, while
+        keeping at least the newest keep_events events. Removed events are
+        loaded again by get_events when needed. Unread events which are
+        removed are still included in the unread counts.
+
+        Returns list of removed ConversationEvents.
+        """
+        count = 0
+        size = 0
+        for conv_event in self._events:
+            if ((num_events is None or count >= num_events) and
+                    (num_bytes is None or size >= num_bytes)):
+                break
+            if len(self._events) - count <= keep_events:
+                break
+            count += 1
+            size += conv_event._get_byte_size()
+        removed = self._events.remove_oldest(count)
+        if removed and (self._evicted_timestamp is None or
+                        removed[0].timestamp < self._evicted_timestamp):
+            self._evicted_timestamp = removed[0].timestamp
+        latest_read_timestamp = self.latest_read_timestamp
+        for conv_event in removed:
+            if conv_event.timestamp > latest_read_timestamp:
+                _, num_messages = self._count_events([conv_event])
+                bisect.insort(self._evicted_unread,
+                              (conv_event.timestamp, num_messages == 1))
+        return removed
+
     def next_event(self, event_id, prev=False):
         """Return ConversationEvent following the event with given event_id.
 
         If prev is True, return the previous event rather than the following
         one.
 
-        Raises KeyError if no such ConversationEvent is known.
-
-        Return None if there is no following event.
+        Return None if there is no following event, or if no event with
+        event_id is in memory, for example because it was evicted.
         """
-        i = self.events.index(self._events_dict[event_id])
+        if self._event_budget is not None:
+            self._event_budget.touch(self)
+        if event_id not in self._events:
+            return None
+        i = self._events.index(event_id)
         if prev and i > 0:
-            return self.events[i - 1]
-        elif not prev and i + 1 < len(self.events):
-            return self.events[i + 1]
+            return self._events[i - 1]
+        elif not prev and i + 1 < len(self._events):
+            return self._events[i + 1]
         else:
             return None
 
     def get_event(self, event_id):
         """Return ConversationEvent with the given event_id.
 
-        Raises KeyError if no such ConversationEvent is known.
+        Return None if no such ConversationEvent is in memory, for example
+        because it was evicted. Evicted events are loaded again by get_events.
         """
-        return self._events_dict[event_id]
+        if self._event_budget is not None:
+            self._event_budget.touch(self)
+        if event_id not in self._events:
+            return None
+        return self._events.get(event_id)
 
     @property
     def id_(self):
@@ -439,8 +890,26 @@ class Conversation(object):
         delay between sending a message and the user's own message being
         considered read.
         """
-        return [conv_event for conv_event in self._events
-                if conv_event.timestamp > self.latest_read_timestamp]
+        return self._events[self._events.bisect(self.latest_read_timestamp):]
+
+    @property
+    def num_unread_events(self):
+        """The number of unread ConversationEvents.
+
+        This is the length of unread_events, but doesn't need to find them,
+        plus the number of unread events which were evicted from memory.
+        Events which were evicted after being read are not counted if the
+        read timestamp moves back before them, until they are loaded again.
+        """
+        return self._num_unread_events
+
+    @property
+    def num_unread_chat_messages(self):
+        """The number of unread chat messages from other users.
+
+        Like num_unread_events, this includes evicted messages.
+        """
+        return self._num_unread_chat_messages
 
     @property
     def is_archived(self):
@@ -464,11 +933,23 @@ class Conversation(object):
 class ConversationList(object):
     """Wrapper around Client that maintains a list of Conversations."""
 
-    def __init__(self, client, conv_states, user_list, sync_timestamp):
+    def __init__(self, client, conv_states, user_list, sync_timestamp,
+                 outbox=None, event_store=None, event_budget=None,
+                 compact_events=False, search_index=None):
         self._client = client  # Client
         self._conv_dict = {}  # {conv_id: Conversation}
         self._sync_timestamp = sync_timestamp  # datetime
         self._user_list = user_list  # UserList
+        self._outbox = outbox  # Outbox or None
+        self._event_store = event_store  # EventStore or None
+        self._event_budget = event_budget  # EventBudget or None
+        self._compact_events = compact_events
+        self._search_index = search_index  # SearchIndex or None
+        # Lock held while flushing the outbox:
+        self._flush_outbox_lock = asyncio.Lock()
+        # Whether all events up to the present have been synced, so events
+        # that arrive follow the newest events of their conversations:
+        self._is_synced = True
 
         # Initialize the list of conversations from Client's list of
         # hangouts_pb2.ConversationState.
@@ -476,8 +957,17 @@ class ConversationList(object):
             self.add_conversation(conv_state.conversation, conv_state.event)
 
         self._client.on_state_update.add_observer(self._on_state_update)
+        self._client.on_disconnect.add_observer(self._on_disconnect)
         self._client.on_connect.add_observer(self._sync)
         self._client.on_reconnect.add_observer(self._sync)
+        if self._outbox is not None:
+            # Flush after syncing, so conversations created while
+            # disconnected are known.
+            self._client.on_connect.add_observer(self.flush_outbox)
+            self._client.on_reconnect.add_observer(self.flush_outbox)
+            if len(self._outbox) > 0:
+                # Send messages left over from a previous session.
+                asyncio.async(self.flush_outbox())
 
         # Event fired when a new ConversationEvent arrives with arguments
         # (ConversationEvent).
@@ -499,6 +989,11 @@ class ConversationList(object):
         return [conv for conv in self._conv_dict.values()
                 if not conv.is_archived or include_archived]
 
+    @property
+    def sync_timestamp(self):
+        """The time events were last synced until as a datetime."""
+        return self._sync_timestamp
+
     def get(self, conv_id):
         """Return a Conversation from its ID.
 
@@ -511,16 +1006,123 @@ class ConversationList(object):
         conv_id = conversation.conversation_id.id
         logger.info('Adding new conversation: {}'.format(conv_id))
         conv = Conversation(self._client, self._user_list, conversation,
-                            events)
+                            events, outbox=self._outbox,
+                            event_store=self._event_store,
+                            event_budget=self._event_budget,
+                            compact_events=self._compact_events,
+                            search_index=self._search_index)
+        conv._is_synced = self._is_synced
         self._conv_dict[conv_id] = conv
         return conv
 
+    def broadcast(self, segments, conv_ids,
+                  concurrency=BROADCAST_CONCURRENCY, rate=BROADCAST_RATE):
+        """Send the same message to many conversations.
+
+        segments is a list of ChatMessageSegments to send, which are only
+        serialized once. At most concurrency messages are in flight at once,
+        and at most rate messages are started per second (or any number if
+        rate is None). Each message is sent like Conversation.send_message,
+        so it is ordered with other messages sent to the same conversation.
+
+        Returns an iterator of futures like asyncio.as_completed, which resolve
+        to (conv_id, error) tuples in the order the messages finish sending,
+        where error is None or the hangups.NetworkError raised when sending
+        the message failed.
+
+        Raises KeyError if any conversation ID is invalid, before any messages
+        are sent. Raises ValueError if concurrency is less than 1, or rate is
+        not positive or None.
+        """
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be positive or None')
+        convs = [self._conv_dict[conv_id] for conv_id in conv_ids]
+        segments_pb = [segment.to_pb() for segment in segments]
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_event_loop()
+        next_start_time = loop.time()
+
+        @asyncio.coroutine
+        def send(conv):
+            """Send the message to conv and return (conv_id, error)."""
+            nonlocal next_start_time
+            with (yield from semaphore):
+                if rate is not None:
+                    # Reserve the next start time before sleeping.
+                    start_time = max(loop.time(), next_start_time)
+                    next_start_time = start_time + 1 / rate
+                    yield from asyncio.sleep(start_time - loop.time())
+                try:
+                    yield from conv._send_message(segments_pb)
+                except exceptions.NetworkError as e:
+                    return (conv.id_, e)
+                return (conv.id_, None)
+
+        logger.info('Broadcasting message to {} conversations'
+                    .format(len(convs)))
+        return asyncio.as_completed([asyncio.async(send(conv))
+                                     for conv in convs])
+
+    @asyncio.coroutine
+    def flush_outbox(self):
+        """Send the messages in the outbox.
+
+        Conversations are flushed concurrently, but the messages of each
+        conversation are sent in order. If a message fails to send, the
+        remaining messages of its conversation are left in the outbox.
+
+        Only one flush runs at a time. Another flush waits for it to finish,
+        and then sends the messages that are still in the outbox.
+        """
+        with (yield from self._flush_outbox_lock):
+            # {conv_id: [OutboxMessage]}
+            messages = collections.OrderedDict()
+            for message in (yield from self._outbox.load_messages()):
+                messages.setdefault(message.conversation_id,
+                                    []).append(message)
+            if messages:
+                logger.info('Flushing outbox for {} conversations'
+                            .format(len(messages)))
+                yield from asyncio.gather(*[
+                    self._flush_conversation_outbox(conv_id, conv_messages)
+                    for conv_id, conv_messages in messages.items()
+                ])
+
+    @asyncio.coroutine
+    def _flush_conversation_outbox(self, conv_id, messages):
+        """Send list of OutboxMessages for one conversation in order."""
+        conv = self._conv_dict.get(conv_id)
+        try:
+            if conv is not None:
+                # The conversation skips messages being sent by
+                # Conversation.send_message, and loads the messages again
+                # under its lock.
+                yield from conv._send_outbox_messages()
+                return
+            # Messages to conversations unknown to this session are only
+            # sent here, and flushes don't overlap.
+            for message in messages:
+                yield from self._client.sendchatmessage(
+                    conv_id, message.segments, image_id=message.image_id,
+                    otr_status=message.otr_status,
+                    delivery_medium=message.delivery_medium,
+                    client_generated_id=message.client_generated_id,
+                )
+                self._outbox.mark_sent(message.id_)
+        except exceptions.NetworkError as e:
+            logger.warning('Failed to flush outbox for conversation '
+                           '{}: {}'.format(conv_id, e))
+
     @asyncio.coroutine
     def leave_conversation(self, conv_id):
         """Leave conversation and remove it from ConversationList"""
         logger.info('Leaving conversation: {}'.format(conv_id))
         yield from self._conv_dict[conv_id].leave()
-        del self._conv_dict[conv_id]
+        conv = self._conv_dict.pop(conv_id)
+        if self._event_budget is not None:
+            self._event_budget.remove(conv)
 
     @asyncio.coroutine
     def _on_state_update(self, state_update):
@@ -594,29 +1196,83 @@ class ConversationList(object):
             logger.warning('Received WatermarkNotification for '
                            'unknown conversation {}'.format(conv_id))
 
+    def _set_synced(self, is_synced):
+        """Set whether all events up to the present have been synced."""
+        self._is_synced = is_synced
+        for conv in self._conv_dict.values():
+            conv._is_synced = is_synced
+
+    def _on_disconnect(self):
+        """Receive disconnect event, after which events may be missed."""
+        self._set_synced(False)
+
     @asyncio.coroutine
     def _sync(self):
-        """Sync conversation state and events that could have been missed."""
+        """Sync conversation state and events that could have been missed.
+
+        Events are requested in pages of up to SYNC_MAX_RESPONSE_SIZE_BYTES.
+        The server truncates larger responses, so while responses are close
+        to the limit, the next page is requested from the sync_timestamp of
+        the previous one. Each page is processed as soon as it arrives.
+
+        Until a sync completes, events are not linked to the preceding events
+        in the event store, since events may have been missed.
+        """
         logger.info('Syncing events since {}'.format(self._sync_timestamp))
-        try:
-            res = yield from self._client.syncallnewevents(
-                self._sync_timestamp
-            )
-        except exceptions.NetworkError as e:
-            logger.warning('Failed to sync events, some events may be lost: {}'
-                           .format(e))
+        start_time = time.monotonic()
+        self._set_synced(False)
+        since = self._sync_timestamp
+        for _ in range(SYNC_MAX_PAGES):
+            try:
+                res = yield from self._client.syncallnewevents(
+                    since, max_response_size_bytes=SYNC_MAX_RESPONSE_SIZE_BYTES
+                )
+            except exceptions.NetworkError as e:
+                logger.warning('Failed to sync events, some events may be '
+                               'lost: {}'.format(e))
+                break
+            yield from self._handle_sync_page(res, since)
+            if not res.sync_timestamp:
+                self._set_synced(True)
+                break
+            next_since = parsers.from_timestamp(res.sync_timestamp)
+            if next_since > self._sync_timestamp:
+                self._sync_timestamp = next_since
+            size = res.ByteSize()
+            is_truncated = (size >= SYNC_TRUNCATED_RATIO *
+                            SYNC_MAX_RESPONSE_SIZE_BYTES)
+            if not is_truncated or next_since <= since:
+                if size >= SYNC_WARNING_RATIO * SYNC_MAX_RESPONSE_SIZE_BYTES:
+                    logger.warning('Last sync response was {} bytes, some '
+                                   'events may be lost if it was truncated'
+                                   .format(size))
+                self._set_synced(True)
+                break
+            logger.info('Sync response was truncated, continuing from {}'
+                        .format(next_since))
+            since = next_since
         else:
-            for conv_state in res.conversation_state:
-                conv_id = conv_state.conversation_id.id
-                conv = self._conv_dict.get(conv_id, None)
-                if conv is not None:
-                    conv.update_conversation(conv_state.conversation)
-                    for event_ in conv_state.event:
-                        timestamp = parsers.from_timestamp(event_.timestamp)
-                        if timestamp > self._sync_timestamp:
-                            # This updates the sync_timestamp for us, as well
-                            # as triggering events.
-                            yield from self._on_event(event_)
-                else:
-                    self.add_conversation(conv_state.conversation,
-                                          conv_state.event)
+            logger.warning('Stopped syncing after {} pages, some events may '
+                           'be lost'.format(SYNC_MAX_PAGES))
+        sync_duration_histogram.observe(time.monotonic() - start_time)
+
+    @asyncio.coroutine
+    def _handle_sync_page(self, res, since):
+        """Process a SyncAllNewEventsResponse requested from since."""
+        for conv_state in res.conversation_state:
+            conv_id = conv_state.conversation_id.id
+            conv = self._conv_dict.get(conv_id, None)
+            if conv is not None:
+                conv.update_conversation(conv_state.conversation)
+                for event_ in conv_state.event:
+                    # Compare with the start of the page rather than
+                    # self._sync_timestamp, which _on_event advances, so
+                    # events of later conversations aren't skipped.
+                    timestamp = parsers.from_timestamp(event_.timestamp)
+                    if timestamp > since:
+                        # This updates the sync_timestamp for us, as well
+                        # as triggering events.
+                        yield from self._on_event(event_)
+            else:
+                self.add_conversation(conv_state.conversation,
+                                      conv_state.event)
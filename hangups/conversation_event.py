@@ -10,6 +10,13 @@ from hangups import parsers, message_parser, user, hangouts_pb2, pblite
 
 logger = logging.getLogger(__name__)
 chat_message_parser = message_parser.ChatMessageParser()
+# Attachment embed item types which are known to be valid:
+KNOWN_EMBED_ITEM_TYPES = frozenset([
+    hangouts_pb2.ITEM_TYPE_PLUS_PHOTO,
+    hangouts_pb2.ITEM_TYPE_PLACE_V2,
+    hangouts_pb2.ITEM_TYPE_PLACE,
+    hangouts_pb2.ITEM_TYPE_THING,
+])
 
 
 class ConversationEvent(object):
@@ -19,21 +26,70 @@ class ConversationEvent(object):
     This corresponds to hangouts_pb2.Event.
 
     This is the base class for such events.
+
+    If compact is True, the event is kept as serialized bytes, which use much
+    less memory than a hangouts_pb2.Event, and parsed again whenever a
+    property other than id_ or timestamp is read.
+
+    Events are immutable, so the values of properties are computed when they
+    are first read and cached, except for values parsed from compact events.
     """
 
-    def __init__(self, event):
-        self._event = event  # Event
+    __slots__ = ('_event_pb', '_event_bytes', '_id', '_raw_timestamp',
+                 '_timestamp', '_user_id')
+
+    def __init__(self, event, compact=False):
+        if compact:
+            self._event_pb = None
+            self._event_bytes = event.SerializeToString()  # bytes
+        else:
+            self._event_pb = event  # Event
+            self._event_bytes = None
+        self._id = event.event_id
+        self._raw_timestamp = event.timestamp
+        self._timestamp = None  # datetime or None
+        self._user_id = None  # UserID or None
+
+    @property
+    def _event(self):
+        """The hangouts_pb2.Event, parsed again if the event is compact."""
+        if self._event_pb is not None:
+            return self._event_pb
+        event = hangouts_pb2.Event()
+        event.ParseFromString(self._event_bytes)
+        return event
+
+    def _memoize(self, name, value):
+        """Cache value in the slot name unless the event is compact.
+
+        Returns value.
+        """
+        if self._event_pb is not None:
+            setattr(self, name, value)
+        return value
+
+    def _get_byte_size(self):
+        """Return the serialized size of the event in bytes."""
+        if self._event_pb is not None:
+            return self._event_pb.ByteSize()
+        return len(self._event_bytes)
 
     @property
     def timestamp(self):
         """A timestamp of when the event occurred."""
-        return parsers.from_timestamp(self._event.timestamp)
+        if self._timestamp is None:
+            self._timestamp = parsers.from_timestamp(self._raw_timestamp)
+        return self._timestamp
 
     @property
     def user_id(self):
         """A UserID indicating who created the event."""
-        return user.UserID(chat_id=self._event.sender_id.chat_id,
-                           gaia_id=self._event.sender_id.gaia_id)
+        if self._user_id is not None:
+            return self._user_id
+        sender_id = self._event.sender_id
+        return self._memoize('_user_id', user.UserID(
+            chat_id=sender_id.chat_id, gaia_id=sender_id.gaia_id
+        ))
 
     @property
     def conversation_id(self):
@@ -43,7 +99,7 @@ class ConversationEvent(object):
     @property
     def id_(self):
         """The ID of the ConversationEvent."""
-        return self._event.event_id
+        return self._id
 
 
 class ChatMessageSegment(object):
@@ -92,6 +148,10 @@ class ChatMessageSegment(object):
 
     def serialize(self):
         """Serialize the segment to pblite."""
+        return pblite.encode(self.to_pb())
+
+    def to_pb(self):
+        """Return the segment as hangouts_pb2.Segment."""
         segment = hangouts_pb2.Segment(
             type=self.type_,
             text=self.text,
@@ -104,7 +164,7 @@ class ChatMessageSegment(object):
         )
         if self.link_target is not None:
             segment.link_data.link_target = self.link_target
-        return pblite.encode(segment)
+        return segment
 
 
 class ChatMessageEvent(ConversationEvent):
@@ -114,9 +174,19 @@ class ChatMessageEvent(ConversationEvent):
     Corresponds to hangouts_pb2.ChatMessage.
     """
 
+    __slots__ = ('_text', '_segments', '_attachments')
+
+    def __init__(self, event, compact=False):
+        super().__init__(event, compact=compact)
+        self._text = None  # str or None
+        self._segments = None  # [ChatMessageSegment] or None
+        self._attachments = None  # [str] or None
+
     @property
     def text(self):
         """A textual representation of the message."""
+        if self._text is not None:
+            return self._text
         lines = ['']
         for segment in self.segments:
             if segment.type_ == hangouts_pb2.SEGMENT_TYPE_TEXT:
@@ -129,30 +199,33 @@ class ChatMessageEvent(ConversationEvent):
                 logger.warning('Ignoring unknown chat message segment type: {}'
                                .format(segment.type_))
         lines.extend(self.attachments)
-        return '\n'.join(lines)
+        return self._memoize('_text', '\n'.join(lines))
 
     @property
     def segments(self):
-        """List of hangouts_pb2.Segment in the message."""
-        seg_list = self._event.chat_message.message_content.segment
-        return [ChatMessageSegment.deserialize(seg) for seg in seg_list]
+        """List of ChatMessageSegments in the message."""
+        if self._segments is None:
+            seg_list = self._event.chat_message.message_content.segment
+            segments = self._memoize('_segments', [
+                ChatMessageSegment.deserialize(seg) for seg in seg_list
+            ])
+        else:
+            segments = self._segments
+        # Return a copy so callers can't modify the cached list.
+        return list(segments)
 
     @property
     def attachments(self):
         """Attachments in the message."""
+        if self._attachments is not None:
+            return list(self._attachments)
         raw_attachments = self._event.chat_message.message_content.attachment
         if raw_attachments is None:
             raw_attachments = []
         attachments = []
         for attachment in raw_attachments:
             for embed_item_type in attachment.embed_item.type:
-                known_types = [
-                    hangouts_pb2.ITEM_TYPE_PLUS_PHOTO,
-                    hangouts_pb2.ITEM_TYPE_PLACE_V2,
-                    hangouts_pb2.ITEM_TYPE_PLACE,
-                    hangouts_pb2.ITEM_TYPE_THING,
-                ]
-                if embed_item_type not in known_types:
+                if embed_item_type not in KNOWN_EMBED_ITEM_TYPES:
                     logger.warning('Received chat message attachment with '
                                    'unknown embed type: %r', embed_item_type)
 
@@ -160,7 +233,8 @@ class ChatMessageEvent(ConversationEvent):
                 attachments.append(
                     attachment.embed_item.plus_photo.thumbnail.image_url
                 )
-        return attachments
+        self._memoize('_attachments', attachments)
+        return list(attachments)
 
 
 class RenameEvent(ConversationEvent):
@@ -170,6 +244,8 @@ class RenameEvent(ConversationEvent):
     Corresponds to hangouts_pb2.ConversationRename.
     """
 
+    __slots__ = ()
+
     @property
     def new_name(self):
         """The conversation's new name.
@@ -194,6 +270,8 @@ class MembershipChangeEvent(ConversationEvent):
     Corresponds to hangouts_pb2.MembershipChange.
     """
 
+    __slots__ = ()
+
     @property
     def type_(self):
         """The membership change type (MembershipChangeType)."""
@@ -5,8 +5,15 @@ Observers must be removed to avoid memory leaks.
 
 import asyncio
 import logging
+import time
+
+from hangups import metrics
 
 logger = logging.getLogger(__name__)
+observer_duration_histogram = metrics.REGISTRY.histogram(
+    'hangups_event_observer_duration_seconds',
+    'Time taken by event observer callbacks.', ['event']
+)
 
 
 class Event(object):
@@ -40,14 +47,22 @@ class Event(object):
                              .format(callback, self))
         self._observers.remove(callback)
 
+    @property
+    def has_observers(self):
+        """True if the event has any observers."""
+        return len(self._observers) > 0
+
     @asyncio.coroutine
     def fire(self, *args, **kwargs):
         """Call all observer callbacks with the same arguments."""
         logger.debug('Fired {}'.format(self))
         for observer in self._observers:
+            start_time = time.monotonic()
             gen = observer(*args, **kwargs)
             if asyncio.iscoroutinefunction(observer):
                 yield from gen
+            observer_duration_histogram.observe(time.monotonic() - start_time,
+                                                event=self._name)
 
     def __repr__(self):
         return 'Event(\'{}\')'.format(self._name)
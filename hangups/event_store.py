@@ -0,0 +1,163 @@
+"""Persistent storage for conversation events.
+
+Events are stored in an SQLite database, indexed by conversation ID, event ID
+and timestamp. The store may not contain every event of a conversation, for
+example if the client was disconnected for some time. To avoid serving
+history with gaps, each event records the ID of the event preceding it when
+that is known, and only unbroken chains of events are returned.
+
+Coroutines should use store_events and load_events_before, which use the
+database in a separate thread so they don't block the event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import sqlite3
+import threading
+
+from hangups import hangouts_pb2
+
+logger = logging.getLogger(__name__)
+
+
+class EventStore(object):
+
+    """Store of hangouts_pb2.Events in an SQLite database.
+
+    path is the path of the database file, which is created if it doesn't
+    exist. Use ':memory:' for a store which is not persisted.
+    """
+
+    def __init__(self, path):
+        # The database is used by the executor's thread as well as the
+        # caller's, so access is serialized by a lock. The executor has a
+        # single thread, so operations run in the order they are started.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Events are written often, so trade durability of the last few
+        # writes after a power failure for speed.
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'conversation_id TEXT NOT NULL, '
+                'event_id TEXT NOT NULL, '
+                'timestamp INTEGER NOT NULL, '
+                'previous_event_id TEXT, '
+                'event BLOB NOT NULL, '
+                'PRIMARY KEY (conversation_id, event_id))'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS events_by_timestamp '
+                'ON events (conversation_id, timestamp)'
+            )
+
+    def add_events(self, conversation_id, events, previous_event_id=None):
+        """Add consecutive events of a conversation.
+
+        events is a list of hangouts_pb2.Events ordered oldest first, with no
+        events missing between them. previous_event_id is the ID of the event
+        preceding the first one, or None if it is unknown.
+
+        Events which are already stored are not replaced, but are linked to
+        the preceding event if it was unknown.
+        """
+        rows = []
+        for event_ in events:
+            rows.append((conversation_id, event_.event_id, event_.timestamp,
+                         previous_event_id, event_.SerializeToString()))
+            previous_event_id = event_.event_id
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO events (conversation_id, event_id, '
+                'timestamp, previous_event_id, event) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._db.executemany(
+                'UPDATE events SET previous_event_id = ? '
+                'WHERE conversation_id = ? AND event_id = ? '
+                'AND previous_event_id IS NULL',
+                [(row[3], row[0], row[1]) for row in rows
+                 if row[3] is not None]
+            )
+
+    def get_events_before(self, conversation_id, event_id, max_events):
+        """Return list of up to max_events events preceding an event.
+
+        Events are ordered oldest first. Only events which are known to be
+        consecutive are returned, so fewer than max_events (or none) may be
+        returned even if older events are stored.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT timestamp, previous_event_id FROM events '
+                'WHERE conversation_id = ? AND event_id = ?',
+                (conversation_id, event_id)
+            ).fetchone()
+            if row is None or row[1] is None:
+                return []
+            timestamp, expected_event_id = row
+            rows = self._db.execute(
+                'SELECT event_id, previous_event_id, event FROM events '
+                'WHERE conversation_id = ? AND timestamp <= ? '
+                'AND event_id != ? ORDER BY timestamp DESC LIMIT ?',
+                (conversation_id, timestamp, event_id, max_events)
+            ).fetchall()
+        events = []
+        for event_id_, previous_event_id, data in rows:
+            if event_id_ != expected_event_id:
+                break
+            event_ = hangouts_pb2.Event()
+            event_.ParseFromString(data)
+            events.append(event_)
+            expected_event_id = previous_event_id
+            if expected_event_id is None:
+                break
+        events.reverse()
+        return events
+
+    def store_events(self, conversation_id, events, previous_event_id=None):
+        """Add consecutive events of a conversation in a thread.
+
+        Takes the same arguments as add_events. The events are added in the
+        background, and the returned asyncio.Future may be waited for to
+        find out whether they were. Failures are also logged.
+        """
+        future = self._run_in_executor(self.add_events, conversation_id,
+                                       events, previous_event_id)
+        future.add_done_callback(self._on_events_stored)
+        return future
+
+    @staticmethod
+    def _on_events_stored(future):
+        """Log a failure to store events."""
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning('Failed to store events: {}'
+                           .format(future.exception()))
+
+    @asyncio.coroutine
+    def load_events_before(self, conversation_id, event_id, max_events):
+        """Return list of events like get_events_before, in a thread.
+
+        Events stored before this is called are included.
+        """
+        return (yield from self._run_in_executor(
+            self.get_events_before, conversation_id, event_id, max_events
+        ))
+
+    def _run_in_executor(self, func, *args):
+        """Start calling func in the store's thread and return a Future.
+
+        The call is queued immediately, so calls run in the order this is
+        called.
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        """Wait for pending operations and close the database."""
+        self._executor.shutdown()
+        self._db.close()
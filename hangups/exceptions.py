@@ -9,3 +9,8 @@ class HangupsError(Exception):
 class NetworkError(HangupsError):
     """hangups network operation failed."""
     pass
+
+
+class AuthError(NetworkError):
+    """hangups request was rejected because the cookies are invalid."""
+    pass
@@ -0,0 +1,267 @@
+"""Export conversation history to files.
+
+Events are written to a file per conversation, either as length-delimited
+binary hangouts_pb2.Events (each preceded by its size as a varint), or as JSON
+Lines with an object per event. Files may be compressed with gzip.
+
+Events can be exported from the events kept in memory by a ConversationList,
+which are written oldest first, or by downloading the full history of
+conversations with hangups.backfill.Backfill, which is written newest first.
+Either way, events are written in batches as they become available, so memory
+use is bounded by the batch size rather than the size of the history.
+"""
+
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import os
+
+from google.protobuf.descriptor import FieldDescriptor
+
+from hangups import backfill, hangouts_pb2
+
+logger = logging.getLogger(__name__)
+# Length-delimited binary Protocol Buffers:
+FORMAT_PROTOBUF = 'protobuf'
+# JSON Lines:
+FORMAT_JSON = 'jsonl'
+_EXTENSIONS = {FORMAT_PROTOBUF: '.pb', FORMAT_JSON: '.jsonl'}
+# Number of events written at a time when exporting from memory:
+BATCH_SIZE = 1000
+
+
+def _encode_varint(value):
+    """Return bytes encoding an unsigned integer as a varint."""
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _message_to_dict(message):
+    """Return JSON-compatible dict of a Protocol Buffer message's fields.
+
+    Enum values are converted to their names, and bytes to base64.
+    """
+    result = {}
+    for field, value in message.ListFields():
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            result[field.name] = [_value_to_json(field, item)
+                                  for item in value]
+        else:
+            result[field.name] = _value_to_json(field, value)
+    return result
+
+
+def _value_to_json(field, value):
+    """Return JSON-compatible value of a Protocol Buffer field."""
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        return _message_to_dict(value)
+    elif field.type == FieldDescriptor.TYPE_ENUM:
+        enum_value = field.enum_type.values_by_number.get(value)
+        return value if enum_value is None else enum_value.name
+    elif field.type == FieldDescriptor.TYPE_BYTES:
+        return base64.b64encode(value).decode('ascii')
+    else:
+        return value
+
+
+def encode_event(event, format_):
+    """Return bytes encoding a hangouts_pb2.Event in an export format."""
+    if format_ == FORMAT_PROTOBUF:
+        data = event.SerializeToString()
+        return _encode_varint(len(data)) + data
+    elif format_ == FORMAT_JSON:
+        return (json.dumps(_message_to_dict(event), sort_keys=True) +
+                '\n').encode('utf-8')
+    else:
+        raise ValueError('Unknown export format: {}'.format(format_))
+
+
+def read_events(path):
+    """Yield hangouts_pb2.Events from an exported binary file.
+
+    The file may be compressed with gzip.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            size = 0
+            shift = 0
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    if shift:
+                        raise ValueError('Export file is truncated')
+                    return
+                size |= (byte[0] & 0x7f) << shift
+                shift += 7
+                if not byte[0] & 0x80:
+                    break
+            data = f.read(size)
+            if len(data) != size:
+                raise ValueError('Export file is truncated')
+            event = hangouts_pb2.Event()
+            event.ParseFromString(data)
+            yield event
+
+
+class Exporter(object):
+
+    """Writes events to a file per conversation in a directory.
+
+    format_ is FORMAT_PROTOBUF or FORMAT_JSON. If compress is True, files are
+    compressed with gzip.
+
+    Events are appended to existing files, and each write opens and closes
+    the file, so any number of conversations can be exported without keeping
+    files open. Compressed files then contain a gzip member per write, which
+    gzip readers handle transparently.
+    """
+
+    def __init__(self, directory, format_=FORMAT_PROTOBUF, compress=False):
+        if format_ not in _EXTENSIONS:
+            raise ValueError('Unknown export format: {}'.format(format_))
+        self._directory = directory
+        self._format = format_
+        self._compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, conversation_id):
+        """Return path of the file for a conversation."""
+        filename = conversation_id + _EXTENSIONS[self._format]
+        if self._compress:
+            filename += '.gz'
+        return os.path.join(self._directory, filename)
+
+    def write_events(self, conversation_id, events):
+        """Append a list of hangouts_pb2.Events to a conversation's file.
+
+        This blocks while the file is written. Returns the size of the file
+        in bytes after writing.
+        """
+        data = b''.join(encode_event(event, self._format) for event in events)
+        opener = gzip.open if self._compress else open
+        path = self.get_path(conversation_id)
+        with opener(path, 'ab') as f:
+            f.write(data)
+        return os.path.getsize(path)
+
+    def truncate(self, conversation_id, size):
+        """Truncate a conversation's file to size bytes if it is larger.
+
+        size should be a size returned by write_events, so the file ends
+        after a complete write.
+        """
+        path = self.get_path(conversation_id)
+        try:
+            if os.path.getsize(path) > size:
+                logger.info('Truncating {} to {} bytes'.format(path, size))
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        except FileNotFoundError:
+            pass
+
+    def move_aside(self, conversation_id):
+        """Rename a conversation's file so a new one is written, if it exists.
+
+        The file is renamed by appending the first unused suffix of .1, .2,
+        and so on to its path. Returns the new path, or None if there was no
+        file.
+        """
+        path = self.get_path(conversation_id)
+        if not os.path.exists(path):
+            return None
+        num = 1
+        while os.path.exists('{}.{}'.format(path, num)):
+            num += 1
+        new_path = '{}.{}'.format(path, num)
+        logger.warning('Moving {} without an export checkpoint to {}'
+                       .format(path, new_path))
+        os.rename(path, new_path)
+        return new_path
+
+    @asyncio.coroutine
+    def write(self, conversation_id, events):
+        """Append a list of hangouts_pb2.Events to a conversation's file.
+
+        The file is written in the default executor, so files of different
+        conversations may be written concurrently. Writes to the same
+        conversation should not be concurrent.
+
+        Returns the size of the file in bytes after writing.
+        """
+        loop = asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(None, self.write_events,
+                                                conversation_id, events))
+
+
+@asyncio.coroutine
+def export_conversation_list(conversation_list, exporter,
+                             include_archived=True, batch_size=BATCH_SIZE):
+    """Export the events kept in memory by a ConversationList.
+
+    Conversations are written concurrently, in batches of batch_size events.
+    """
+    @asyncio.coroutine
+    def export_conversation(conv):
+        """Write the events of a conversation in batches."""
+        conv_events = conv.events
+        for i in range(0, len(conv_events), batch_size):
+            yield from exporter.write(conv.id_, [
+                conv_event._event for conv_event
+                in conv_events[i:i + batch_size]
+            ])
+        return len(conv_events)
+
+    convs = conversation_list.get_all(include_archived=include_archived)
+    counts = yield from asyncio.gather(
+        *[export_conversation(conv) for conv in convs]
+    )
+    logger.info('Exported {} events from {} conversations'
+                .format(sum(counts), len(convs)))
+
+
+@asyncio.coroutine
+def export_history(client, conversation_ids, exporter, checkpoint_dir,
+                   **kwargs):
+    """Export the full history of conversations by downloading it.
+
+    Pages of events are written as they are downloaded by a
+    hangups.backfill.Backfill, using checkpoint_dir for its checkpoints, so
+    an interrupted export resumes where it stopped. Other keyword arguments
+    are passed to Backfill. Each file is written in order from the newest
+    event to the oldest.
+
+    Each checkpoint records the size of the file after the last page was
+    written. When resuming, the file is truncated to that size, so pages
+    written after the checkpoint are not duplicated. Existing files of
+    conversations without a checkpoint may not have been written by an
+    export, so they are kept by renaming them with Exporter.move_aside, and
+    a new file is written.
+
+    Returns dict mapping the IDs of conversations which could not be
+    exported to hangups.NetworkErrors.
+    """
+    @asyncio.coroutine
+    def write_page(conversation_id, events):
+        """Write a page of events newest first, and return the file size."""
+        return (yield from exporter.write(conversation_id, events[::-1]))
+
+    backfill_ = backfill.Backfill(client, write_page, checkpoint_dir,
+                                  **kwargs)
+    for conversation_id in conversation_ids:
+        checkpoint = backfill_.load_checkpoint(conversation_id)
+        if checkpoint is None:
+            exporter.move_aside(conversation_id)
+        elif (not checkpoint['done'] and
+              checkpoint['sink_state'] is not None):
+            exporter.truncate(conversation_id, checkpoint['sink_state'])
+    return (yield from backfill_.run(conversation_ids))
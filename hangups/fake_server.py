@@ -0,0 +1,464 @@
+"""Stand-in server for the Hangouts chat API and BrowserChannel.
+
+This server implements enough of the protocols used by hangups.Client to load
+test applications without connecting to Google. State is kept in memory and
+initialized from hangouts_pb2 fixtures, which may be generated using
+FakeServer.populate. Responses may be delayed and made to fail randomly.
+
+To run a server on port 8080 with 100 generated conversations:
+
+    python -m hangups.fake_server --port 8080 --conversations 100
+
+And to connect a Client to it:
+
+    client = hangups.Client(
+        hangups.fake_server.FAKE_COOKIES,
+        api_origin_url='http://localhost:8080',
+        channel_url_prefix='http://localhost:8080/client-channel/{}',
+    )
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+from aiohttp import web
+
+from hangups import hangouts_pb2, pblite
+
+logger = logging.getLogger(__name__)
+# Cookies accepted by the server (any cookies are accepted, but Client requires
+# these to be present):
+FAKE_COOKIES = {name: 'fake' for name
+                in ['SAPISID', 'HSID', 'SSID', 'APISID', 'SID']}
+# Interval in seconds between noop arrays sent on the backward channel:
+NOOP_INTERVAL_SECS = 15
+# Request and response message names for each chat API endpoint:
+ENDPOINTS = {
+    'clients/setactiveclient': 'SetActiveClient',
+    'contacts/getentitybyid': 'GetEntityById',
+    'contacts/getselfinfo': 'GetSelfInfo',
+    'contacts/searchentities': 'SearchEntities',
+    'conversations/adduser': 'AddUser',
+    'conversations/createconversation': 'CreateConversation',
+    'conversations/deleteconversation': 'DeleteConversation',
+    'conversations/easteregg': 'EasterEgg',
+    'conversations/getconversation': 'GetConversation',
+    'conversations/removeuser': 'RemoveUser',
+    'conversations/renameconversation': 'RenameConversation',
+    'conversations/sendchatmessage': 'SendChatMessage',
+    'conversations/setconversationnotificationlevel':
+        'SetConversationNotificationLevel',
+    'conversations/setfocus': 'SetFocus',
+    'conversations/settyping': 'SetTyping',
+    'conversations/syncallnewevents': 'SyncAllNewEvents',
+    'conversations/syncrecentconversations': 'SyncRecentConversations',
+    'conversations/updatewatermark': 'UpdateWatermark',
+    'presence/querypresence': 'QueryPresence',
+    'presence/setpresence': 'SetPresence',
+}
+
+
+def _format_chunk(data):
+    """Return data encoded as a length-prefixed BrowserChannel chunk."""
+    text = json.dumps(data)
+    # The length is the number of UTF-16 code units, like JavaScript's string
+    # length.
+    length = len(text.encode('utf-16-le')) // 2
+    return '{}\n{}'.format(length, text).encode()
+
+
+def _get_newest(events, max_events):
+    """Return the newest max_events of a list of events, oldest first.
+
+    Unlike events[-max_events:], this returns no events if max_events is 0.
+    """
+    return events[max(len(events) - max_events, 0):] if max_events else []
+
+
+def _make_entity(gaia_id, name):
+    """Return a new hangouts_pb2.Entity."""
+    return hangouts_pb2.Entity(
+        id=hangouts_pb2.ParticipantId(gaia_id=gaia_id, chat_id=gaia_id),
+        properties=hangouts_pb2.EntityProperties(
+            display_name=name,
+            first_name=name.split()[0],
+            email=['{}@example.com'.format(gaia_id)],
+        ),
+    )
+
+
+class _Session(object):
+
+    """A BrowserChannel session, identified by its SID."""
+
+    def __init__(self, sid, client_id):
+        self.sid = sid
+        self.client_id = client_id
+        # Queue of arrays to send on the backward channel:
+        self.arrays = asyncio.Queue()
+        # Iterator of IDs for arrays:
+        self.array_ids = itertools.count()
+
+
+class FakeServer(object):
+
+    """In-memory stand-in for the Hangouts servers.
+
+    latency is the minimum delay in seconds before responding to each request,
+    and a random delay of up to latency_jitter seconds is added to it.
+
+    error_rate is the probability of responding to a chat API or forward
+    channel request with an HTTP 500 error.
+    """
+
+    def __init__(self, latency=0, latency_jitter=0, error_rate=0,
+                 noop_interval=NOOP_INTERVAL_SECS):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.noop_interval = noop_interval
+        self.self_entity = _make_entity('1', 'Fake User')
+        self._entities = {}  # {gaia_id: hangouts_pb2.Entity}
+        self._conv_states = {}  # {conv_id: hangouts_pb2.ConversationState}
+        self._sessions = {}  # {sid: _Session}
+        # {(conv_id, client_generated_id): hangouts_pb2.Event}:
+        self._sent_events = {}
+        self._ids = itertools.count(1)
+        self._last_timestamp = 0
+        self.add_entity(self.self_entity)
+
+    ##########################################################################
+    # Public methods
+    ##########################################################################
+
+    def add_entity(self, entity):
+        """Add a hangouts_pb2.Entity for a user."""
+        self._entities[entity.id.gaia_id] = entity
+
+    def add_conversation(self, conv_state):
+        """Add a hangouts_pb2.ConversationState with its events."""
+        self._conv_states[conv_state.conversation_id.id] = conv_state
+
+    def add_event(self, event):
+        """Add a hangouts_pb2.Event and push it to connected clients."""
+        conv_state = self._conv_states[event.conversation_id.id]
+        conv_state.event.extend([event])
+        conv_state.conversation.self_conversation_state.sort_timestamp = (
+            event.timestamp
+        )
+        self.push_state_update(hangouts_pb2.StateUpdate(
+            state_update_header=hangouts_pb2.StateUpdateHeader(
+                current_server_time=event.timestamp,
+            ),
+            event_notification=hangouts_pb2.EventNotification(event=event),
+        ))
+
+    def push_state_update(self, state_update):
+        """Send a hangouts_pb2.StateUpdate to every session."""
+        batch_update = hangouts_pb2.BatchUpdate(state_update=[state_update])
+        array = [{'p': json.dumps({
+            '2': {'2': json.dumps(['cbu'] + pblite.encode(batch_update))}
+        })}]
+        for session in self._sessions.values():
+            session.arrays.put_nowait(array)
+
+    def expire_sessions(self):
+        """Forget all sessions, so clients must request a new SID."""
+        self._sessions.clear()
+
+    def populate(self, num_conversations=10, num_participants=2,
+                 events_per_conversation=100):
+        """Add generated users, conversations and chat messages."""
+        for conv_num in range(num_conversations):
+            participants = [self.self_entity]
+            for _ in range(num_participants - 1):
+                gaia_id = str(next(self._ids) + 1000000)
+                participants.append(
+                    _make_entity(gaia_id, 'User {}'.format(gaia_id))
+                )
+                self.add_entity(participants[-1])
+            conv_id = 'conv{}'.format(conv_num)
+            self.add_conversation(hangouts_pb2.ConversationState(
+                conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+                conversation=hangouts_pb2.Conversation(
+                    conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+                    type=(hangouts_pb2.CONVERSATION_TYPE_GROUP
+                          if num_participants > 2 else
+                          hangouts_pb2.CONVERSATION_TYPE_ONE_TO_ONE),
+                    self_conversation_state=(
+                        hangouts_pb2.UserConversationState(
+                            view=[hangouts_pb2.CONVERSATION_VIEW_INBOX],
+                        )
+                    ),
+                    participant_data=[
+                        hangouts_pb2.ConversationParticipantData(
+                            id=entity.id,
+                            fallback_name=entity.properties.display_name,
+                        ) for entity in participants
+                    ],
+                ),
+            ))
+            for event_num in range(events_per_conversation):
+                self.add_event(self._make_chat_message_event(
+                    conv_id, random.choice(participants).id,
+                    [hangouts_pb2.Segment(
+                        type=hangouts_pb2.SEGMENT_TYPE_TEXT,
+                        text='Message {}'.format(event_num),
+                    )],
+                ))
+
+    def make_app(self, loop=None):
+        """Return aiohttp.web.Application serving the fake endpoints."""
+        app = web.Application(loop=loop)
+        app.router.add_route('POST', '/client-channel/channel/bind',
+                             self._handle_forward_channel)
+        app.router.add_route('GET', '/client-channel/channel/bind',
+                             self._handle_backward_channel)
+        app.router.add_route('POST', '/chat/v1/{service}/{method}',
+                             self._handle_api_request)
+        return app
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=8080, loop=None):
+        """Start serving and return the asyncio.Server."""
+        loop = asyncio.get_event_loop() if loop is None else loop
+        app = self.make_app(loop=loop)
+        server = yield from loop.create_server(app.make_handler(), host, port)
+        logger.info('Fake server listening on {}:{}'.format(host, port))
+        return server
+
+    ##########################################################################
+    # Private methods
+    ##########################################################################
+
+    def _get_timestamp(self):
+        """Return a unique, increasing microsecond timestamp."""
+        self._last_timestamp = max(self._last_timestamp + 1,
+                                   int(time.time() * 1000000))
+        return self._last_timestamp
+
+    def _make_chat_message_event(self, conv_id, sender_id, segments):
+        """Return new hangouts_pb2.Event containing a chat message."""
+        return hangouts_pb2.Event(
+            conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+            sender_id=sender_id,
+            timestamp=self._get_timestamp(),
+            event_id='event{}'.format(next(self._ids)),
+            chat_message=hangouts_pb2.ChatMessage(
+                message_content=hangouts_pb2.MessageContent(segment=segments),
+            ),
+            event_type=hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
+        )
+
+    @asyncio.coroutine
+    def _simulate_latency(self):
+        """Sleep for the configured latency."""
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            yield from asyncio.sleep(delay)
+
+    def _should_fail(self):
+        """Return True if a request should fail with an error."""
+        return random.random() < self.error_rate
+
+    @asyncio.coroutine
+    def _handle_forward_channel(self, request):
+        """Handle a forward channel request, creating a session if needed."""
+        yield from self._simulate_latency()
+        if self._should_fail():
+            return web.Response(status=500, reason='Injected error')
+        sid = request.GET.get('SID')
+        if sid is None:
+            sid = 'SID{}'.format(next(self._ids))
+            session = _Session(sid, 'client{}'.format(next(self._ids)))
+            self._sessions[sid] = session
+            # Tell the client its client_id once it opens the backward
+            # channel.
+            session.arrays.put_nowait([{'p': json.dumps({
+                '3': {'2': session.client_id}
+            })}])
+            logger.info('Created new session {}'.format(sid))
+            return web.Response(body=_format_chunk([
+                [0, ['c', sid, '', 8]],
+                [1, [{'gsid': 'gsessionid'}]],
+            ]))
+        elif sid not in self._sessions:
+            return web.Response(status=400, reason='Unknown SID')
+        else:
+            return web.Response(body=_format_chunk([1, 0, 0]))
+
+    @asyncio.coroutine
+    def _handle_backward_channel(self, request):
+        """Handle a long-polling request, streaming arrays to the client."""
+        session = self._sessions.get(request.GET.get('SID'))
+        if session is None:
+            return web.Response(status=400, reason='Unknown SID')
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        response.start(request)
+        try:
+            while self._sessions.get(session.sid) is session:
+                try:
+                    array = yield from asyncio.wait_for(
+                        session.arrays.get(), self.noop_interval
+                    )
+                except asyncio.TimeoutError:
+                    array = ['noop']
+                response.write(_format_chunk([
+                    [next(session.array_ids), array]
+                ]))
+                yield from response.drain()
+        except ConnectionError:
+            logger.info('Long-polling client disconnected')
+        return response
+
+    @asyncio.coroutine
+    def _handle_api_request(self, request):
+        """Handle a pblite chat API request."""
+        endpoint = '{}/{}'.format(request.match_info['service'],
+                                  request.match_info['method'])
+        try:
+            message_name = ENDPOINTS[endpoint]
+        except KeyError:
+            return web.Response(status=404, reason='Unknown endpoint')
+        request_pb = getattr(hangouts_pb2, message_name + 'Request')()
+        response_pb = getattr(hangouts_pb2, message_name + 'Response')()
+        pblite.decode(request_pb, json.loads((yield from request.text())))
+        yield from self._simulate_latency()
+        if self._should_fail():
+            return web.Response(status=500, reason='Injected error')
+        handler = getattr(self, '_handle_' + request.match_info['method'],
+                          None)
+        if handler is not None:
+            handler(request_pb, response_pb)
+        response_pb.response_header.status = hangouts_pb2.RESPONSE_STATUS_OK
+        response_pb.response_header.current_server_time = (
+            self._get_timestamp()
+        )
+        return web.Response(
+            body=json.dumps([message_name] + pblite.encode(response_pb))
+            .encode(),
+            content_type='application/json+protobuf',
+        )
+
+    def _handle_getselfinfo(self, _, response_pb):
+        """Respond with the self entity."""
+        response_pb.self_entity.CopyFrom(self.self_entity)
+
+    def _handle_getentitybyid(self, request_pb, response_pb):
+        """Respond with the requested entities."""
+        for spec in request_pb.batch_lookup_spec:
+            entity = self._entities.get(spec.gaia_id)
+            if entity is not None:
+                response_pb.entity.add().CopyFrom(entity)
+
+    def _handle_syncrecentconversations(self, request_pb, response_pb):
+        """Respond with the most recently modified conversations."""
+        conv_states = sorted(
+            self._conv_states.values(), reverse=True,
+            key=lambda conv_state: (conv_state.conversation
+                                    .self_conversation_state.sort_timestamp)
+        )[:request_pb.max_conversations or None]
+        max_events = request_pb.max_events_per_conversation
+        for conv_state in conv_states:
+            response_conv_state = response_pb.conversation_state.add(
+                conversation_id=conv_state.conversation_id,
+                conversation=conv_state.conversation,
+            )
+            response_conv_state.event.extend(
+                _get_newest(conv_state.event, max_events)
+            )
+        response_pb.sync_timestamp = self._get_timestamp()
+
+    def _handle_syncallnewevents(self, request_pb, response_pb):
+        """Respond with conversations with events since the timestamp."""
+        for conv_state in self._conv_states.values():
+            events = [event for event in conv_state.event
+                      if event.timestamp > request_pb.last_sync_timestamp]
+            if events:
+                response_pb.conversation_state.add(
+                    conversation_id=conv_state.conversation_id,
+                    conversation=conv_state.conversation,
+                    event=events,
+                )
+        response_pb.sync_timestamp = self._get_timestamp()
+
+    def _handle_getconversation(self, request_pb, response_pb):
+        """Respond with events before the continuation token."""
+        conv_id = request_pb.conversation_spec.conversation_id.id
+        conv_state = self._conv_states.get(conv_id)
+        if conv_state is None:
+            return
+        timestamp = request_pb.event_continuation_token.event_timestamp
+        events = [event for event in conv_state.event
+                  if not timestamp or event.timestamp < timestamp]
+        events = _get_newest(events, request_pb.max_events_per_conversation)
+        response_pb.conversation_state.conversation_id.id = conv_id
+        response_pb.conversation_state.conversation.CopyFrom(
+            conv_state.conversation
+        )
+        response_pb.conversation_state.event.extend(events)
+        if events:
+            token = response_pb.conversation_state.event_continuation_token
+            token.event_id = events[0].event_id
+            token.event_timestamp = events[0].timestamp
+
+    def _handle_sendchatmessage(self, request_pb, response_pb):
+        """Add a chat message event, ignoring duplicate requests."""
+        header = request_pb.event_request_header
+        key = (header.conversation_id.id, header.client_generated_id)
+        event = self._sent_events.get(key)
+        if event is None and header.conversation_id.id in self._conv_states:
+            event = self._make_chat_message_event(
+                header.conversation_id.id, self.self_entity.id,
+                request_pb.message_content.segment,
+            )
+            self._sent_events[key] = event
+            self.add_event(event)
+        if event is not None:
+            response_pb.created_event.CopyFrom(event)
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(prog='hangups.fake_server')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='minimum response delay in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0,
+                        help='maximum random delay added to --latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='probability of responding with an error')
+    parser.add_argument('--conversations', type=int, default=10,
+                        help='number of conversations to generate')
+    parser.add_argument('--participants', type=int, default=2,
+                        help='number of participants per conversation')
+    parser.add_argument('--events', type=int, default=100,
+                        help='number of events per conversation')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='log detailed debugging messages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    server = FakeServer(latency=args.latency,
+                        latency_jitter=args.latency_jitter,
+                        error_rate=args.error_rate)
+    server.populate(args.conversations, args.participants, args.events)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,10 @@
 import aiohttp
 import asyncio
 import collections
+import datetime
+import email.utils
 import logging
+import random
 
 from hangups import exceptions
 
@@ -11,30 +14,119 @@ logger = logging.getLogger(__name__)
 CONNECT_TIMEOUT = 30
 REQUEST_TIMEOUT = 30
 MAX_RETRIES = 3
+# Default total time in seconds allowed for a request, including retries:
+DEFAULT_TIMEOUT = 60
+# Maximum delays in seconds before the first retry, and before any retry:
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 8
+# HTTP status codes indicating a request may succeed if it is retried:
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# HTTP status codes indicating the request's cookies are invalid:
+AUTH_ERROR_STATUSES = {401, 403}
 
 FetchResponse = collections.namedtuple('FetchResponse', ['code', 'body',
-                                                         'cookies'])
+                                                         'cookies', 'headers'])
+
+# Stages of a request reported by RequestTrace:
+TRACE_QUEUED = 'queued'
+TRACE_ATTEMPT_STARTED = 'attempt_started'
+TRACE_FIRST_BYTE = 'first_byte'
+TRACE_BODY_READ = 'body_read'
+TRACE_DECODED = 'decoded'
+
+# A stage of a request. request_id is unique per request, including each
+# hedged request, size is a number of bytes or None, elapsed is the time in
+# seconds since the request was queued, and duration is the time in seconds
+# since the previous stage.
+RequestTrace = collections.namedtuple(
+    'RequestTrace',
+    ['request_id', 'endpoint', 'stage', 'size', 'elapsed', 'duration']
+)
+
+
+def _get_backoff_delay(retry_num):
+    """Return a random delay in seconds to wait before retrying a request.
+
+    The upper bound grows exponentially with retry_num, and the delay is
+    chosen uniformly below it to avoid many clients retrying in lockstep.
+    """
+    return random.uniform(
+        0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** retry_num)
+    )
+
+
+def _parse_retry_after(value):
+    """Return the delay in seconds given by a Retry-After header value.
+
+    Returns None if the value is missing or invalid.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_time.tzinfo is None:
+        retry_time = retry_time.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return max(0, (retry_time - now).total_seconds())
 
 
 @asyncio.coroutine
 def fetch(method, url, params=None, headers=None, cookies=None, data=None,
-          connector=None):
+          connector=None, timeout=DEFAULT_TIMEOUT, retry=True, trace=None,
+          semaphore=None):
     """Make an HTTP request.
 
-    If the request times out or a encounters a connection issue, it will be
-    retried MAX_RETRIES times before finally raising hangups.NetworkError.
+    timeout is the total time in seconds allowed for the request, including
+    any retries.
+
+    If retry is True and the request times out, encounters a connection issue
+    or returns one of RETRY_STATUSES, it will be retried up to MAX_RETRIES
+    times before finally raising hangups.NetworkError. Retries are delayed by
+    a random exponential backoff or the server's Retry-After header, and are
+    not attempted if they would not finish before the timeout. Only pass
+    retry=True for requests which are safe to repeat.
+
+    trace is an optional coroutine function called with arguments (stage,
+    size=None) as each attempt progresses.
+
+    semaphore is an optional asyncio.Semaphore which is held during each
+    attempt, but not while waiting to retry, to limit the number of requests
+    in flight.
+
+    Raises hangups.AuthError if the response status is in
+    AUTH_ERROR_STATUSES.
 
     Returns FetchResponse.
     """
     logger.debug('Sending request %s %s:\n%r', method, url, data)
+    loop = asyncio.get_event_loop()
+    end_time = loop.time() + timeout
+    num_attempts = MAX_RETRIES if retry else 1
     error_msg = None
-    for retry_num in range(MAX_RETRIES):
+    for retry_num in range(num_attempts):
+        retry_after = None
+        if semaphore is not None:
+            yield from semaphore.acquire()
         try:
+            if trace is not None:
+                yield from trace(TRACE_ATTEMPT_STARTED)
             res = yield from asyncio.wait_for(aiohttp.request(
                 method, url, params=params, headers=headers, cookies=cookies,
                 data=data, connector=connector
-            ), CONNECT_TIMEOUT)
-            body = yield from asyncio.wait_for(res.read(), REQUEST_TIMEOUT)
+            ), min(CONNECT_TIMEOUT, end_time - loop.time()))
+            if trace is not None:
+                yield from trace(TRACE_FIRST_BYTE)
+            body = yield from asyncio.wait_for(
+                res.read(), min(REQUEST_TIMEOUT, end_time - loop.time())
+            )
+            if trace is not None:
+                yield from trace(TRACE_BODY_READ, size=len(body))
             logger.debug('Received response %d %s:\n%r', res.status,
                          res.reason, body)
         except asyncio.TimeoutError:
@@ -44,12 +136,36 @@ def fetch(method, url, params=None, headers=None, cookies=None, data=None,
         except aiohttp.ServerDisconnectedError as e:
             error_msg = 'Server disconnected error: {}'.format(e)
         else:
-            error_msg = None
-            break
+            if res.status in RETRY_STATUSES:
+                error_msg = ('Request return unexpected status: {}: {}'
+                             .format(res.status, res.reason))
+                retry_after = _parse_retry_after(
+                    res.headers.get('Retry-After')
+                )
+            else:
+                error_msg = None
+                break
+        finally:
+            if semaphore is not None:
+                semaphore.release()
         logger.info('Request attempt %d failed: %s', retry_num, error_msg)
+        if retry_num + 1 < num_attempts:
+            delay = (retry_after if retry_after is not None
+                     else _get_backoff_delay(retry_num))
+            if loop.time() + delay >= end_time:
+                logger.info('Not retrying request since it would exceed the '
+                            'timeout')
+                break
+            yield from asyncio.sleep(delay)
     if error_msg:
-        logger.info('Request failed after %d attempts', MAX_RETRIES)
+        logger.info('Request failed after %d attempts', retry_num + 1)
         raise exceptions.NetworkError(error_msg)
+    if res.status in AUTH_ERROR_STATUSES:
+        logger.info('Request was not authorized: %d %s', res.status,
+                    res.reason)
+        raise exceptions.AuthError(
+            'Request was not authorized: {}: {}'.format(res.status, res.reason)
+        )
     if res.status > 200 or res.status < 200:
         logger.info('Request returned unexpected status: %d %s', res.status,
                     res.reason)
@@ -58,4 +174,4 @@ def fetch(method, url, params=None, headers=None, cookies=None, data=None,
             .format(res.status, res.reason)
         )
     cookie_dict = {name: morsel.value for name, morsel in res.cookies.items()}
-    return FetchResponse(res.status, body, cookie_dict)
+    return FetchResponse(res.status, body, cookie_dict, res.headers)
@@ -0,0 +1,260 @@
+"""Counters, gauges and histograms for monitoring hangups.
+
+Metrics are kept in a Registry. The metrics recorded by hangups itself are
+kept in the default REGISTRY, which may be exported in the Prometheus text
+format using Registry.get_text, or served over HTTP using serve:
+
+    server = yield from hangups.metrics.serve(9100)
+
+Prometheus text format documentation is available here:
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+# Default histogram buckets, suitable for durations in seconds:
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape_label_value(value):
+    """Escape a label value for the Prometheus text format."""
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_value(value):
+    """Format a sample value for the Prometheus text format."""
+    if value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    else:
+        return str(value)
+
+
+def _format_sample(name, label_names, label_values, value):
+    """Return a line of the Prometheus text format for one sample."""
+    if label_names:
+        labels = ','.join('{}="{}"'.format(name_, _escape_label_value(value_))
+                          for name_, value_ in zip(label_names, label_values))
+        name = '{}{{{}}}'.format(name, labels)
+    return '{} {}'.format(name, _format_value(value))
+
+
+class _Metric(object):
+
+    """Base class for metrics.
+
+    Each metric has a value for every combination of label values it has been
+    updated with. Label values are passed as keyword arguments.
+    """
+
+    type_ = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}  # {label_values: value}
+
+    def _get_key(self, labels):
+        """Return tuple of label values in the order of label_names.
+
+        Raises ValueError if the labels don't match the label names.
+        """
+        if set(labels) != set(self.label_names):
+            raise ValueError('{} expected labels {}, got {}'.format(
+                self.name, self.label_names, tuple(labels)
+            ))
+        return tuple(labels[name] for name in self.label_names)
+
+    def get_samples(self):
+        """Yield (name, label_names, label_values, value) tuples."""
+        for key, value in sorted(self._values.items()):
+            yield (self.name, self.label_names, key, value)
+
+    def get_text(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation
+                                  .replace('\\', r'\\').replace('\n', r'\n')),
+            '# TYPE {} {}'.format(self.name, self.type_),
+        ]
+        lines.extend(_format_sample(*sample) for sample in self.get_samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+
+    """A value that only increases, such as a number of events."""
+
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter by amount."""
+        if amount < 0:
+            raise ValueError('Counters can only be increased')
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current value of the counter."""
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Gauge(_Metric):
+
+    """A value that may increase or decrease, such as a size."""
+
+    type_ = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge to value."""
+        self._values[self._get_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """Increase the gauge by amount."""
+        key = self._get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrease the gauge by amount."""
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        """Return the current value of the gauge."""
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Histogram(_Metric):
+
+    """Counts of observed values in buckets, such as request durations."""
+
+    type_ = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        if 'le' in self.label_names:
+            raise ValueError('Histograms may not have a label named "le"')
+
+    def observe(self, value, **labels):
+        """Record an observed value."""
+        key = self._get_key(labels)
+        try:
+            bucket_counts, total = self._values[key]
+        except KeyError:
+            bucket_counts, total = [0] * (len(self.buckets) + 1), 0
+        # Store the count for each bucket separately, and make them
+        # cumulative when exporting.
+        bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (bucket_counts, total + value)
+
+    def get_count(self, **labels):
+        """Return the number of observed values."""
+        try:
+            bucket_counts, _ = self._values[self._get_key(labels)]
+        except KeyError:
+            return 0
+        return sum(bucket_counts)
+
+    def get_samples(self):
+        """Yield (name, label_names, label_values, value) tuples."""
+        bucket_label_names = self.label_names + ('le',)
+        for key, (bucket_counts, total) in sorted(self._values.items()):
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                           bucket_counts):
+                count += bucket_count
+                yield (self.name + '_bucket', bucket_label_names,
+                       key + (_format_value(float(bound)),), count)
+            yield (self.name + '_sum', self.label_names, key, total)
+            yield (self.name + '_count', self.label_names, key, count)
+
+
+class Registry(object):
+
+    """Collection of metrics which can be exported together."""
+
+    def __init__(self):
+        self._metrics = {}  # {name: _Metric}
+
+    def register(self, metric):
+        """Add a metric and return it.
+
+        Raises ValueError if a metric with the same name was already added.
+        """
+        if metric.name in self._metrics:
+            raise ValueError('Metric {} is already registered'
+                             .format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        """Add and return a new Counter."""
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        """Add and return a new Gauge."""
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Add and return a new Histogram."""
+        return self.register(Histogram(name, documentation, label_names,
+                                       buckets))
+
+    def get(self, name):
+        """Return a metric by its name.
+
+        Raises KeyError if there is no such metric.
+        """
+        return self._metrics[name]
+
+    def get_text(self):
+        """Return all metrics in the Prometheus text format."""
+        return ''.join(metric.get_text() for _, metric
+                       in sorted(self._metrics.items()))
+
+
+REGISTRY = Registry()
+
+
+@asyncio.coroutine
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve metrics in the Prometheus text format over HTTP.
+
+    Every request is answered with the current metrics of registry, regardless
+    of its path. By default, only local connections are accepted.
+
+    Returns an asyncio.Server, which may be closed to stop serving.
+    """
+    @asyncio.coroutine
+    def handle_connection(reader, writer):
+        """Read an HTTP request and respond with the metrics."""
+        try:
+            # Read the request line and headers, and ignore them.
+            while True:
+                line = yield from reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            body = registry.get_text().encode()
+            writer.write(
+                'HTTP/1.0 200 OK\r\nContent-Type: {}\r\n'
+                'Content-Length: {}\r\n\r\n'
+                .format(CONTENT_TYPE, len(body)).encode() + body
+            )
+            yield from writer.drain()
+        except ConnectionError as e:
+            logger.info('Failed to serve metrics: {}'.format(e))
+        finally:
+            writer.close()
+    server = yield from asyncio.start_server(handle_connection, host, port)
+    logger.info('Serving metrics on {}:{}'.format(host, port))
+    return server
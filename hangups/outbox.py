@@ -0,0 +1,202 @@
+"""Durable storage for outgoing chat messages.
+
+Messages are written to the outbox before they are sent, and removed once the
+server has accepted them. Messages which could not be sent remain in the
+outbox, and are sent again by ConversationList when the client reconnects,
+with the same client_generated_id so the server can ignore duplicates.
+
+Coroutines should use add_message and load_messages, which use the database
+in a separate thread so they don't block the event loop, and mark_sent. Sent
+messages are removed along with the next write to the database, or after
+REMOVE_DELAY_SECS, so sending a message usually takes a single write.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import sqlite3
+import threading
+
+from hangups import hangouts_pb2
+
+logger = logging.getLogger(__name__)
+# Time in seconds after a message is marked as sent before it is removed from
+# the database, unless another write removes it first:
+REMOVE_DELAY_SECS = 1
+
+# A message in the outbox. id_ orders messages in the order they were added,
+# segments is a list of hangouts_pb2.Segment and delivery_medium is a
+# hangouts_pb2.DeliveryMedium.
+OutboxMessage = collections.namedtuple('OutboxMessage', [
+    'id_', 'conversation_id', 'client_generated_id', 'segments', 'image_id',
+    'otr_status', 'delivery_medium',
+])
+
+
+class Outbox(object):
+
+    """Queue of outgoing chat messages stored in an SQLite database.
+
+    path is the path of the database file, which is created if it doesn't
+    exist. Use ':memory:' for an outbox which is not persisted.
+    """
+
+    def __init__(self, path):
+        # The database is used by the executor's thread as well as the
+        # caller's, so access is serialized by a lock.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # IDs of messages marked as sent which are still in the database,
+        # which are not returned by get_messages:
+        self._sent_ids = set()
+        # asyncio.Handle of the delayed removal of sent messages, or None:
+        self._remove_handle = None
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'conversation_id TEXT NOT NULL, '
+                'client_generated_id INTEGER NOT NULL, '
+                'message_content BLOB NOT NULL, '
+                'image_id TEXT, '
+                'otr_status INTEGER NOT NULL, '
+                'delivery_medium BLOB NOT NULL)'
+            )
+
+    def add(self, conversation_id, client_generated_id, segments, image_id,
+            otr_status, delivery_medium):
+        """Add a message to the outbox and return its ID.
+
+        Messages marked as sent are removed in the same transaction.
+        """
+        message_content = hangouts_pb2.MessageContent(segment=segments)
+        with self._lock, self._db:
+            self._remove_sent()
+            cursor = self._db.execute(
+                'INSERT INTO messages (conversation_id, client_generated_id, '
+                'message_content, image_id, otr_status, delivery_medium) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (conversation_id, client_generated_id,
+                 message_content.SerializeToString(), image_id, otr_status,
+                 delivery_medium.SerializeToString())
+            )
+        return cursor.lastrowid
+
+    def remove(self, id_):
+        """Remove a message from the outbox by its ID."""
+        with self._lock, self._db:
+            self._sent_ids.add(id_)
+            self._remove_sent()
+
+    def mark_sent(self, id_):
+        """Mark a message as sent, so it is removed from the outbox.
+
+        The message is no longer returned by get_messages, but is only
+        removed from the database by the next write, or after
+        REMOVE_DELAY_SECS, so the removals of messages sent close together
+        are batched.
+        """
+        with self._lock:
+            self._sent_ids.add(id_)
+        if self._remove_handle is None:
+            self._remove_handle = asyncio.get_event_loop().call_later(
+                REMOVE_DELAY_SECS, self._on_remove_delay
+            )
+
+    def _on_remove_delay(self):
+        """Start removing the messages marked as sent."""
+        self._remove_handle = None
+        asyncio.async(self._remove_sent_messages())
+
+    @asyncio.coroutine
+    def _remove_sent_messages(self):
+        """Remove the messages marked as sent in a thread."""
+        try:
+            yield from self._run_in_executor(self._remove_sent_locked)
+        except sqlite3.Error as e:
+            logger.warning('Failed to remove sent messages from outbox: {}'
+                           .format(e))
+
+    def _remove_sent_locked(self):
+        """Remove the messages marked as sent in a transaction."""
+        with self._lock, self._db:
+            self._remove_sent()
+
+    def _remove_sent(self):
+        """Remove the messages marked as sent.
+
+        The lock must be held, inside a transaction.
+        """
+        if self._sent_ids:
+            self._db.executemany('DELETE FROM messages WHERE id = ?',
+                                 [(id_,) for id_ in self._sent_ids])
+            self._sent_ids.clear()
+
+    def get_messages(self, conversation_id=None):
+        """Return list of OutboxMessages in the order they were added.
+
+        If conversation_id is given, only return messages for that
+        conversation.
+        """
+        query = ('SELECT id, conversation_id, client_generated_id, '
+                 'message_content, image_id, otr_status, delivery_medium '
+                 'FROM messages')
+        params = ()
+        if conversation_id is not None:
+            query += ' WHERE conversation_id = ?'
+            params = (conversation_id,)
+        with self._lock:
+            rows = self._db.execute(query + ' ORDER BY id', params).fetchall()
+            rows = [row for row in rows if row[0] not in self._sent_ids]
+        messages = []
+        for row in rows:
+            message_content = hangouts_pb2.MessageContent()
+            message_content.ParseFromString(row[3])
+            delivery_medium = hangouts_pb2.DeliveryMedium()
+            delivery_medium.ParseFromString(row[6])
+            messages.append(OutboxMessage(
+                row[0], row[1], row[2], list(message_content.segment), row[4],
+                row[5], delivery_medium
+            ))
+        return messages
+
+    @asyncio.coroutine
+    def add_message(self, *args):
+        """Add a message to the outbox in a thread and return its ID.
+
+        Takes the same arguments as add.
+        """
+        return (yield from self._run_in_executor(self.add, *args))
+
+    @asyncio.coroutine
+    def load_messages(self, conversation_id=None):
+        """Return list of OutboxMessages like get_messages, in a thread."""
+        return (yield from self._run_in_executor(self.get_messages,
+                                                 conversation_id))
+
+    @asyncio.coroutine
+    def _run_in_executor(self, func, *args):
+        """Return the result of calling func in the outbox's thread."""
+        loop = asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(self._executor, func, *args))
+
+    def __len__(self):
+        with self._lock, self._db:
+            self._remove_sent()
+            return self._db.execute(
+                'SELECT COUNT(*) FROM messages'
+            ).fetchone()[0]
+
+    def close(self):
+        """Wait for pending operations and close the database.
+
+        Messages marked as sent are removed first.
+        """
+        if self._remove_handle is not None:
+            self._remove_handle.cancel()
+            self._remove_handle = None
+        self._executor.shutdown()
+        self._remove_sent_locked()
+        self._db.close()
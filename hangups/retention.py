@@ -0,0 +1,145 @@
+"""Limits on the conversation events kept in memory.
+
+Long-running clients receive events indefinitely, so keeping every event in
+memory makes memory usage grow without bound. An EventBudget shared by the
+conversations of a ConversationList limits the number or size of the events
+they keep, by evicting the oldest events of the least recently used
+conversations. Evicted events are loaded again by Conversation.get_events when
+they are needed, from the event store if the conversations have one, or
+otherwise by requesting them.
+"""
+
+import collections
+import logging
+
+from hangups import metrics
+
+logger = logging.getLogger(__name__)
+retained_events_gauge = metrics.REGISTRY.gauge(
+    'hangups_retained_events',
+    'Number of conversation events kept in memory.'
+)
+retained_bytes_gauge = metrics.REGISTRY.gauge(
+    'hangups_retained_event_bytes',
+    'Serialized size in bytes of the conversation events kept in memory.'
+)
+evicted_events_counter = metrics.REGISTRY.counter(
+    'hangups_evicted_events_total',
+    'Number of conversation events evicted from memory.'
+)
+# Default number of the newest events which are never evicted from each
+# conversation:
+MIN_EVENTS_PER_CONVERSATION = 20
+
+
+def _get_size(conv_events):
+    """Return serialized size in bytes of a list of ConversationEvents."""
+    return sum(conv_event._get_byte_size() for conv_event in conv_events)
+
+
+class EventBudget(object):
+
+    """Limit on the events kept in memory across conversations.
+
+    max_events is the maximum number of events, and max_bytes the maximum
+    serialized size of the events in bytes. Either may be None for no limit.
+    The budget may be exceeded if every conversation only has its newest
+    min_events_per_conversation events left, or if the events were added to
+    the conversation currently in use.
+    """
+
+    def __init__(self, max_events=None, max_bytes=None,
+                 min_events_per_conversation=MIN_EVENTS_PER_CONVERSATION):
+        self._max_events = max_events
+        self._max_bytes = max_bytes
+        self._min_events_per_conversation = min_events_per_conversation
+        self._num_events = 0
+        self._num_bytes = 0
+        # {conv_id: Conversation} of every Conversation with events:
+        self._conversations = {}
+        # {conv_id: Conversation}, least recently used first, of the
+        # Conversations which may have events to evict:
+        self._evictable = collections.OrderedDict()
+
+    @property
+    def num_events(self):
+        """The number of events kept in memory."""
+        return self._num_events
+
+    @property
+    def num_bytes(self):
+        """The serialized size in bytes of the events kept in memory."""
+        return self._num_bytes
+
+    def touch(self, conv):
+        """Mark a Conversation as the most recently used."""
+        if conv.id_ in self._evictable:
+            self._evictable.move_to_end(conv.id_)
+
+    def add(self, conv, conv_events):
+        """Account for ConversationEvents added to a Conversation.
+
+        If the budget is exceeded, events are evicted from other
+        conversations.
+        """
+        self._conversations[conv.id_] = conv
+        self._evictable[conv.id_] = conv
+        self.touch(conv)
+        self._num_events += len(conv_events)
+        self._num_bytes += _get_size(conv_events)
+        self._evict(conv)
+        self._update_metrics()
+
+    def remove(self, conv):
+        """Stop accounting for the events of a removed Conversation."""
+        self._evictable.pop(conv.id_, None)
+        if self._conversations.pop(conv.id_, None) is not None:
+            self._num_events -= len(conv.events)
+            self._num_bytes -= _get_size(conv.events)
+            self._update_metrics()
+
+    def _get_excess(self):
+        """Return (events, bytes) tuple of the amount over budget.
+
+        Each item is None if there is no limit or it is not exceeded.
+        """
+        excess_events = excess_bytes = None
+        if (self._max_events is not None and
+                self._num_events > self._max_events):
+            excess_events = self._num_events - self._max_events
+        if self._max_bytes is not None and self._num_bytes > self._max_bytes:
+            excess_bytes = self._num_bytes - self._max_bytes
+        return (excess_events, excess_bytes)
+
+    def _evict(self, current_conv):
+        """Evict events until within budget, except from current_conv.
+
+        Conversations left with no events to evict are forgotten until events
+        are added to them, so each is only visited once while over budget.
+        """
+        excess_events, excess_bytes = self._get_excess()
+        exhausted = []
+        for conv in self._evictable.values():
+            if excess_events is None and excess_bytes is None:
+                break
+            if conv is current_conv:
+                continue
+            evicted = conv.evict_events(excess_events, excess_bytes,
+                                        self._min_events_per_conversation)
+            if evicted:
+                logger.debug('Evicted {} events from conversation {}'
+                             .format(len(evicted), conv.id_))
+                self._num_events -= len(evicted)
+                self._num_bytes -= _get_size(evicted)
+                evicted_events_counter.inc(len(evicted))
+                excess_events, excess_bytes = self._get_excess()
+            if excess_events is not None or excess_bytes is not None:
+                # Eviction stopped before the budget was met, so only the
+                # newest events are left.
+                exhausted.append(conv.id_)
+        for conv_id in exhausted:
+            del self._evictable[conv_id]
+
+    def _update_metrics(self):
+        retained_events_gauge.set(self._num_events)
+        retained_bytes_gauge.set(self._num_bytes)
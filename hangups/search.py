@@ -0,0 +1,258 @@
+"""Full-text search over chat messages.
+
+SearchIndex is an inverted index mapping each term to the chat messages
+containing it, and the positions of the term in each message. Conversations
+add messages to the index as they arrive or are loaded, so the index only
+covers messages which have been seen by the client.
+
+If the index is given a path, messages are also stored in an SQLite database
+at that path, and indexed again by the load coroutine. The database is used
+in a separate thread so it doesn't block the event loop.
+"""
+
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import logging
+import re
+import sqlite3
+import threading
+
+from hangups import conversation_event, parsers, user
+
+logger = logging.getLogger(__name__)
+_TERM_RE = re.compile(r'\w+')
+_QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+# Number of stored messages indexed at a time by load, between which other
+# tasks may run:
+LOAD_BATCH_SIZE = 1000
+
+# A chat message matching a search. timestamp is a datetime.
+SearchResult = collections.namedtuple(
+    'SearchResult', ['conversation_id', 'event_id', 'user_id', 'timestamp']
+)
+
+
+def tokenize(text):
+    """Return list of the lower case terms in text."""
+    return _TERM_RE.findall(text.lower())
+
+
+def _intersect(doc_sets):
+    """Return set of document IDs in all of doc_sets.
+
+    Each of doc_sets is a set or dict of document IDs. Only the smallest one
+    is iterated over.
+    """
+    doc_sets = sorted(doc_sets, key=len)
+    return {doc_id for doc_id in doc_sets[0]
+            if all(doc_id in doc_set for doc_set in doc_sets[1:])}
+
+
+class SearchIndex(object):
+
+    """Index of chat messages supporting term, prefix and phrase queries.
+
+    path is the path of an SQLite database to store messages in, or None to
+    only keep the index in memory.
+    """
+
+    def __init__(self, path=None):
+        self._results = []  # [SearchResult] by document ID
+        self._timestamps = []  # [int] by document ID
+        self._doc_ids = {}  # {(conversation_id, event_id): document ID}
+        self._conversation_docs = collections.defaultdict(set)
+        # {term: {document ID: [position]}}:
+        self._postings = {}
+        self._terms = []  # Sorted list of terms for prefix queries
+        self._db = None
+        if path is not None:
+            # The database is used by the executor's thread as well as the
+            # caller's, so access is serialized by a lock.
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._lock = threading.Lock()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1
+            )
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            with self._lock, self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS messages ('
+                    'conversation_id TEXT NOT NULL, '
+                    'event_id TEXT NOT NULL, '
+                    'chat_id TEXT NOT NULL, '
+                    'gaia_id TEXT NOT NULL, '
+                    'timestamp INTEGER NOT NULL, '
+                    'text TEXT NOT NULL, '
+                    'PRIMARY KEY (conversation_id, event_id))'
+                )
+
+    def __len__(self):
+        return len(self._results)
+
+    @asyncio.coroutine
+    def load(self):
+        """Index the messages stored in the database, if there is one.
+
+        The messages are read in a thread, and indexed in batches so other
+        tasks may run in between. Messages may be added and searched for
+        while this runs.
+        """
+        if self._db is None:
+            return
+        loop = asyncio.get_event_loop()
+        rows = yield from loop.run_in_executor(self._executor,
+                                               self._get_rows)
+        for i in range(0, len(rows), LOAD_BATCH_SIZE):
+            for row in rows[i:i + LOAD_BATCH_SIZE]:
+                if (row[0], row[1]) not in self._doc_ids:
+                    self._index(*row)
+            yield from asyncio.sleep(0)
+        logger.info('Loaded {} messages into search index'
+                    .format(len(rows)))
+
+    def _get_rows(self):
+        """Return list of the stored messages."""
+        with self._lock:
+            return self._db.execute('SELECT * FROM messages').fetchall()
+
+    def _insert_rows(self, rows):
+        """Store messages in the database."""
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def add_events(self, conv_events):
+        """Add the ChatMessageEvents in a list of ConversationEvents.
+
+        Other events and events which are already indexed are ignored. If
+        there is a database, the messages are stored in it in a thread.
+        """
+        rows = []
+        for conv_event in conv_events:
+            if not isinstance(conv_event, conversation_event.ChatMessageEvent):
+                continue
+            key = (conv_event.conversation_id, conv_event.id_)
+            if key in self._doc_ids:
+                continue
+            user_id = conv_event.user_id
+            row = key + (user_id.chat_id, user_id.gaia_id,
+                         parsers.to_timestamp(conv_event.timestamp),
+                         conv_event.text)
+            self._index(*row)
+            rows.append(row)
+        if self._db is not None and rows:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, self._insert_rows,
+                                          rows)
+            future.add_done_callback(self._on_rows_inserted)
+
+    @staticmethod
+    def _on_rows_inserted(future):
+        """Log a failure to store messages."""
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning('Failed to store messages in search index: {}'
+                           .format(future.exception()))
+
+    def _index(self, conversation_id, event_id, chat_id, gaia_id, timestamp,
+               text):
+        """Add a message to the index."""
+        doc_id = len(self._results)
+        self._results.append(SearchResult(
+            conversation_id, event_id,
+            user.UserID(chat_id=chat_id, gaia_id=gaia_id),
+            parsers.from_timestamp(timestamp)
+        ))
+        self._timestamps.append(timestamp)
+        self._doc_ids[(conversation_id, event_id)] = doc_id
+        self._conversation_docs[conversation_id].add(doc_id)
+        for position, term in enumerate(tokenize(text)):
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                bisect.insort(self._terms, term)
+            postings.setdefault(doc_id, []).append(position)
+
+    def _match_phrase(self, terms):
+        """Return set or dict of document IDs containing consecutive terms."""
+        postings = [self._postings.get(term, {}) for term in terms]
+        if len(postings) == 1:
+            return postings[0]
+        doc_ids = set()
+        for doc_id in _intersect(postings):
+            # Positions where the phrase could start.
+            starts = set(postings[0][doc_id])
+            for offset, term_postings in enumerate(postings[1:], 1):
+                starts.intersection_update(position - offset for position
+                                           in term_postings[doc_id])
+            if starts:
+                doc_ids.add(doc_id)
+        return doc_ids
+
+    def _match_prefix(self, prefix):
+        """Return set of document IDs with a term starting with prefix."""
+        doc_ids = set()
+        i = bisect.bisect_left(self._terms, prefix)
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            doc_ids.update(self._postings[self._terms[i]])
+            i += 1
+        return doc_ids
+
+    def search(self, query, conversation_id=None, user_id=None, start=None,
+               end=None, limit=None):
+        """Return list of SearchResults matching query, newest first.
+
+        query is a list of terms separated by spaces, which must all be in
+        matching messages. A term ending with * matches any term starting with
+        it, and terms in double quotes match only if they are consecutive.
+        Terms are case-insensitive.
+
+        Results may be restricted to a conversation_id, a sender's user_id,
+        and to messages sent at or after the datetime start and before the
+        datetime end. At most limit results are returned, if not None.
+        """
+        doc_sets = []
+        for phrase, word in _QUERY_RE.findall(query):
+            if word.endswith('*'):
+                terms = tokenize(word[:-1])
+                if terms:
+                    doc_sets.append(self._match_prefix(terms.pop()))
+            else:
+                terms = tokenize(phrase or word)
+            if terms:
+                doc_sets.append(self._match_phrase(terms))
+        if not doc_sets:
+            return []
+        if conversation_id is not None:
+            doc_sets.append(self._conversation_docs.get(conversation_id, ()))
+        doc_ids = _intersect(doc_sets)
+
+        if user_id is not None:
+            doc_ids = [doc_id for doc_id in doc_ids
+                       if self._results[doc_id].user_id == user_id]
+        if start is not None:
+            start_timestamp = parsers.to_timestamp(start)
+            doc_ids = [doc_id for doc_id in doc_ids
+                       if self._timestamps[doc_id] >= start_timestamp]
+        if end is not None:
+            end_timestamp = parsers.to_timestamp(end)
+            doc_ids = [doc_id for doc_id in doc_ids
+                       if self._timestamps[doc_id] < end_timestamp]
+        if limit is None:
+            doc_ids = sorted(doc_ids, key=self._timestamps.__getitem__,
+                             reverse=True)
+        else:
+            doc_ids = heapq.nlargest(limit, doc_ids,
+                                     key=self._timestamps.__getitem__)
+        return [self._results[doc_id] for doc_id in doc_ids]
+
+    def close(self):
+        """Wait for pending writes and close the database, if there is one."""
+        if self._db is not None:
+            self._executor.shutdown()
+            self._db.close()
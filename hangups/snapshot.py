@@ -0,0 +1,196 @@
+"""Snapshots of UserList and ConversationList for faster startup.
+
+A snapshot contains the self entity, the entities of other users, the state
+of each conversation with its most recent events, and the timestamp the
+ConversationList was last synced at. build_user_conversation_list can restore
+the lists from a snapshot, and then only needs to sync events since that
+timestamp.
+
+The file starts with a header containing MAGIC, the format version and the
+sync timestamp, followed by records. Each record is a one byte record type and
+a four byte length, followed by a serialized hangouts_pb2.Entity or
+hangouts_pb2.ConversationState.
+"""
+
+import asyncio
+import collections
+import io
+import logging
+import os
+import struct
+import time
+
+from google.protobuf.message import DecodeError
+
+from hangups import hangouts_pb2, parsers
+
+logger = logging.getLogger(__name__)
+MAGIC = b'HGSS'
+# Version of the snapshot format, which is incremented when it changes:
+VERSION = 1
+# Maximum number of events saved for each conversation:
+MAX_EVENTS_PER_CONVERSATION = 50
+# Snapshots older than this many seconds are not restored, since syncing
+# events from so long ago may be slower than starting from scratch:
+MAX_AGE_SECS = 2 * 24 * 60 * 60
+# Default interval in seconds between snapshots for save_periodically:
+SAVE_INTERVAL_SECS = 5 * 60
+
+_HEADER = struct.Struct('>4sIQ')  # magic, version, sync timestamp
+_RECORD_HEADER = struct.Struct('>BI')  # record type, length
+_RECORD_SELF_ENTITY = 1
+_RECORD_ENTITY = 2
+_RECORD_CONVERSATION_STATE = 3
+
+# Contents of a snapshot. sync_timestamp is a datetime.
+Snapshot = collections.namedtuple(
+    'Snapshot', ['self_entity', 'entities', 'conv_states', 'sync_timestamp']
+)
+
+
+class SnapshotError(Exception):
+
+    """Exception raised when a snapshot is invalid."""
+
+
+def _user_to_entity(user_):
+    """Return hangouts_pb2.Entity with the details of a User."""
+    return hangouts_pb2.Entity(
+        id=hangouts_pb2.ParticipantId(chat_id=user_.id_.chat_id,
+                                      gaia_id=user_.id_.gaia_id),
+        properties=hangouts_pb2.EntityProperties(
+            display_name=user_.full_name,
+            first_name=user_.first_name or '',
+            photo_url=user_.photo_url or '',
+            email=user_.emails,
+        ),
+    )
+
+
+def _write_record(f, record_type, message):
+    """Write a record containing a Protocol Buffer message."""
+    data = message.SerializeToString()
+    f.write(_RECORD_HEADER.pack(record_type, len(data)))
+    f.write(data)
+
+
+def _read_exactly(f, size):
+    """Read size bytes from file, raising SnapshotError if truncated."""
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError('Snapshot is truncated')
+    return data
+
+
+def _serialize(user_list, conversation_list, max_events):
+    """Return bytes of a snapshot of user_list and conversation_list."""
+    self_user = user_list.get_self_user()
+    sync_timestamp = parsers.to_timestamp(conversation_list.sync_timestamp)
+    f = io.BytesIO()
+    f.write(_HEADER.pack(MAGIC, VERSION, sync_timestamp))
+    _write_record(f, _RECORD_SELF_ENTITY, _user_to_entity(self_user))
+    for user_ in user_list.get_all():
+        # Fallback Users are left out, so their entities are requested when
+        # the snapshot is restored.
+        if not user_.is_self and not user_.is_fallback:
+            _write_record(f, _RECORD_ENTITY, _user_to_entity(user_))
+    for conv in conversation_list.get_all(include_archived=True):
+        _write_record(f, _RECORD_CONVERSATION_STATE,
+                      conv.get_conversation_state(max_events))
+    return f.getvalue()
+
+
+def _write(path, data):
+    """Write a snapshot's bytes to path.
+
+    The snapshot is written to a temporary file which then replaces path, so
+    an existing snapshot is never left partially written.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    logger.info('Saved snapshot to {}'.format(path))
+
+
+def save(path, user_list, conversation_list,
+         max_events=MAX_EVENTS_PER_CONVERSATION):
+    """Save a snapshot of user_list and conversation_list to path.
+
+    This blocks while the file is written, so coroutines should use
+    save_async instead.
+    """
+    _write(path, _serialize(user_list, conversation_list, max_events))
+
+
+@asyncio.coroutine
+def save_async(path, user_list, conversation_list,
+               max_events=MAX_EVENTS_PER_CONVERSATION):
+    """Save a snapshot of user_list and conversation_list to path.
+
+    Coroutine version of save. The lists are serialized on the event loop,
+    so they don't change while they are read, and the file is written in
+    the default executor.
+    """
+    data = _serialize(user_list, conversation_list, max_events)
+    loop = asyncio.get_event_loop()
+    yield from loop.run_in_executor(None, _write, path, data)
+
+
+def load(path):
+    """Return Snapshot loaded from path.
+
+    Raises SnapshotError if the snapshot is missing, invalid or too old.
+    """
+    try:
+        with open(path, 'rb') as f:
+            magic, version, sync_timestamp = _HEADER.unpack(
+                _read_exactly(f, _HEADER.size)
+            )
+            if magic != MAGIC or version != VERSION:
+                raise SnapshotError('Snapshot has unsupported format')
+            if sync_timestamp / 1000000 < time.time() - MAX_AGE_SECS:
+                raise SnapshotError('Snapshot is too old')
+            self_entity = None
+            entities = []
+            conv_states = []
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if not header:
+                    break
+                elif len(header) != _RECORD_HEADER.size:
+                    raise SnapshotError('Snapshot is truncated')
+                record_type, length = _RECORD_HEADER.unpack(header)
+                data = _read_exactly(f, length)
+                if record_type == _RECORD_SELF_ENTITY:
+                    self_entity = hangouts_pb2.Entity()
+                    self_entity.ParseFromString(data)
+                elif record_type == _RECORD_ENTITY:
+                    entities.append(hangouts_pb2.Entity())
+                    entities[-1].ParseFromString(data)
+                elif record_type == _RECORD_CONVERSATION_STATE:
+                    conv_states.append(hangouts_pb2.ConversationState())
+                    conv_states[-1].ParseFromString(data)
+                else:
+                    raise SnapshotError('Snapshot has unknown record type {}'
+                                        .format(record_type))
+    except IOError as e:
+        raise SnapshotError('Failed to read snapshot: {}'.format(e))
+    except DecodeError as e:
+        raise SnapshotError('Snapshot has invalid record: {}'.format(e))
+    if self_entity is None:
+        raise SnapshotError('Snapshot is missing self entity')
+    return Snapshot(self_entity, entities, conv_states,
+                    parsers.from_timestamp(sync_timestamp))
+
+
+@asyncio.coroutine
+def save_periodically(path, user_list, conversation_list,
+                      interval=SAVE_INTERVAL_SECS):
+    """Save a snapshot every interval seconds until cancelled."""
+    while True:
+        yield from asyncio.sleep(interval)
+        try:
+            yield from save_async(path, user_list, conversation_list)
+        except IOError as e:
+            logger.warning('Failed to save snapshot: {}'.format(e))
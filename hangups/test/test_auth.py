@@ -0,0 +1,87 @@
+"""Tests for caching session cookies."""
+
+import asyncio
+import http.cookies
+import time
+
+import pytest
+
+from hangups import auth
+from hangups.test.utils import coroutine_test
+
+
+def test_save_and_load_cookies(tmpdir):
+    path = str(tmpdir.join('cookies'))
+    expires = time.time() + 3600
+    auth._save_cookies(path, {'SID': 'foo'}, expires)
+    assert auth._load_cookies(path) == ({'SID': 'foo'}, expires)
+
+
+def test_load_cookies_without_expiry(tmpdir, monkeypatch):
+    path = str(tmpdir.join('cookies'))
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    auth._save_cookies(path, {'SID': 'foo'}, None)
+    assert auth._load_cookies(path) == (
+        {'SID': 'foo'}, 1000 + auth.COOKIES_MAX_AGE_SECS
+    )
+    # The cookies expire after the maximum age.
+    monkeypatch.setattr(time, 'time', lambda: 1000 +
+                        auth.COOKIES_MAX_AGE_SECS)
+    assert auth._load_cookies(path) is None
+
+
+def test_load_expiring_cookies(tmpdir):
+    path = str(tmpdir.join('cookies'))
+    auth._save_cookies(path, {'SID': 'foo'}, time.time() + 60)
+    assert auth._load_cookies(path) is None
+
+
+def test_load_missing_cookies(tmpdir):
+    assert auth._load_cookies(str(tmpdir.join('cookies'))) is None
+
+
+def test_get_morsel_expiry():
+    cookie = http.cookies.SimpleCookie()
+    cookie.load('A=1; Expires=Wed, 21-Oct-2037 07:28:00 GMT; '
+                'B=2; Max-Age=100; C=3')
+    assert auth._get_morsel_expiry(cookie['A']) == 2139722880
+    assert abs(auth._get_morsel_expiry(cookie['B']) - time.time() - 100) < 5
+    assert auth._get_morsel_expiry(cookie['C']) is None
+
+
+def _make_request(statuses, cookie_names):
+    """Return _request function setting cookie_names for .google.com."""
+    statuses = list(statuses)
+
+    @asyncio.coroutine
+    def request(method, url, connector, cookie_jar=None, headers=None):
+        cookie = http.cookies.SimpleCookie()
+        for name in cookie_names:
+            cookie[name] = 'value'
+            cookie[name]['domain'] = '.google.com'
+            cookie_jar[('.google.com', name)] = cookie[name]
+        return (statuses.pop(0), 'uberauth')
+    return request
+
+
+@coroutine_test
+def test_get_session_cookies(monkeypatch):
+    monkeypatch.setattr(auth, '_request',
+                        _make_request([200, 200], auth.REQUIRED_COOKIES))
+    cookies, expires = yield from auth._get_session_cookies('token', None)
+    assert cookies == {name: 'value' for name in auth.REQUIRED_COOKIES}
+    assert expires is None
+
+
+@coroutine_test
+def test_get_session_cookies_failed(monkeypatch):
+    monkeypatch.setattr(auth, '_request',
+                        _make_request([200, 500], auth.REQUIRED_COOKIES))
+    with pytest.raises(auth.GoogleAuthError):
+        yield from auth._get_session_cookies('token', None)
+
+    monkeypatch.setattr(auth, '_request',
+                        _make_request([200, 200], ['SAPISID', 'SID']))
+    with pytest.raises(auth.GoogleAuthError) as excinfo:
+        yield from auth._get_session_cookies('token', None)
+    assert 'HSID, SSID, APISID' in str(excinfo.value)
@@ -0,0 +1,115 @@
+"""Tests for the backfill crawler."""
+
+import asyncio
+
+import pytest
+
+from hangups import backfill, exceptions, hangouts_pb2
+from hangups.test.utils import coroutine_test
+
+
+class FakeClient(object):
+
+    """Client serving getconversation from a list of events."""
+
+    def __init__(self, num_events):
+        self.events = [hangouts_pb2.Event(event_id=str(i), timestamp=i + 1)
+                       for i in range(num_events)]
+
+    @asyncio.coroutine
+    def getconversation(self, conversation_id, event_timestamp, max_events,
+                        event_continuation_token):
+        events = [event for event in self.events if event.timestamp <
+                  event_continuation_token.event_timestamp][-max_events:]
+        response = hangouts_pb2.GetConversationResponse()
+        response.conversation_state.event.extend(events)
+        if events:
+            token = response.conversation_state.event_continuation_token
+            token.event_timestamp = events[0].timestamp
+        return response
+
+
+class Sink(object):
+
+    def __init__(self, fail_after=None):
+        self.event_ids = []
+        self._fail_after = fail_after
+
+    def __call__(self, conversation_id, events):
+        if self._fail_after is not None and self._fail_after == 0:
+            raise RuntimeError('sink failed')
+        if self._fail_after is not None:
+            self._fail_after -= 1
+        self.event_ids.extend(event.event_id for event in events)
+
+
+def test_token_json():
+    token = hangouts_pb2.EventContinuationToken(
+        event_id='1', event_timestamp=2, storage_continuation_token=b'\x00'
+    )
+    assert backfill._token_from_json(backfill._token_to_json(token)) == token
+
+
+@coroutine_test
+def test_backfill_and_resume(tmpdir):
+    client = FakeClient(5)
+    sink = Sink(fail_after=1)
+    backfill_ = backfill.Backfill(client, sink, str(tmpdir), page_size=2,
+                                  rate=None)
+    with pytest.raises(RuntimeError):
+        yield from backfill_._backfill_conversation('conv1')
+    assert sink.event_ids == ['3', '4']
+    checkpoint = backfill_.load_checkpoint('conv1')
+    assert checkpoint['num_events'] == 2
+    assert not checkpoint['done']
+
+    sink = Sink()
+    backfill_ = backfill.Backfill(client, sink, str(tmpdir), page_size=2,
+                                  rate=None)
+    yield from backfill_._backfill_conversation('conv1')
+    assert sink.event_ids == ['1', '2', '0']
+    checkpoint = backfill_.load_checkpoint('conv1')
+    assert checkpoint['num_events'] == 5
+    assert checkpoint['done']
+
+    # A finished conversation is skipped.
+    yield from backfill_._backfill_conversation('conv1')
+    assert len(sink.event_ids) == 3
+
+
+class StuckClient(FakeClient):
+
+    """Client returning continuation tokens which don't go back in time."""
+
+    @asyncio.coroutine
+    def getconversation(self, conversation_id, event_timestamp, max_events,
+                        event_continuation_token):
+        response = yield from super().getconversation(
+            conversation_id, event_timestamp, max_events,
+            event_continuation_token
+        )
+        if response.conversation_state.event:
+            token = response.conversation_state.event_continuation_token
+            token.event_timestamp = event_continuation_token.event_timestamp
+        return response
+
+
+@coroutine_test
+def test_no_progress(tmpdir):
+    sink = Sink()
+    backfill_ = backfill.Backfill(StuckClient(5), sink, str(tmpdir),
+                                  page_size=2, rate=None)
+    errors = yield from backfill_.run(['conv1'])
+    assert list(errors) == ['conv1']
+    assert isinstance(errors['conv1'], exceptions.NetworkError)
+    assert sink.event_ids == ['3', '4']
+    checkpoint = backfill_.load_checkpoint('conv1')
+    assert checkpoint['num_events'] == 2
+    assert not checkpoint['done']
+
+
+@pytest.mark.parametrize('kwargs', [{'rate': 0}, {'rate': -1},
+                                    {'concurrency': 0}])
+def test_invalid_arguments(tmpdir, kwargs):
+    with pytest.raises(ValueError):
+        backfill.Backfill(FakeClient(0), Sink(), str(tmpdir), **kwargs)
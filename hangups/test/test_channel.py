@@ -1,8 +1,10 @@
 """Tests for channel data parsing."""
 
+import asyncio
+
 import pytest
 
-from hangups import channel
+from hangups import channel, exceptions
 
 
 @pytest.mark.parametrize('input_,expected', [
@@ -73,3 +75,31 @@ def test_split_characters():
     p = channel.ChunkParser()
     assert list(p.get_chunks(b'1\n\xe2\x82')) == []
     assert list(p.get_chunks(b'\xac')) == ['€']
+
+
+def test_listen_refresh_failure(monkeypatch):
+    @asyncio.coroutine
+    def sleep(delay):
+        pass
+
+    @asyncio.coroutine
+    def fail():
+        num_attempts[0] += 1
+        raise exceptions.AuthError('Unauthorized')
+
+    @asyncio.coroutine
+    def refresh_cookies():
+        num_refreshes[0] += 1
+        raise exceptions.AuthError('Failed to refresh cookies')
+
+    num_attempts = [0]
+    num_refreshes = [0]
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    channel_ = channel.Channel({}, None, refresh_cookies=refresh_cookies)
+    channel_._fetch_channel_sid = fail
+    # A failure to refresh the cookies is retried like other errors, until
+    # listen runs out of retries.
+    loop.run_until_complete(channel_.listen())
+    assert num_attempts[0] == num_refreshes[0] == 6
@@ -0,0 +1,373 @@
+"""Tests for the client."""
+
+import asyncio
+import io
+import json
+
+import pytest
+
+from hangups import client, exceptions, hangouts_pb2, http_utils
+from hangups.test.utils import coroutine_test
+
+
+COOKIES = {name: 'fake' for name in ['SAPISID', 'HSID', 'SSID', 'APISID',
+                                     'SID']}
+
+
+def test_init():
+    client_ = client.Client(COOKIES, api_max_connections=5,
+                            keepalive_timeout=10)
+    client_._connector.close()
+    client_._channel_connector.close()
+
+
+class FakeResponse(object):
+
+    """aiohttp response with a status and body."""
+
+    def __init__(self, status, body=b''):
+        self.status = status
+        self.reason = 'Reason'
+        self.headers = {}
+        self.cookies = {}
+        self._body = body
+
+    @asyncio.coroutine
+    def read(self):
+        return self._body
+
+
+@coroutine_test
+def test_api_max_connections(monkeypatch):
+    client_ = client.Client(COOKIES, api_max_connections=2)
+    num_in_flight = [0]
+    max_in_flight = [0]
+
+    @asyncio.coroutine
+    def request(*args, **kwargs):
+        num_in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], num_in_flight[0])
+        yield from asyncio.sleep(0.01)
+        num_in_flight[0] -= 1
+        return FakeResponse(200)
+
+    monkeypatch.setattr(http_utils.aiohttp, 'request', request)
+    yield from asyncio.gather(*[
+        client_._base_request('https://example.com', 'application/json',
+                              'json', '')
+        for _ in range(5)
+    ])
+    assert max_in_flight[0] == 2
+
+
+@coroutine_test
+def test_api_max_connections_retry(monkeypatch):
+    client_ = client.Client(COOKIES, api_max_connections=1)
+    attempts = []
+
+    @asyncio.coroutine
+    def request(method, url, data=None, **kwargs):
+        attempts.append(data)
+        yield from asyncio.sleep(0.01)
+        # The first attempt of each request fails.
+        return FakeResponse(503 if attempts.count(data) == 1 else 200)
+
+    monkeypatch.setattr(http_utils.aiohttp, 'request', request)
+    monkeypatch.setattr(http_utils, '_get_backoff_delay',
+                        lambda retry_num: 0.05)
+    yield from asyncio.gather(*[
+        client_._base_request('https://example.com', 'application/json',
+                              'json', data, retry=True)
+        for data in ['a', 'b']
+    ])
+    # The connection isn't held while waiting to retry, so the other request
+    # is sent in the meantime.
+    assert attempts[0] != attempts[1]
+    assert attempts[2:] == attempts[:2]
+
+
+class FakeUploadServer(object):
+
+    """_base_request function serving a resumable image upload.
+
+    upload_failures is a list with an item for each chunk upload request in
+    order. If an item is not None, the request fails after the server has
+    received that many bytes of the chunk. query_failures is the number of
+    offset queries which fail before they succeed.
+    """
+
+    def __init__(self, upload_failures=(), query_failures=0):
+        self.data = b''
+        self.requests = []  # [(command, offset)]
+        self._upload_failures = list(upload_failures)
+        self._query_failures = query_failures
+
+    @asyncio.coroutine
+    def __call__(self, url, content_type, response_type, data, headers=None,
+                 **kwargs):
+        if url == client.IMAGE_UPLOAD_URL:
+            return self._make_response({'sessionStatus': {
+                'externalFieldTransfers': [{'putInfo': {'url': 'upload'}}]
+            }})
+        command = headers['X-Goog-Upload-Command']
+        if command == 'query':
+            self.requests.append((command, None))
+            if self._query_failures > 0:
+                self._query_failures -= 1
+                raise exceptions.NetworkError('Injected query error')
+            return self._make_response({}, headers={
+                'X-Goog-Upload-Size-Received': str(len(self.data))
+            })
+        offset = int(headers['X-Goog-Upload-Offset'])
+        self.requests.append((command, offset))
+        assert offset == len(self.data)
+        failure = (self._upload_failures.pop(0) if self._upload_failures
+                   else None)
+        if failure is not None:
+            self.data += data[:failure]
+            raise exceptions.NetworkError('Injected upload error')
+        self.data += data
+        return self._make_response({'sessionStatus': {'additionalInfo': {
+            'uploader_service.GoogleRupioAdditionalInfo': {
+                'completionInfo': {'customerSpecificInfo': {
+                    'photoid': 'photo-id'
+                }}
+            }
+        }}})
+
+    @staticmethod
+    def _make_response(body, headers=None):
+        return http_utils.FetchResponse(200, json.dumps(body).encode(), {},
+                                        headers or {})
+
+
+@asyncio.coroutine
+def _upload_image(monkeypatch, server, progress=None):
+    """Upload 10 bytes 4 at a time to server and return the image ID."""
+    monkeypatch.setattr(client, 'IMAGE_UPLOAD_CHUNK_SIZE', 4)
+    client_ = client.Client(COOKIES)
+    client_._base_request = server
+    callback = None if progress is None else (
+        lambda *args: progress.append(args)
+    )
+    return (yield from client_.upload_image(
+        io.BytesIO(b'0123456789'), filename='image.png',
+        progress_callback=callback
+    ))
+
+
+@coroutine_test
+def test_upload_image_chunks(monkeypatch):
+    server = FakeUploadServer()
+    progress = []
+    image_id = yield from _upload_image(monkeypatch, server, progress)
+    assert image_id == 'photo-id'
+    assert server.data == b'0123456789'
+    assert server.requests == [('upload', 0), ('upload', 4),
+                               ('upload, finalize', 8)]
+    assert progress == [(4, 10), (8, 10), (10, 10)]
+
+
+@coroutine_test
+def test_upload_image_resume(monkeypatch):
+    # The second chunk fails after 2 of its bytes are received, and the
+    # first query for the offset fails.
+    server = FakeUploadServer(upload_failures=[None, 2], query_failures=1)
+    progress = []
+    image_id = yield from _upload_image(monkeypatch, server, progress)
+    assert image_id == 'photo-id'
+    assert server.data == b'0123456789'
+    assert server.requests == [('upload', 0), ('upload', 4), ('query', None),
+                               ('query', None), ('upload, finalize', 6)]
+    assert progress == [(4, 10), (10, 10)]
+
+
+@coroutine_test
+def test_upload_image_max_resumes(monkeypatch):
+    server = FakeUploadServer(
+        upload_failures=[0] * (client.IMAGE_UPLOAD_MAX_RESUMES + 1)
+    )
+    with pytest.raises(exceptions.NetworkError):
+        yield from _upload_image(monkeypatch, server)
+    assert server.requests == ([('upload', 0), ('query', None)] *
+                               client.IMAGE_UPLOAD_MAX_RESUMES +
+                               [('upload', 0)])
+
+    # Failed queries count as resumes.
+    server = FakeUploadServer(upload_failures=[0],
+                              query_failures=client.IMAGE_UPLOAD_MAX_RESUMES)
+    with pytest.raises(exceptions.NetworkError):
+        yield from _upload_image(monkeypatch, server)
+    assert server.requests == ([('upload', 0)] + [('query', None)] *
+                               client.IMAGE_UPLOAD_MAX_RESUMES)
+
+
+class FakeRequests(object):
+
+    """make_request function for RequestHedger.
+
+    Each request finishes after a delay, and returns a result or raises it
+    if it's an exception. Cancelled requests are recorded by index.
+    """
+
+    def __init__(self, *outcomes):
+        self._outcomes = outcomes  # [(delay, result)]
+        self.num_started = 0
+        self.cancelled = []
+
+    def __call__(self):
+        delay, result = self._outcomes[self.num_started]
+        self.num_started += 1
+        return self._request(self.num_started - 1, delay, result)
+
+    @asyncio.coroutine
+    def _request(self, index, delay, result):
+        try:
+            yield from asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def _make_hedger(budget=client.HEDGE_MAX_BURST):
+    """Return RequestHedger which hedges after 0.01 seconds."""
+    hedger = client.RequestHedger()
+    for _ in range(client.HEDGE_MIN_SAMPLES):
+        hedger._latencies.append(0.01)
+    hedger._budget = budget
+    return hedger
+
+
+@coroutine_test
+def test_hedge_wins():
+    requests = FakeRequests((1, 'primary'), (0, 'hedged'))
+    assert (yield from _make_hedger().request(requests)) == 'hedged'
+    assert requests.num_started == 2
+    # Let the cancellation be delivered.
+    yield from asyncio.sleep(0)
+    assert requests.cancelled == [0]
+
+
+@coroutine_test
+def test_primary_wins():
+    requests = FakeRequests((0, 'primary'))
+    assert (yield from _make_hedger().request(requests)) == 'primary'
+    assert requests.num_started == 1
+
+    # The primary request may also win after the hedged request is sent.
+    requests = FakeRequests((0.05, 'primary'), (1, 'hedged'))
+    assert (yield from _make_hedger().request(requests)) == 'primary'
+    assert requests.num_started == 2
+    yield from asyncio.sleep(0)
+    assert requests.cancelled == [1]
+
+
+@coroutine_test
+def test_hedge_budget():
+    requests = FakeRequests((0.05, 'primary'))
+    assert (yield from _make_hedger(budget=0).request(requests)) == 'primary'
+    assert requests.num_started == 1
+
+
+@coroutine_test
+def test_hedge_error():
+    # A failed request is ignored if the other one succeeds.
+    requests = FakeRequests((0.05, exceptions.NetworkError('primary')),
+                            (0.1, 'hedged'))
+    assert (yield from _make_hedger().request(requests)) == 'hedged'
+    requests = FakeRequests((0.05, 'primary'),
+                            (0, exceptions.NetworkError('hedged')))
+    assert (yield from _make_hedger().request(requests)) == 'primary'
+
+    # If both fail, the error is raised.
+    requests = FakeRequests((0.05, exceptions.NetworkError('primary')),
+                            (0, exceptions.NetworkError('hedged')))
+    with pytest.raises(exceptions.NetworkError):
+        yield from _make_hedger().request(requests)
+    assert requests.cancelled == []
+
+
+# pblite response with an OK response header:
+OK_RESPONSE = b'["cgserp",[1]]'
+
+
+def _trace_requests(monkeypatch, client_, responses):
+    """Return dict of the stages traced by client_ by request_id.
+
+    Each response is a (delay, FakeResponse) tuple for a request attempt.
+    """
+    responses = list(responses)
+    traces = {}
+
+    @asyncio.coroutine
+    def request(*args, **kwargs):
+        delay, response = responses.pop(0)
+        yield from asyncio.sleep(delay)
+        return response
+
+    monkeypatch.setattr(http_utils.aiohttp, 'request', request)
+    monkeypatch.setattr(http_utils, '_get_backoff_delay',
+                        lambda retry_num: 0)
+    client_.on_request_trace.add_observer(
+        lambda trace: traces.setdefault(trace.request_id, []).append(
+            trace.stage
+        )
+    )
+    return traces
+
+
+@asyncio.coroutine
+def _send_request(client_, endpoint):
+    yield from client_._pb_request(endpoint,
+                                   hangouts_pb2.GetConversationRequest(),
+                                   hangouts_pb2.GetConversationResponse())
+
+
+ATTEMPT_STAGES = [http_utils.TRACE_ATTEMPT_STARTED,
+                  http_utils.TRACE_FIRST_BYTE, http_utils.TRACE_BODY_READ]
+
+
+@coroutine_test
+def test_trace_retried(monkeypatch):
+    client_ = client.Client(COOKIES)
+    traces = _trace_requests(monkeypatch, client_, [
+        (0, FakeResponse(503)), (0, FakeResponse(200, OK_RESPONSE))
+    ])
+    yield from _send_request(client_, 'conversations/getconversation')
+    assert list(traces.values()) == [
+        [http_utils.TRACE_QUEUED] + ATTEMPT_STAGES * 2 +
+        [http_utils.TRACE_DECODED]
+    ]
+
+
+@coroutine_test
+def test_trace_failed(monkeypatch):
+    client_ = client.Client(COOKIES)
+    traces = _trace_requests(monkeypatch, client_, [(0, FakeResponse(503))])
+    with pytest.raises(exceptions.NetworkError):
+        yield from _send_request(client_, 'conversations/sendchatmessage')
+    # The failed attempt is traced, but nothing is decoded.
+    assert list(traces.values()) == [
+        [http_utils.TRACE_QUEUED] + ATTEMPT_STAGES
+    ]
+
+
+@coroutine_test
+def test_trace_hedged(monkeypatch):
+    client_ = client.Client(COOKIES, hedge_requests=True)
+    client_._hedgers['conversations/getconversation'] = _make_hedger()
+    traces = _trace_requests(monkeypatch, client_, [
+        (1, FakeResponse(200, OK_RESPONSE)),
+        (0, FakeResponse(200, OK_RESPONSE)),
+    ])
+    yield from _send_request(client_, 'conversations/getconversation')
+    # The hedged request has its own request_id, and the original request
+    # is cancelled before its response arrives.
+    first_id, hedged_id = sorted(traces)
+    assert traces[first_id] == [http_utils.TRACE_QUEUED,
+                                http_utils.TRACE_ATTEMPT_STARTED]
+    assert traces[hedged_id] == ([http_utils.TRACE_QUEUED] + ATTEMPT_STAGES +
+                                 [http_utils.TRACE_DECODED])
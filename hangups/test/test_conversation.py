@@ -0,0 +1,473 @@
+"""Tests for conversations."""
+
+import asyncio
+import random
+
+import pytest
+
+from hangups import (conversation, conversation_event, event, event_store,
+                     exceptions, hangouts_pb2, outbox, parsers, user)
+from hangups.test.utils import coroutine_test
+
+
+def _make_event(conv_id, timestamp):
+    return hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+        event_id='{}-{}'.format(conv_id, timestamp), timestamp=timestamp,
+        event_type=hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
+    )
+
+
+def _make_conv_state(conv_id, events):
+    conv_state = hangouts_pb2.ConversationState(
+        conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+        event=events,
+    )
+    conv_state.conversation.conversation_id.id = conv_id
+    return conv_state
+
+
+class FakeUserList(object):
+
+    def get_self_user(self):
+        return user.User(user.UserID(chat_id='1', gaia_id='1'), 'Full Name',
+                         None, None, [], True)
+
+    def get_user(self, user_id):
+        return user.User(user_id, 'Full Name', None, None, [],
+                         user_id.chat_id == '1')
+
+
+class FakeClient(object):
+
+    """Client serving syncallnewevents in pages of a number of events."""
+
+    def __init__(self, events, page_size, truncated_ratio=1):
+        self.on_state_update = event.Event('on_state_update')
+        self.on_connect = event.Event('on_connect')
+        self.on_reconnect = event.Event('on_reconnect')
+        self.on_disconnect = event.Event('on_disconnect')
+        self.requests = []
+        self._events = events
+        self._page_size = page_size
+        self._truncated_ratio = truncated_ratio
+
+    @asyncio.coroutine
+    def syncallnewevents(self, timestamp, max_response_size_bytes):
+        since = parsers.to_timestamp(timestamp)
+        self.requests.append(since)
+        events = [event_ for event_ in self._events
+                  if event_.timestamp > since][:self._page_size]
+        res = hangouts_pb2.SyncAllNewEventsResponse(
+            sync_timestamp=events[-1].timestamp if events else since,
+            conversation_state=[
+                _make_conv_state(conv_id, [event_ for event_ in events
+                                           if event_.conversation_id.id ==
+                                           conv_id])
+                for conv_id in sorted({event_.conversation_id.id
+                                       for event_ in events})
+            ],
+        )
+        if len(events) == self._page_size:
+            # Pad the response as if it was cut off at the size limit.
+            res.response_header.debug_url = 'x' * int(
+                max_response_size_bytes * self._truncated_ratio
+            )
+        return res
+
+
+@coroutine_test
+def test_sync_pages():
+    # conv1 has a newer event than conv2 in each page.
+    events = sorted([_make_event('conv1', timestamp)
+                     for timestamp in range(2, 12, 2)] +
+                    [_make_event('conv2', timestamp)
+                     for timestamp in range(1, 11, 2)],
+                    key=lambda event_: event_.timestamp)
+    client = FakeClient(events, page_size=4)
+    conv_list = conversation.ConversationList(
+        client, [_make_conv_state('conv1', []), _make_conv_state('conv2', [])],
+        FakeUserList(), parsers.from_timestamp(0)
+    )
+    received = []
+    conv_list.on_event.add_observer(
+        lambda conv_event: received.append(conv_event.timestamp)
+    )
+    yield from conv_list._sync()
+    assert client.requests == [0, 4, 8]
+    assert sorted(parsers.to_timestamp(timestamp)
+                  for timestamp in received) == list(range(1, 11))
+    assert conv_list.sync_timestamp == parsers.from_timestamp(10)
+
+
+@coroutine_test
+def test_sync_truncated_below_ratio(caplog):
+    events = [_make_event('conv1', timestamp) for timestamp in range(1, 9)]
+    # The page is cut off, but is too small to be detected as truncated.
+    client = FakeClient(events, page_size=4, truncated_ratio=(
+        (conversation.SYNC_WARNING_RATIO +
+         conversation.SYNC_TRUNCATED_RATIO) / 2
+    ))
+    conv_list = conversation.ConversationList(
+        client, [_make_conv_state('conv1', [])], FakeUserList(),
+        parsers.from_timestamp(0)
+    )
+    yield from conv_list._sync()
+    assert client.requests == [0]
+    assert conv_list.sync_timestamp == parsers.from_timestamp(4)
+    assert 'some events may be lost' in caplog.text
+
+
+@coroutine_test
+def test_event_store_sync():
+    store = event_store.EventStore(':memory:')
+    client = FakeClient([], page_size=4)
+    conv_list = conversation.ConversationList(
+        client, [_make_conv_state('conv1', [_make_event('conv1', 1)])],
+        FakeUserList(), parsers.from_timestamp(1), event_store=store
+    )
+
+    @asyncio.coroutine
+    def get_ids_before(timestamp):
+        events = yield from store.load_events_before(
+            'conv1', 'conv1-{}'.format(timestamp), 5
+        )
+        return [event_.event_id for event_ in events]
+
+    yield from conv_list._on_event(_make_event('conv1', 2))
+    assert (yield from get_ids_before(2)) == ['conv1-1']
+    # Events may be missed while disconnected, so until a sync completes,
+    # events are not linked.
+    yield from client.on_disconnect.fire()
+    yield from conv_list._on_event(_make_event('conv1', 4))
+    assert (yield from get_ids_before(4)) == []
+
+    @asyncio.coroutine
+    def syncallnewevents(timestamp, max_response_size_bytes):
+        raise exceptions.NetworkError('Injected error')
+    client.syncallnewevents = syncallnewevents
+    yield from conv_list._sync()
+    yield from conv_list._on_event(_make_event('conv1', 5))
+    assert (yield from get_ids_before(5)) == []
+
+    del client.syncallnewevents
+    yield from conv_list._sync()
+    yield from conv_list._on_event(_make_event('conv1', 6))
+    assert (yield from get_ids_before(6)) == ['conv1-5']
+
+
+class FakeSendClient(object):
+
+    """Client receiving sendchatmessage requests after a random delay.
+
+    Like a real server, requests in flight at the same time are received in
+    any order. failures maps message texts to the number of times their
+    requests fail.
+    """
+
+    def __init__(self, failures=None):
+        self.received = []  # [(text, image_id, client_generated_id)]
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._failures = dict(failures or {})
+
+    @asyncio.coroutine
+    def upload_image(self, image_file):
+        yield from asyncio.sleep(0.01)
+        return 'image-{}'.format(image_file)
+
+    @asyncio.coroutine
+    def sendchatmessage(self, conversation_id, segments, image_id=None,
+                        otr_status=None, delivery_medium=None,
+                        client_generated_id=None):
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            yield from asyncio.sleep(random.uniform(0.002, 0.005))
+        finally:
+            self._in_flight -= 1
+        text = segments[0].text
+        if self._failures.get(text, 0) > 0:
+            self._failures[text] -= 1
+            raise exceptions.NetworkError('Injected error')
+        self.received.append((text, image_id, client_generated_id))
+
+    def get_texts(self):
+        """Return texts received, in the order the server shows them."""
+        return [text for text, _, _ in sorted(self.received,
+                                              key=lambda item: item[2])]
+
+
+def _make_conversation(client):
+    return conversation.Conversation(
+        client, FakeUserList(), hangouts_pb2.Conversation(
+            conversation_id=hangouts_pb2.ConversationId(id='conv1'),
+        )
+    )
+
+
+def _send(conv, text, image_file=None):
+    return conv.send_message([conversation_event.ChatMessageSegment(text)],
+                             image_file=image_file)
+
+
+@coroutine_test
+def test_send_message_order():
+    # The first message fails twice before it's sent.
+    client = FakeSendClient(failures={'0': 2})
+    conv = _make_conversation(client)
+    num_messages = conversation.MAX_MESSAGES_IN_FLIGHT * 2
+    futures = [_send(conv, str(i)) for i in range(num_messages)]
+    # The order is decided when send_message is called, not when the
+    # futures are waited for.
+    yield from asyncio.gather(*reversed(futures))
+    assert client.get_texts() == [str(i) for i in range(num_messages)]
+    assert len({id_ for _, _, id_ in client.received}) == num_messages
+    assert client.max_in_flight == conversation.MAX_MESSAGES_IN_FLIGHT
+
+
+@coroutine_test
+def test_send_message_failure():
+    client = FakeSendClient(
+        failures={'0': conversation.SEND_MESSAGE_RETRIES + 1}
+    )
+    conv = _make_conversation(client)
+    results = yield from asyncio.gather(_send(conv, '0'), _send(conv, '1'),
+                                        return_exceptions=True)
+    assert isinstance(results[0], exceptions.NetworkError)
+    assert results[1] is None
+    assert client.get_texts() == ['1']
+
+
+@coroutine_test
+def test_send_image_with_text():
+    client = FakeSendClient()
+    conv = _make_conversation(client)
+    # More text messages follow the image than images may be uploaded at
+    # once.
+    num_messages = conversation.MAX_IMAGE_UPLOADS + 4
+    yield from asyncio.wait_for(asyncio.gather(*[
+        _send(conv, str(i), image_file='file' if i == 1 else None)
+        for i in range(num_messages)
+    ]), 5)
+    assert [(text, image_id) for text, image_id, _
+            in sorted(client.received, key=lambda item: item[2])] == [
+        (str(i), 'image-file' if i == 1 else None)
+        for i in range(num_messages)
+    ]
+
+
+class FakeBroadcastClient(object):
+
+    """Client for a ConversationList which records sendchatmessage requests.
+
+    Requests to conversations in fail_conv_ids fail.
+    """
+
+    def __init__(self, fail_conv_ids=()):
+        self.on_state_update = event.Event('on_state_update')
+        self.on_connect = event.Event('on_connect')
+        self.on_reconnect = event.Event('on_reconnect')
+        self.on_disconnect = event.Event('on_disconnect')
+        self.start_times = []
+        self.max_in_flight = 0
+        self._num_in_flight = 0
+        self._fail_conv_ids = fail_conv_ids
+
+    @asyncio.coroutine
+    def sendchatmessage(self, conversation_id, segments, **kwargs):
+        self.start_times.append(asyncio.get_event_loop().time())
+        self._num_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._num_in_flight)
+        try:
+            yield from asyncio.sleep(0.01)
+        finally:
+            self._num_in_flight -= 1
+        if conversation_id in self._fail_conv_ids:
+            raise exceptions.NetworkError('Injected error')
+
+
+def _make_conversation_list(client, num_conversations):
+    return conversation.ConversationList(
+        client, [_make_conv_state('conv{}'.format(i), [])
+                 for i in range(num_conversations)],
+        FakeUserList(), parsers.from_timestamp(0)
+    )
+
+
+@coroutine_test
+def test_broadcast():
+    client = FakeBroadcastClient(fail_conv_ids=['conv2'])
+    conv_list = _make_conversation_list(client, 6)
+    results = {}
+    for future in conv_list.broadcast(
+            [conversation_event.ChatMessageSegment('hello')],
+            ['conv{}'.format(i) for i in range(6)], concurrency=2, rate=None
+    ):
+        conv_id, error = yield from future
+        results[conv_id] = error
+    assert isinstance(results.pop('conv2'), exceptions.NetworkError)
+    assert results == {'conv{}'.format(i): None for i in [0, 1, 3, 4, 5]}
+    assert client.max_in_flight == 2
+
+
+@coroutine_test
+def test_broadcast_rate():
+    client = FakeBroadcastClient()
+    conv_list = _make_conversation_list(client, 5)
+    yield from asyncio.gather(*conv_list.broadcast(
+        [conversation_event.ChatMessageSegment('hello')],
+        ['conv{}'.format(i) for i in range(5)], rate=100
+    ))
+    # Messages are started 0.01 seconds apart, give or take timer jitter.
+    assert len(client.start_times) == 5
+    assert client.start_times[-1] - client.start_times[0] > 0.035
+
+
+def test_broadcast_invalid():
+    conv_list = _make_conversation_list(FakeBroadcastClient(), 1)
+    segments = [conversation_event.ChatMessageSegment('hello')]
+    with pytest.raises(ValueError):
+        conv_list.broadcast(segments, ['conv0'], rate=0)
+    with pytest.raises(ValueError):
+        conv_list.broadcast(segments, ['conv0'], concurrency=0)
+    with pytest.raises(KeyError):
+        conv_list.broadcast(segments, ['conv0', 'conv1'])
+
+
+def _make_outbox(texts):
+    outbox_ = outbox.Outbox(':memory:')
+    for i, text in enumerate(texts):
+        outbox_.add('conv0', i + 1, [hangouts_pb2.Segment(
+            type=hangouts_pb2.SEGMENT_TYPE_TEXT, text=text
+        )], None, hangouts_pb2.OFF_THE_RECORD_STATUS_ON_THE_RECORD,
+            hangouts_pb2.DeliveryMedium())
+    return outbox_
+
+
+class FakeOutboxClient(FakeSendClient):
+
+    """FakeSendClient for a ConversationList."""
+
+    def __init__(self, failures=None):
+        super().__init__(failures=failures)
+        self.on_state_update = event.Event('on_state_update')
+        self.on_connect = event.Event('on_connect')
+        self.on_reconnect = event.Event('on_reconnect')
+        self.on_disconnect = event.Event('on_disconnect')
+
+
+@coroutine_test
+def test_flush_outbox():
+    client = FakeOutboxClient()
+    outbox_ = _make_outbox(['a', 'b'])
+    conv_list = conversation.ConversationList(
+        client, [_make_conv_state('conv0', [])], FakeUserList(),
+        parsers.from_timestamp(0), outbox=outbox_
+    )
+    # Flushes overlapping with each other (and the flush started by the
+    # ConversationList) and with a new message don't send messages twice.
+    yield from asyncio.gather(
+        conv_list.flush_outbox(), conv_list.flush_outbox(),
+        _send(conv_list.get('conv0'), 'c'),
+    )
+    yield from conv_list.flush_outbox()
+    assert client.get_texts() == ['a', 'b', 'c']
+    assert len(client.received) == 3
+    assert len(outbox_) == 0
+
+
+@coroutine_test
+def test_send_message_after_failure():
+    client = FakeOutboxClient(
+        failures={'a': conversation.SEND_MESSAGE_RETRIES + 1}
+    )
+    outbox_ = _make_outbox([])
+    conv = conversation.ConversationList(
+        client, [_make_conv_state('conv0', [])], FakeUserList(),
+        parsers.from_timestamp(0), outbox=outbox_
+    ).get('conv0')
+    with pytest.raises(exceptions.NetworkError):
+        yield from _send(conv, 'a')
+    assert len(outbox_) == 1
+    # The failed message is sent again after the next one, and keeps its
+    # place.
+    yield from _send(conv, 'b')
+    assert [text for text, _, _ in client.received] == ['b', 'a']
+    assert client.get_texts() == ['a', 'b']
+    assert len(outbox_) == 0
+
+
+def _make_unread_event(timestamp, sender=None):
+    """Return chat message Event from sender, or another Event if None."""
+    event_ = _make_event('conv1', timestamp)
+    if sender is not None:
+        event_.sender_id.chat_id = event_.sender_id.gaia_id = sender
+        event_.chat_message.message_content.segment.add(text='text')
+    return event_
+
+
+class FakeHistoryClient(object):
+
+    """Client serving getconversation from a list of events."""
+
+    def __init__(self, events):
+        self._events = events
+
+    @asyncio.coroutine
+    def getconversation(self, conv_id, timestamp, max_events):
+        before = parsers.to_timestamp(timestamp)
+        events = [event_ for event_ in self._events
+                  if event_.timestamp < before][-max_events:]
+        return hangouts_pb2.GetConversationResponse(
+            conversation_state=hangouts_pb2.ConversationState(event=events)
+        )
+
+
+@coroutine_test
+def test_unread_counts():
+    # Chat messages from another user (2), from the self user (1), and an
+    # event which isn't a chat message.
+    events = [_make_unread_event(1, '2'), _make_unread_event(2, '1'),
+              _make_unread_event(3), _make_unread_event(4, '2'),
+              _make_unread_event(5, '1'), _make_unread_event(6, '2')]
+    conversation_pb = _make_conv_state('conv1', []).conversation
+    read_state = conversation_pb.self_conversation_state.self_read_state
+    read_state.latest_read_timestamp = 3
+    conv = conversation.Conversation(FakeHistoryClient(events),
+                                     FakeUserList(), conversation_pb,
+                                     events[2:])
+
+    def get_counts():
+        return (conv.num_unread_events, conv.num_unread_chat_messages)
+
+    def set_read_timestamp(timestamp):
+        conv._on_watermark_notification(parsers.WatermarkNotification(
+            'conv1', user.UserID(chat_id='1', gaia_id='1'),
+            parsers.from_timestamp(timestamp)
+        ))
+
+    assert get_counts() == (3, 2)
+    conv.add_event(_make_unread_event(7, '2'))
+    assert get_counts() == (4, 3)
+    set_read_timestamp(5)
+    assert get_counts() == (2, 2)
+    set_read_timestamp(1)
+    assert get_counts() == (5, 3)
+    assert len(conv.unread_events) == 5
+    # A zero read timestamp in a conversation update means it's unchanged.
+    conv.update_conversation(_make_conv_state('conv1', []).conversation)
+    assert get_counts() == (5, 3)
+    # Loading older events counts the unread ones.
+    yield from conv.get_events('conv1-3')
+    assert [conv_event.id_ for conv_event in conv.events][:2] == [
+        'conv1-1', 'conv1-2'
+    ]
+    assert get_counts() == (6, 3)
+    assert len(conv.unread_events) == 6
+    # Evicted unread events are counted until they are read.
+    conv.evict_events(num_events=3)
+    assert get_counts() == (6, 3)
+    set_read_timestamp(4)
+    assert get_counts() == (3, 2)
+    assert len(conv.unread_events) == 3
@@ -0,0 +1,49 @@
+"""Tests for ConversationEvents."""
+
+import pytest
+
+from hangups import conversation_event, hangouts_pb2, user
+
+
+def _make_event():
+    event = hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id='conv1'),
+        sender_id=hangouts_pb2.ParticipantId(gaia_id='1', chat_id='2'),
+        timestamp=1000000,
+        event_id='event1',
+    )
+    event.chat_message.message_content.segment.add(
+        type=hangouts_pb2.SEGMENT_TYPE_TEXT, text='hello'
+    )
+    return event
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_chat_message_event(compact):
+    conv_event = conversation_event.ChatMessageEvent(_make_event(),
+                                                     compact=compact)
+    assert conv_event.id_ == 'event1'
+    assert conv_event.conversation_id == 'conv1'
+    assert conv_event.user_id == user.UserID(chat_id='2', gaia_id='1')
+    assert conv_event.timestamp.timestamp() == 1
+    assert conv_event.text == 'hello'
+    assert conv_event._get_byte_size() == _make_event().ByteSize()
+
+
+def test_compact_event_is_not_mutable():
+    conv_event = conversation_event.ChatMessageEvent(_make_event(),
+                                                     compact=True)
+    conv_event._event.chat_message.message_content.segment[0].text = 'bye'
+    assert conv_event.text == 'hello'
+    with pytest.raises(AttributeError):
+        conv_event.foo = 'bar'
+
+
+def test_properties_are_cached():
+    conv_event = conversation_event.ChatMessageEvent(_make_event())
+    assert conv_event.timestamp is conv_event.timestamp
+    assert conv_event.user_id is conv_event.user_id
+    segments = conv_event.segments
+    segments.clear()
+    assert len(conv_event.segments) == 1
+    assert conv_event.segments[0] is conv_event.segments[0]
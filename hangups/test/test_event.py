@@ -4,15 +4,7 @@ import asyncio
 import pytest
 
 from hangups import event
-
-def coroutine_test(f):
-    """Decorator to create a coroutine that starts and stops its own loop."""
-    def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(future)
-    return wrapper
+from hangups.test.utils import coroutine_test
 
 
 @coroutine_test
@@ -65,3 +57,13 @@ def test_remove_nonexistant():
     a = lambda a: print('A: got {}'.format(a))
     with pytest.raises(ValueError):
         e.remove_observer(a)
+
+
+def test_has_observers():
+    e = event.Event('MyEvent')
+    a = lambda a: print('A: got {}'.format(a))
+    assert not e.has_observers
+    e.add_observer(a)
+    assert e.has_observers
+    e.remove_observer(a)
+    assert not e.has_observers
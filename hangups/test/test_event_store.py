@@ -0,0 +1,60 @@
+"""Tests for the event store."""
+
+from hangups import event_store, hangouts_pb2
+from hangups.test.utils import coroutine_test
+
+
+def _make_events(*event_ids):
+    return [hangouts_pb2.Event(event_id=event_id, timestamp=i * 1000)
+            for i, event_id in enumerate(event_ids)]
+
+
+def _get_ids(events):
+    return [event_.event_id for event_ in events]
+
+
+def test_get_events_before():
+    store = event_store.EventStore(':memory:')
+    store.add_events('conv1', _make_events('a', 'b', 'c', 'd'))
+    store.add_events('conv2', _make_events('a', 'b'))
+    assert _get_ids(store.get_events_before('conv1', 'd', 2)) == ['b', 'c']
+    assert _get_ids(store.get_events_before('conv1', 'd', 5)) == ['a', 'b',
+                                                                  'c']
+    assert store.get_events_before('conv1', 'a', 5) == []
+    assert store.get_events_before('conv1', 'unknown', 5) == []
+
+
+def test_gap_not_returned():
+    store = event_store.EventStore(':memory:')
+    events = _make_events('a', 'b', 'c', 'd')
+    store.add_events('conv1', events[:2])
+    # The events between b and d were missed.
+    store.add_events('conv1', events[3:])
+    assert store.get_events_before('conv1', 'd', 5) == []
+    # Linking the missing event joins the two chains.
+    store.add_events('conv1', events[2:3], previous_event_id='b')
+    store.add_events('conv1', events[2:])
+    assert _get_ids(store.get_events_before('conv1', 'd', 5)) == ['a', 'b',
+                                                                  'c']
+
+
+def test_persistence(tmpdir):
+    path = str(tmpdir.join('events.db'))
+    store = event_store.EventStore(path)
+    store.add_events('conv1', _make_events('a', 'b'))
+    store.close()
+    event_, = event_store.EventStore(path).get_events_before('conv1', 'b', 5)
+    assert event_.event_id == 'a'
+    assert event_.timestamp == 0
+
+
+@coroutine_test
+def test_store_and_load_events():
+    store = event_store.EventStore(':memory:')
+    events = _make_events('a', 'b', 'c')
+    # Events are stored in order in the background, before loading them.
+    store.store_events('conv1', events[:2])
+    store.store_events('conv1', events[2:], previous_event_id='b')
+    loaded_events = yield from store.load_events_before('conv1', 'c', 5)
+    assert _get_ids(loaded_events) == ['a', 'b']
+    store.close()
@@ -0,0 +1,132 @@
+"""Tests for exporting conversation history."""
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from hangups import export, hangouts_pb2
+from hangups.test.utils import coroutine_test
+
+
+def _make_events(start, stop):
+    events = []
+    for i in range(start, stop):
+        event = hangouts_pb2.Event(
+            event_id=str(i), timestamp=i,
+            event_type=hangouts_pb2.EVENT_TYPE_REGULAR_CHAT_MESSAGE,
+        )
+        # Make some events long enough to need a multi-byte length.
+        event.chat_message.message_content.segment.add(
+            type=hangouts_pb2.SEGMENT_TYPE_TEXT, text='x' * i * 10
+        )
+        events.append(event)
+    return events
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_protobuf(tmpdir, compress):
+    exporter = export.Exporter(str(tmpdir), compress=compress)
+    exporter.write_events('conv1', _make_events(0, 20))
+    exporter.write_events('conv1', _make_events(20, 30))
+    path = exporter.get_path('conv1')
+    assert path.endswith('.pb.gz' if compress else '.pb')
+    assert list(export.read_events(path)) == _make_events(0, 30)
+
+
+def test_json(tmpdir):
+    exporter = export.Exporter(str(tmpdir), export.FORMAT_JSON,
+                               compress=True)
+    exporter.write_events('conv1', _make_events(1, 3))
+    with gzip.open(exporter.get_path('conv1'), 'rt') as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0] == {
+        'event_id': '1',
+        'timestamp': 1,
+        'event_type': 'EVENT_TYPE_REGULAR_CHAT_MESSAGE',
+        'chat_message': {'message_content': {'segment': [
+            {'type': 'SEGMENT_TYPE_TEXT', 'text': 'x' * 10},
+        ]}},
+    }
+    assert len(lines) == 2
+
+
+def test_unknown_format(tmpdir):
+    with pytest.raises(ValueError):
+        export.Exporter(str(tmpdir), 'xml')
+
+
+class FakeClient(object):
+
+    """Client serving getconversation from a list of events."""
+
+    def __init__(self, events):
+        self.events = events
+
+    @asyncio.coroutine
+    def getconversation(self, conversation_id, event_timestamp, max_events,
+                        event_continuation_token):
+        events = [event for event in self.events if event.timestamp <
+                  event_continuation_token.event_timestamp][-max_events:]
+        response = hangouts_pb2.GetConversationResponse()
+        response.conversation_state.event.extend(events)
+        if events:
+            token = response.conversation_state.event_continuation_token
+            token.event_timestamp = events[0].timestamp
+        return response
+
+
+class FailingExporter(export.Exporter):
+
+    """Exporter which fails after writing a number of pages."""
+
+    def __init__(self, directory, num_writes):
+        super().__init__(directory)
+        self._num_writes = num_writes
+
+    def write_events(self, conversation_id, events):
+        size = super().write_events(conversation_id, events)
+        self._num_writes -= 1
+        if self._num_writes == 0:
+            raise RuntimeError('Injected error')
+        return size
+
+
+@pytest.mark.parametrize('num_writes', [1, 2])
+@coroutine_test
+def test_export_history_resume(tmpdir, num_writes):
+    client = FakeClient(_make_events(1, 6))
+    export_dir = str(tmpdir.join('export'))
+    checkpoint_dir = str(tmpdir.join('checkpoints'))
+    # The export is interrupted after writing a page, but before saving its
+    # checkpoint.
+    with pytest.raises(RuntimeError):
+        yield from export.export_history(
+            client, ['conv1'], FailingExporter(export_dir, num_writes),
+            checkpoint_dir, page_size=2, rate=None
+        )
+    exporter = export.Exporter(export_dir)
+    errors = yield from export.export_history(
+        client, ['conv1'], exporter, checkpoint_dir, page_size=2, rate=None
+    )
+    assert errors == {}
+    # Events are written newest first, without duplicates.
+    assert list(export.read_events(exporter.get_path('conv1'))) == (
+        _make_events(1, 6)[::-1]
+    )
+
+
+@coroutine_test
+def test_export_history_existing_file(tmpdir):
+    exporter = export.Exporter(str(tmpdir.join('export')))
+    exporter.write_events('conv1', _make_events(0, 1))
+    path = exporter.get_path('conv1')
+    errors = yield from export.export_history(
+        FakeClient(_make_events(1, 3)), ['conv1'], exporter,
+        str(tmpdir.join('checkpoints')), page_size=2, rate=None
+    )
+    assert errors == {}
+    # The file without a checkpoint is kept, and a new file is written.
+    assert list(export.read_events(path + '.1')) == _make_events(0, 1)
+    assert list(export.read_events(path)) == _make_events(1, 3)[::-1]
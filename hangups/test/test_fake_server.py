@@ -0,0 +1,84 @@
+"""Tests for the fake server."""
+
+import pytest
+
+from hangups import fake_server, hangouts_pb2
+
+
+def _make_server():
+    server = fake_server.FakeServer()
+    server.populate(num_conversations=2, events_per_conversation=5)
+    return server
+
+
+def _get_conversation(server, max_events, timestamp=0):
+    request_pb = hangouts_pb2.GetConversationRequest(
+        conversation_spec=hangouts_pb2.ConversationSpec(
+            conversation_id=hangouts_pb2.ConversationId(id='conv0'),
+        ),
+        max_events_per_conversation=max_events,
+        event_continuation_token=hangouts_pb2.EventContinuationToken(
+            event_timestamp=timestamp,
+        ),
+    )
+    response_pb = hangouts_pb2.GetConversationResponse()
+    server._handle_getconversation(request_pb, response_pb)
+    return response_pb.conversation_state
+
+
+def _get_text(events):
+    return [event.chat_message.message_content.segment[0].text
+            for event in events]
+
+
+@pytest.mark.parametrize('max_events,expected', [
+    (0, []),
+    (2, ['Message 3', 'Message 4']),
+    (10, ['Message {}'.format(i) for i in range(5)]),
+])
+def test_getconversation(max_events, expected):
+    conv_state = _get_conversation(_make_server(), max_events)
+    assert _get_text(conv_state.event) == expected
+
+
+def test_getconversation_continuation():
+    server = _make_server()
+    conv_state = _get_conversation(server, 2)
+    conv_state = _get_conversation(
+        server, 2, conv_state.event_continuation_token.event_timestamp
+    )
+    assert _get_text(conv_state.event) == ['Message 1', 'Message 2']
+
+
+@pytest.mark.parametrize('max_events,num_events', [(0, 0), (3, 3)])
+def test_syncrecentconversations(max_events, num_events):
+    request_pb = hangouts_pb2.SyncRecentConversationsRequest(
+        max_conversations=1, max_events_per_conversation=max_events,
+    )
+    response_pb = hangouts_pb2.SyncRecentConversationsResponse()
+    _make_server()._handle_syncrecentconversations(request_pb, response_pb)
+    # The most recently modified conversation is returned.
+    conv_state, = response_pb.conversation_state
+    assert conv_state.conversation_id.id == 'conv1'
+    assert len(conv_state.event) == num_events
+
+
+def test_sendchatmessage_duplicate():
+    server = _make_server()
+    request_pb = hangouts_pb2.SendChatMessageRequest(
+        message_content=hangouts_pb2.MessageContent(segment=[
+            hangouts_pb2.Segment(type=hangouts_pb2.SEGMENT_TYPE_TEXT,
+                                 text='hello'),
+        ]),
+        event_request_header=hangouts_pb2.EventRequestHeader(
+            conversation_id=hangouts_pb2.ConversationId(id='conv0'),
+            client_generated_id=1,
+        ),
+    )
+    event_ids = set()
+    for _ in range(2):
+        response_pb = hangouts_pb2.SendChatMessageResponse()
+        server._handle_sendchatmessage(request_pb, response_pb)
+        event_ids.add(response_pb.created_event.event_id)
+    assert len(event_ids) == 1
+    assert _get_text(_get_conversation(server, 10).event)[-1] == 'hello'
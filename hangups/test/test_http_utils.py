@@ -0,0 +1,35 @@
+"""Tests for HTTP request utilities."""
+
+import datetime
+import email.utils
+
+import pytest
+
+from hangups import http_utils
+
+
+@pytest.mark.parametrize('input_,expected', [
+    (None, None),
+    ('', None),
+    ('invalid', None),
+    ('0', 0),
+    ('120', 120),
+    ('-5', 0),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0),
+])
+def test_parse_retry_after(input_, expected):
+    assert http_utils._parse_retry_after(input_) == expected
+
+
+def test_parse_retry_after_date():
+    retry_time = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                  datetime.timedelta(seconds=60))
+    value = email.utils.format_datetime(retry_time, usegmt=True)
+    assert 50 < http_utils._parse_retry_after(value) <= 60
+
+
+@pytest.mark.parametrize('retry_num', range(10))
+def test_backoff_delay(retry_num):
+    delay = http_utils._get_backoff_delay(retry_num)
+    assert 0 <= delay <= http_utils.RETRY_BACKOFF_MAX
+    assert delay <= http_utils.RETRY_BACKOFF_BASE * 2 ** retry_num
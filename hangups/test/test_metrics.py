@@ -0,0 +1,87 @@
+"""Tests for metrics and the Prometheus text format."""
+
+import pytest
+
+from hangups import metrics
+
+
+def test_counter():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter.')
+    counter.inc()
+    counter.inc(2)
+    assert counter.get() == 3
+    assert registry.get_text() == (
+        '# HELP test_total Test counter.\n'
+        '# TYPE test_total counter\n'
+        'test_total 3\n'
+    )
+
+
+def test_counter_decrease():
+    counter = metrics.Counter('test_total', 'Test counter.')
+    with pytest.raises(ValueError):
+        counter.inc(-1)
+
+
+def test_labels():
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter.', ['type'])
+    counter.inc(type='b')
+    counter.inc(type='a"\\\n')
+    assert counter.get(type='b') == 1
+    assert registry.get_text() == (
+        '# HELP test_total Test counter.\n'
+        '# TYPE test_total counter\n'
+        'test_total{type="a\\"\\\\\\n"} 1\n'
+        'test_total{type="b"} 1\n'
+    )
+
+
+def test_wrong_labels():
+    counter = metrics.Counter('test_total', 'Test counter.', ['type'])
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(type='a', other='b')
+
+
+def test_gauge():
+    registry = metrics.Registry()
+    gauge = registry.gauge('test_size', 'Test gauge.')
+    gauge.set(5)
+    gauge.dec(2)
+    gauge.inc(0.5)
+    assert gauge.get() == 3.5
+    assert registry.get_text() == (
+        '# HELP test_size Test gauge.\n'
+        '# TYPE test_size gauge\n'
+        'test_size 3.5\n'
+    )
+
+
+def test_histogram():
+    registry = metrics.Registry()
+    histogram = registry.histogram('test_seconds', 'Test histogram.',
+                                   ['endpoint'], buckets=[0.5, 1])
+    histogram.observe(0.25, endpoint='a')
+    histogram.observe(1, endpoint='a')
+    histogram.observe(2, endpoint='a')
+    assert histogram.get_count(endpoint='a') == 3
+    assert histogram.get_count(endpoint='b') == 0
+    assert registry.get_text() == (
+        '# HELP test_seconds Test histogram.\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{endpoint="a",le="0.5"} 1\n'
+        'test_seconds_bucket{endpoint="a",le="1"} 2\n'
+        'test_seconds_bucket{endpoint="a",le="+Inf"} 3\n'
+        'test_seconds_sum{endpoint="a"} 3.25\n'
+        'test_seconds_count{endpoint="a"} 3\n'
+    )
+
+
+def test_already_registered():
+    registry = metrics.Registry()
+    registry.counter('test_total', 'Test counter.')
+    with pytest.raises(ValueError):
+        registry.counter('test_total', 'Test counter.')
@@ -0,0 +1,113 @@
+"""Tests for the outbox."""
+
+import asyncio
+import sqlite3
+
+from hangups import hangouts_pb2, outbox
+from hangups.test.utils import coroutine_test
+
+
+def _add_message(outbox_, conv_id, client_generated_id, text):
+    return outbox_.add(
+        conv_id, client_generated_id,
+        [hangouts_pb2.Segment(type=hangouts_pb2.SEGMENT_TYPE_TEXT, text=text)],
+        None, hangouts_pb2.OFF_THE_RECORD_STATUS_ON_THE_RECORD,
+        hangouts_pb2.DeliveryMedium(
+            medium_type=hangouts_pb2.DELIVERY_MEDIUM_BABEL
+        ),
+    )
+
+
+def test_add_and_get():
+    outbox_ = outbox.Outbox(':memory:')
+    _add_message(outbox_, 'conv1', 1, 'hello')
+    message, = outbox_.get_messages()
+    assert message.conversation_id == 'conv1'
+    assert message.client_generated_id == 1
+    assert [segment.text for segment in message.segments] == ['hello']
+    assert message.image_id is None
+    assert (message.delivery_medium.medium_type ==
+            hangouts_pb2.DELIVERY_MEDIUM_BABEL)
+
+
+def test_order_and_filter():
+    outbox_ = outbox.Outbox(':memory:')
+    _add_message(outbox_, 'conv1', 3, 'a')
+    _add_message(outbox_, 'conv2', 2, 'b')
+    _add_message(outbox_, 'conv1', 1, 'c')
+    assert [m.client_generated_id for m in outbox_.get_messages()] == [3, 2, 1]
+    assert ([m.client_generated_id for m in outbox_.get_messages('conv1')] ==
+            [3, 1])
+
+
+def test_remove():
+    outbox_ = outbox.Outbox(':memory:')
+    id_ = _add_message(outbox_, 'conv1', 1, 'a')
+    _add_message(outbox_, 'conv1', 2, 'b')
+    outbox_.remove(id_)
+    assert len(outbox_) == 1
+    assert outbox_.get_messages()[0].client_generated_id == 2
+
+
+def test_persistence(tmpdir):
+    path = str(tmpdir.join('outbox.db'))
+    outbox_ = outbox.Outbox(path)
+    _add_message(outbox_, 'conv1', 1, 'a')
+    outbox_.close()
+    assert len(outbox.Outbox(path)) == 1
+
+
+def test_coroutines():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    outbox_ = outbox.Outbox(':memory:')
+    id_ = loop.run_until_complete(outbox_.add_message(
+        'conv1', 1,
+        [hangouts_pb2.Segment(type=hangouts_pb2.SEGMENT_TYPE_TEXT, text='a')],
+        None, hangouts_pb2.OFF_THE_RECORD_STATUS_ON_THE_RECORD,
+        hangouts_pb2.DeliveryMedium()
+    ))
+    _add_message(outbox_, 'conv2', 2, 'b')
+    messages = loop.run_until_complete(outbox_.load_messages('conv1'))
+    assert [message.id_ for message in messages] == [id_]
+    outbox_.mark_sent(id_)
+    assert len(outbox_) == 1
+    outbox_.close()
+
+
+def _count_rows(path):
+    """Return number of messages in an outbox database."""
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    finally:
+        db.close()
+
+
+@coroutine_test
+def test_mark_sent(tmpdir, monkeypatch):
+    monkeypatch.setattr(outbox, 'REMOVE_DELAY_SECS', 0.01)
+    path = str(tmpdir.join('outbox.db'))
+    outbox_ = outbox.Outbox(path)
+    id_ = _add_message(outbox_, 'conv1', 1, 'a')
+    outbox_.mark_sent(id_)
+    # The message is removed with the next write.
+    assert outbox_.get_messages() == []
+    assert _count_rows(path) == 1
+    id_ = _add_message(outbox_, 'conv1', 2, 'b')
+    assert _count_rows(path) == 1
+    # Otherwise it is removed after a delay.
+    outbox_.mark_sent(id_)
+    assert _count_rows(path) == 1
+    yield from asyncio.sleep(0.05)
+    assert _count_rows(path) == 0
+    outbox_.close()
+
+
+def test_close_removes_sent(tmpdir):
+    path = str(tmpdir.join('outbox.db'))
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    outbox_ = outbox.Outbox(path)
+    outbox_.mark_sent(_add_message(outbox_, 'conv1', 1, 'a'))
+    outbox_.close()
+    assert _count_rows(path) == 0
@@ -0,0 +1,147 @@
+"""Tests for event retention limits."""
+
+import asyncio
+
+from hangups import conversation, hangouts_pb2, parsers, retention, user
+from hangups.test.utils import coroutine_test
+
+
+def _make_event(conv_id, timestamp, text=''):
+    event_ = hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id=conv_id),
+        event_id='{}-{}'.format(conv_id, timestamp), timestamp=timestamp,
+    )
+    event_.chat_message.message_content.segment.add(text=text)
+    return event_
+
+
+class FakeUserList(object):
+
+    def get_self_user(self):
+        return user.User(user.UserID(chat_id='1', gaia_id='1'), 'Full Name',
+                         None, None, [], True)
+
+
+class FakeClient(object):
+
+    """Client serving getconversation from a list of events."""
+
+    def __init__(self, events=()):
+        self.requests = []
+        self._events = events
+
+    @asyncio.coroutine
+    def getconversation(self, conv_id, timestamp, max_events):
+        before = parsers.to_timestamp(timestamp)
+        self.requests.append(before)
+        events = [event_ for event_ in self._events
+                  if event_.timestamp < before][-max_events:]
+        return hangouts_pb2.GetConversationResponse(
+            conversation_state=hangouts_pb2.ConversationState(event=events)
+        )
+
+
+def _make_conversation_pb(conv_id, read_timestamp=0):
+    conversation_pb = hangouts_pb2.Conversation(
+        conversation_id=hangouts_pb2.ConversationId(id=conv_id)
+    )
+    read_state = conversation_pb.self_conversation_state.self_read_state
+    read_state.latest_read_timestamp = read_timestamp
+    return conversation_pb
+
+
+def _make_conversation(budget, conv_id, timestamps, text='', client=None,
+                       read_timestamp=0):
+    conversation_pb = _make_conversation_pb(conv_id, read_timestamp)
+    return conversation.Conversation(
+        client, FakeUserList(), conversation_pb,
+        [_make_event(conv_id, timestamp, text) for timestamp in timestamps],
+        event_budget=budget
+    )
+
+
+def _get_ids(conv):
+    return [conv_event.id_ for conv_event in conv.events]
+
+
+def test_evict_least_recently_used():
+    budget = retention.EventBudget(max_events=6, min_events_per_conversation=1)
+    conv1 = _make_conversation(budget, 'conv1', [1, 2, 3])
+    conv2 = _make_conversation(budget, 'conv2', [1, 2])
+    conv1.get_event('conv1-3')
+    _make_conversation(budget, 'conv3', [1, 2])
+    # conv2 is the least recently used, so its oldest event is evicted.
+    assert _get_ids(conv2) == ['conv2-2']
+    assert len(conv1.events) == 3
+    assert budget.num_events == 6
+
+
+def test_keep_newest_events():
+    budget = retention.EventBudget(max_events=2, min_events_per_conversation=2)
+    conv1 = _make_conversation(budget, 'conv1', [1, 2, 3])
+    # Events are never evicted from the conversation they were added to.
+    assert len(conv1.events) == 3
+    conv2 = _make_conversation(budget, 'conv2', [1, 2, 3])
+    assert _get_ids(conv1) == ['conv1-2', 'conv1-3']
+    assert budget.num_events == 5
+    assert retention.retained_events_gauge.get() == 5
+    # conv1 has no more events to evict, so it isn't visited again until
+    # events are added to it.
+    conv2.add_event(_make_event('conv2', 4))
+    assert _get_ids(conv1) == ['conv1-2', 'conv1-3']
+    conv1.add_event(_make_event('conv1', 4))
+    conv2.add_event(_make_event('conv2', 5))
+    assert _get_ids(conv1) == ['conv1-3', 'conv1-4']
+
+
+def test_max_bytes_and_remove():
+    budget = retention.EventBudget(max_bytes=200,
+                                   min_events_per_conversation=0)
+    conv1 = _make_conversation(budget, 'conv1', [1, 2], text='x' * 50)
+    conv2 = _make_conversation(budget, 'conv2', [1], text='x' * 50)
+    assert _get_ids(conv1) == ['conv1-2']
+    assert budget.num_bytes <= 200
+    budget.remove(conv2)
+    assert budget.num_events == 1
+    assert budget.num_bytes == conv1.events[0]._get_byte_size()
+
+
+@coroutine_test
+def test_evicted_events():
+    budget = retention.EventBudget(max_events=4, min_events_per_conversation=1)
+    events = [_make_event('conv1', timestamp) for timestamp in range(1, 6)]
+    client = FakeClient(events)
+    conv1 = _make_conversation(budget, 'conv1', range(1, 6), client=client)
+    _make_conversation(budget, 'conv2', [1, 2, 3])
+    assert _get_ids(conv1) == ['conv1-5']
+    assert conv1.get_event('conv1-3') is None
+    assert conv1.next_event('conv1-3') is None
+    # Evicted events are loaded again until the requested one is found.
+    conv_events = yield from conv1.get_events('conv1-3', max_events=2)
+    assert [conv_event.id_ for conv_event in conv_events] == ['conv1-1',
+                                                              'conv1-2']
+    assert client.requests == [5, 3]
+    assert conv1.next_event('conv1-3').id_ == 'conv1-4'
+
+
+@coroutine_test
+def test_evicted_unread_events():
+    budget = retention.EventBudget(max_events=4, min_events_per_conversation=1)
+    events = [_make_event('conv1', timestamp) for timestamp in range(1, 6)]
+    conv1 = _make_conversation(budget, 'conv1', range(1, 6),
+                               client=FakeClient(events), read_timestamp=2)
+    _make_conversation(budget, 'conv2', [1, 2, 3])
+    # Unread events are still counted after they are evicted.
+    assert _get_ids(conv1) == ['conv1-5']
+    assert conv1.num_unread_events == 3
+    assert conv1.num_unread_chat_messages == 3
+    # Evicted events are no longer counted once they are read.
+    conv1.update_conversation(_make_conversation_pb('conv1', 3))
+    assert conv1.num_unread_events == 2
+    assert conv1.num_unread_chat_messages == 2
+    # Evicted events which are loaded again are not counted twice.
+    yield from conv1.get_events('conv1-5')
+    assert _get_ids(conv1) == ['conv1-1', 'conv1-2', 'conv1-3', 'conv1-4',
+                               'conv1-5']
+    assert conv1.num_unread_events == len(conv1.unread_events) == 2
+    assert conv1.num_unread_chat_messages == 2
@@ -0,0 +1,74 @@
+"""Tests for the search index."""
+
+import datetime
+
+from hangups import conversation_event, hangouts_pb2, parsers, search, user
+from hangups.test.utils import coroutine_test
+
+
+def _make_event(event_id, text, conversation_id='conv1', sender='1',
+                seconds=0):
+    event = hangouts_pb2.Event(
+        conversation_id=hangouts_pb2.ConversationId(id=conversation_id),
+        sender_id=hangouts_pb2.ParticipantId(gaia_id=sender, chat_id=sender),
+        timestamp=seconds * 1000000,
+        event_id=event_id,
+    )
+    event.chat_message.message_content.segment.add(text=text)
+    return conversation_event.ChatMessageEvent(event)
+
+
+def _make_index(path=None):
+    index = search.SearchIndex(path)
+    index.add_events([
+        _make_event('1', 'Lunch at the new place?', seconds=1),
+        _make_event('2', 'The new place is closed', sender='2', seconds=2),
+        _make_event('3', 'Place your bets', conversation_id='conv2',
+                    seconds=3),
+    ])
+    return index
+
+
+def _search(index, query, **kwargs):
+    return [result.event_id for result in index.search(query, **kwargs)]
+
+
+def test_queries():
+    index = _make_index()
+    assert _search(index, 'place') == ['3', '2', '1']
+    assert _search(index, 'NEW place') == ['2', '1']
+    assert _search(index, '"new place" closed') == ['2']
+    assert _search(index, '"place new"') == []
+    assert _search(index, 'clo*') == ['2']
+    assert _search(index, 'pl* bet*') == ['3']
+    assert _search(index, 'missing') == []
+    assert _search(index, '') == []
+
+
+def test_scopes():
+    index = _make_index()
+    assert _search(index, 'place', conversation_id='conv1') == ['2', '1']
+    assert _search(index, 'place', conversation_id='conv3') == []
+    assert _search(index, 'place',
+                   user_id=user.UserID(chat_id='2', gaia_id='2')) == ['2']
+    epoch = parsers.from_timestamp(0)
+    assert _search(index, 'place',
+                   start=epoch + datetime.timedelta(seconds=2),
+                   end=epoch + datetime.timedelta(seconds=3)) == ['2']
+    assert _search(index, 'place', limit=1) == ['3']
+
+
+@coroutine_test
+def test_persistence(tmpdir):
+    path = str(tmpdir.join('search.db'))
+    index = _make_index(path)
+    # Adding events again doesn't duplicate them.
+    index.add_events([_make_event('1', 'Lunch at the new place?')])
+    index.close()
+    index = search.SearchIndex(path)
+    assert len(index) == 0
+    # Messages added before loading aren't indexed twice.
+    index.add_events([_make_event('1', 'Lunch at the new place?')])
+    yield from index.load()
+    assert len(index) == 3
+    assert _search(index, 'lunch') == ['1']
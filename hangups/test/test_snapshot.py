@@ -0,0 +1,157 @@
+"""Tests for snapshots."""
+
+import asyncio
+import datetime
+
+import pytest
+
+from hangups import (conversation, event, hangouts_pb2, parsers, snapshot,
+                     user)
+from hangups.test.utils import coroutine_test
+
+
+class FakeUserList(object):
+
+    def __init__(self, users):
+        self._users = users
+
+    def get_self_user(self):
+        return self._users[0]
+
+    def get_all(self):
+        return self._users
+
+
+class FakeConversation(object):
+
+    def __init__(self, conv_id, gaia_ids=()):
+        self._conv_id = conv_id
+        self._gaia_ids = gaia_ids
+
+    def get_conversation_state(self, max_events):
+        conv_state = hangouts_pb2.ConversationState(
+            conversation_id=hangouts_pb2.ConversationId(id=self._conv_id),
+        )
+        conv_state.conversation.conversation_id.id = self._conv_id
+        for gaia_id in self._gaia_ids:
+            conv_state.conversation.participant_data.add(
+                id=hangouts_pb2.ParticipantId(chat_id=gaia_id,
+                                              gaia_id=gaia_id),
+                fallback_name='Fallback',
+            )
+        return conv_state
+
+
+class FakeConversationList(object):
+
+    def __init__(self, conv_ids, sync_timestamp, gaia_ids=()):
+        self._convs = [FakeConversation(conv_id, gaia_ids)
+                       for conv_id in conv_ids]
+        self.sync_timestamp = sync_timestamp
+
+    def get_all(self, include_archived=False):
+        return self._convs
+
+
+class FakeClient(object):
+
+    """Client recording getentitybyid requests."""
+
+    def __init__(self):
+        self.on_connect = event.Event('on_connect')
+        self.on_reconnect = event.Event('on_reconnect')
+        self.on_disconnect = event.Event('on_disconnect')
+        self.on_state_update = event.Event('on_state_update')
+        self.requests = []
+
+    @asyncio.coroutine
+    def getentitybyid(self, gaia_ids):
+        self.requests.append(sorted(gaia_ids))
+        return hangouts_pb2.GetEntityByIdResponse()
+
+
+def _make_user(gaia_id, is_self, is_fallback=False):
+    return user.User(user.UserID(chat_id=gaia_id, gaia_id=gaia_id),
+                     'Full Name', None, None, ['a@example.com'], is_self,
+                     is_fallback=is_fallback)
+
+
+def _now():
+    return parsers.from_timestamp(
+        parsers.to_timestamp(datetime.datetime.now(datetime.timezone.utc))
+    )
+
+
+def test_save_and_load(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    sync_timestamp = _now()
+    snapshot.save(
+        path, FakeUserList([_make_user('1', True), _make_user('2', False),
+                            _make_user('3', False, is_fallback=True)]),
+        FakeConversationList(['conv1', 'conv2'], sync_timestamp)
+    )
+    snapshot_ = snapshot.load(path)
+    assert snapshot_.self_entity.id.gaia_id == '1'
+    assert [entity.id.gaia_id for entity in snapshot_.entities] == ['2']
+    assert snapshot_.entities[0].properties.display_name == 'Full Name'
+    assert [conv_state.conversation_id.id for conv_state
+            in snapshot_.conv_states] == ['conv1', 'conv2']
+    assert snapshot_.sync_timestamp == sync_timestamp
+
+
+@coroutine_test
+def test_save_async(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    yield from snapshot.save_async(
+        path, FakeUserList([_make_user('1', True)]),
+        FakeConversationList(['conv1'], _now())
+    )
+    snapshot_ = snapshot.load(path)
+    assert [conv_state.conversation_id.id for conv_state
+            in snapshot_.conv_states] == ['conv1']
+
+
+def test_load_old(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    sync_timestamp = datetime.datetime(2015, 1, 1,
+                                       tzinfo=datetime.timezone.utc)
+    snapshot.save(path, FakeUserList([_make_user('1', True)]),
+                  FakeConversationList([], sync_timestamp))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load(path)
+
+
+def test_load_truncated(tmpdir):
+    path = tmpdir.join('snapshot')
+    sync_timestamp = datetime.datetime.now(datetime.timezone.utc)
+    snapshot.save(str(path), FakeUserList([_make_user('1', True)]),
+                  FakeConversationList(['conv1'], sync_timestamp))
+    path.write_binary(path.read_binary()[:-1])
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load(str(path))
+
+
+def test_load_missing(tmpdir):
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load(str(tmpdir.join('snapshot')))
+
+
+@coroutine_test
+def test_restore(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    snapshot.save(
+        path, FakeUserList([_make_user('1', True), _make_user('2', False)]),
+        FakeConversationList(['conv1'], _now(), gaia_ids=['1', '2', '3'])
+    )
+    client = FakeClient()
+    user_list, conv_list = (
+        yield from conversation.build_user_conversation_list(
+            client, snapshot_path=path
+        )
+    )
+    assert [conv.id_ for conv in conv_list.get_all()] == ['conv1']
+    # Only the entity missing from the snapshot is requested.
+    yield from user_list.entities_future
+    assert client.requests == [['3']]
+    user_3 = user_list.get_user(user.UserID(chat_id='3', gaia_id='3'))
+    assert user_3.is_fallback
@@ -0,0 +1,79 @@
+"""Tests for the event timeline."""
+
+import collections
+
+import pytest
+
+from hangups import timeline
+
+Event = collections.namedtuple('Event', ['id_', 'timestamp'])
+
+
+def _get_ids(events):
+    return [event_.id_ for event_ in events]
+
+
+def test_append_and_prepend():
+    timeline_ = timeline.Timeline([Event('c', 3), Event('d', 4)])
+    assert timeline_.add(Event('b', 2))
+    assert timeline_.add(Event('a', 1))
+    assert timeline_.add(Event('e', 5))
+    assert _get_ids(timeline_) == ['a', 'b', 'c', 'd', 'e']
+    assert [timeline_.index(id_) for id_ in 'abcde'] == [0, 1, 2, 3, 4]
+    assert timeline_.get('b').timestamp == 2
+    assert timeline_[-1].id_ == 'e'
+    assert _get_ids(timeline_[-2:]) == ['d', 'e']
+    assert _get_ids(timeline_[:2]) == ['a', 'b']
+
+
+def test_out_of_order():
+    timeline_ = timeline.Timeline([Event('a', 1), Event('c', 3)])
+    timeline_.add(Event('0', 0))
+    timeline_.add(Event('b', 2))
+    timeline_.add(Event('b2', 2))
+    assert _get_ids(timeline_) == ['0', 'a', 'b', 'b2', 'c']
+    assert [timeline_.index(id_) for id_ in ['0', 'b2', 'c']] == [0, 3, 4]
+    timeline_.add(Event('-1', -1))
+    assert timeline_.index('c') == 5
+
+
+def test_duplicate_and_missing():
+    timeline_ = timeline.Timeline([Event('a', 1)])
+    assert not timeline_.add(Event('a', 2))
+    assert len(timeline_) == 1
+    assert 'a' in timeline_
+    assert 'b' not in timeline_
+    with pytest.raises(KeyError):
+        timeline_.get('b')
+    with pytest.raises(IndexError):
+        timeline_[1]
+
+
+def test_bisect():
+    timeline_ = timeline.Timeline([Event('b', 2), Event('c', 2)])
+    timeline_.add(Event('a', 1))
+    timeline_.add(Event('d', 3))
+    assert [timeline_.bisect(t) for t in [0, 1, 2, 3]] == [0, 1, 3, 4]
+    assert timeline.Timeline().bisect(0) == 0
+
+
+def test_remove_oldest():
+    timeline_ = timeline.Timeline([Event(str(i), i) for i in range(2, 8)])
+    timeline_.add(Event('1', 1))
+    timeline_.add(Event('0', 0))
+    assert _get_ids(timeline_.remove_oldest(3)) == ['0', '1', '2']
+    assert _get_ids(timeline_.remove_oldest(1)) == ['3']
+    assert '3' not in timeline_
+    assert [timeline_.index(id_) for id_ in '4567'] == [0, 1, 2, 3]
+    # Events may be added at either end after removing some.
+    timeline_.add(Event('3', 3))
+    timeline_.add(Event('8', 8))
+    assert _get_ids(timeline_) == ['3', '4', '5', '6', '7', '8']
+    assert [timeline_.index(id_) for id_ in '38'] == [0, 5]
+    assert _get_ids(timeline_.remove_oldest(4)) == ['3', '4', '5', '6']
+    assert _get_ids(timeline_) == ['7', '8']
+    assert timeline_.get('8').timestamp == 8
+    assert _get_ids(timeline_.remove_oldest(5)) == ['7', '8']
+    assert len(timeline_) == 0
+    timeline_.add(Event('9', 9))
+    assert timeline_.index('9') == 0
@@ -0,0 +1,92 @@
+"""Tests for users."""
+
+import asyncio
+
+import pytest
+
+from hangups import event, exceptions, hangouts_pb2, user
+from hangups.test.utils import coroutine_test
+
+
+def _make_entity(gaia_id, name):
+    return hangouts_pb2.Entity(
+        id=hangouts_pb2.ParticipantId(gaia_id=gaia_id, chat_id=gaia_id),
+        properties=hangouts_pb2.EntityProperties(display_name=name,
+                                                 first_name=name),
+    )
+
+
+class FakeClient(object):
+
+    """Client serving getentitybyid after a delay, or raising error."""
+
+    def __init__(self, delay=0, error=None):
+        self.on_state_update = event.Event('on_state_update')
+        self.on_disconnect = event.Event('on_disconnect')
+        self.on_reconnect = event.Event('on_reconnect')
+        self.requests = []
+        self.delay = delay
+        self.error = error
+
+    @asyncio.coroutine
+    def getentitybyid(self, gaia_ids):
+        self.requests.append(list(gaia_ids))
+        yield from asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return hangouts_pb2.GetEntityByIdResponse(entity=[
+            _make_entity(gaia_id, 'User {}'.format(gaia_id))
+            for gaia_id in gaia_ids
+        ])
+
+
+def _make_user_list(client):
+    return user.UserList(
+        client, _make_entity('1', 'Self'), [],
+        [hangouts_pb2.ConversationParticipantData(
+            id=hangouts_pb2.ParticipantId(gaia_id='2', chat_id='2'),
+            fallback_name='Fallback',
+        )]
+    )
+
+
+def _get_name(user_list):
+    return user_list.get_user(user.UserID(chat_id='2', gaia_id='2')).full_name
+
+
+@coroutine_test
+def test_load_entities_in_background():
+    user_list = _make_user_list(FakeClient())
+    assert _get_name(user_list) == 'Fallback'
+    yield from user_list.load_entities_in_background(['2'])
+    assert _get_name(user_list) == 'User 2'
+
+
+@coroutine_test
+def test_load_entities_errors():
+    client = FakeClient(error=exceptions.NetworkError('Injected error'))
+    user_list = _make_user_list(client)
+    # Failed requests leave the fallback Users in place.
+    yield from user_list.load_entities_in_background(['2'])
+    assert _get_name(user_list) == 'Fallback'
+    # Unexpected errors are raised by the future.
+    client.error = ValueError('Unexpected error')
+    with pytest.raises(ValueError):
+        yield from user_list.load_entities_in_background(['2'])
+
+
+@coroutine_test
+def test_load_entities_reconnect():
+    client = FakeClient(delay=1)
+    user_list = _make_user_list(client)
+    future = user_list.load_entities_in_background(['2'])
+    while not client.requests:
+        yield from asyncio.sleep(0)
+    yield from client.on_disconnect.fire()
+    yield from asyncio.wait([future])
+    assert future.cancelled()
+    client.delay = 0
+    yield from client.on_reconnect.fire()
+    yield from user_list.entities_future
+    assert _get_name(user_list) == 'User 2'
+    assert client.requests == [['2'], ['2']]
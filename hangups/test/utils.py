@@ -0,0 +1,17 @@
+"""Helpers shared by the tests."""
+
+import asyncio
+import functools
+
+
+def coroutine_test(f):
+    """Decorator to create a coroutine that starts and stops its own loop."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        coro = asyncio.coroutine(f)
+        loop = asyncio.new_event_loop()
+        # Make the loop current, so futures created by the code under test
+        # belong to it.
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(coro(*args, **kwargs))
+    return wrapper
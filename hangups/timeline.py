@@ -0,0 +1,140 @@
+"""Ordered sequence of conversation events."""
+
+import itertools
+
+
+class Timeline(object):
+
+    """Sequence of ConversationEvents sorted by timestamp.
+
+    Events are usually added either after the newest event as they arrive, or
+    before the oldest event when scrolling back, so the timeline is stored as
+    two lists: older events are appended to the front list in reverse order,
+    and newer events to the back list. Both cases take amortized constant
+    time.
+
+    Each event is assigned a sequence number, which increases by one from
+    each event to the next, so the position of an event can be found from its
+    ID in constant time.
+
+    The oldest events are removed from the back list by advancing a start
+    offset into it rather than deleting them, and the list is only compacted
+    once more than half of it is removed, so removal also takes amortized
+    constant time. Sequence numbers are not changed by compacting, since the
+    sequence number of the first item of the back list is kept separately.
+
+    Events arriving out of order are inserted in the right position by
+    rebuilding the timeline, which takes linear time.
+    """
+
+    def __init__(self, events=()):
+        self._front = []  # [ConversationEvent], newest first
+        self._back = []  # [ConversationEvent], oldest first
+        self._start = 0  # Index of the first event in the back list
+        self._base_seq = 0  # Sequence number of the first item of _back
+        self._seqs = {}  # {event_id: sequence number}
+        for conv_event in events:
+            self.add(conv_event)
+
+    def __len__(self):
+        return len(self._front) + len(self._back) - self._start
+
+    def __iter__(self):
+        return itertools.chain(reversed(self._front),
+                               itertools.islice(self._back, self._start,
+                                                None))
+
+    def __contains__(self, event_id):
+        return event_id in self._seqs
+
+    def __getitem__(self, index):
+        """Return ConversationEvent at index, or list of them for a slice."""
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Timeline index out of range')
+        return self._get(index)
+
+    def _get(self, index):
+        """Return ConversationEvent at a valid non-negative index."""
+        if index < len(self._front):
+            return self._front[-1 - index]
+        else:
+            return self._back[self._start + index - len(self._front)]
+
+    def index(self, event_id):
+        """Return the index of the event with the given ID.
+
+        Raises KeyError if no such event is in the timeline.
+        """
+        return (self._seqs[event_id] - self._base_seq - self._start +
+                len(self._front))
+
+    def get(self, event_id):
+        """Return the ConversationEvent with the given ID.
+
+        Raises KeyError if no such event is in the timeline.
+        """
+        return self._get(self.index(event_id))
+
+    def bisect(self, timestamp):
+        """Return the index of the first event newer than timestamp."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if timestamp < self._get(middle).timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def add(self, conv_event):
+        """Add a ConversationEvent in order of its timestamp.
+
+        Events with the same timestamp are kept in the order they were added.
+        Returns False if an event with the same ID is already in the
+        timeline, otherwise True.
+        """
+        if conv_event.id_ in self._seqs:
+            return False
+        timestamp = conv_event.timestamp
+        if not self or timestamp >= self._get(len(self) - 1).timestamp:
+            self._seqs[conv_event.id_] = self._base_seq + len(self._back)
+            self._back.append(conv_event)
+        elif timestamp < self._get(0).timestamp:
+            self._front.append(conv_event)
+            self._seqs[conv_event.id_] = (self._base_seq + self._start -
+                                          len(self._front))
+        else:
+            self._insert(conv_event)
+        return True
+
+    def remove_oldest(self, count):
+        """Remove the count oldest events and return them in a list."""
+        removed = self[:count]
+        for conv_event in removed:
+            del self._seqs[conv_event.id_]
+        num_front = min(len(removed), len(self._front))
+        if num_front > 0:
+            del self._front[-num_front:]
+        self._start += len(removed) - num_front
+        if self._start * 2 > len(self._back):
+            del self._back[:self._start]
+            self._base_seq += self._start
+            self._start = 0
+        return removed
+
+    def _insert(self, conv_event):
+        """Insert a ConversationEvent by rebuilding the timeline."""
+        events = list(self)
+        index = len(events)
+        while events[index - 1].timestamp > conv_event.timestamp:
+            index -= 1
+        events.insert(index, conv_event)
+        self._front = []
+        self._back = events
+        self._start = 0
+        self._base_seq = 0
+        self._seqs = {event_.id_: seq for seq, event_ in enumerate(events)}
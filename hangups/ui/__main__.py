@@ -3,6 +3,7 @@
 import appdirs
 import asyncio
 import configargparse
+import functools
 import logging
 import os
 import sys
@@ -14,6 +15,7 @@ from hangups.ui.notify import Notifier
 from hangups.ui.utils import get_conv_name
 
 
+logger = logging.getLogger(__name__)
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 MESSAGE_TIME_FORMAT = '(%I:%M:%S %p)'
 MESSAGE_DATETIME_FORMAT = '\n< %y-%m-%d >\n(%I:%M:%S %p)'
@@ -44,9 +46,12 @@ class ChatUI(object):
     """User interface for hangups."""
 
     def __init__(self, refresh_token_path, keybindings, palette,
-                 disable_notifier):
+                 disable_notifier, snapshot_path):
         """Start the user interface."""
         self._keys = keybindings
+        self._snapshot_path = snapshot_path
+        # Future for hangups.snapshot.save_periodically:
+        self._snapshot_future = None
 
         set_terminal_title('hangups')
 
@@ -64,7 +69,14 @@ class ChatUI(object):
         except hangups.GoogleAuthError as e:
             sys.exit('Login failed ({})'.format(e))
 
-        self._client = hangups.Client(cookies)
+        self._client = hangups.Client(
+            cookies, refresh_cookies=functools.partial(
+                hangups.auth.refresh_cookies, refresh_token_path
+            ),
+            cookies_expires=hangups.auth.get_cookies_expiry(
+                refresh_token_path
+            ),
+        )
         self._client.on_connect.add_observer(self._on_connect)
 
         loop = asyncio.get_event_loop()
@@ -81,8 +93,19 @@ class ChatUI(object):
         finally:
             # Ensure urwid cleans up properly and doesn't wreck the terminal.
             self._urwid_loop.stop()
+            if self._snapshot_future is not None:
+                self._snapshot_future.cancel()
+                self._save_snapshot()
             loop.close()
 
+    def _save_snapshot(self):
+        """Save a snapshot for a faster startup next time."""
+        try:
+            hangups.snapshot.save(self._snapshot_path, self._user_list,
+                                  self._conv_list)
+        except IOError as e:
+            logger.warning('Failed to save snapshot: {}'.format(e))
+
     def _input_filter(self, keys, _):
         """Handle global keybindings."""
         if keys == [self._keys['menu']]:
@@ -138,7 +161,14 @@ class ChatUI(object):
     def _on_connect(self):
         """Handle connecting for the first time."""
         self._user_list, self._conv_list = (
-            yield from hangups.build_user_conversation_list(self._client)
+            yield from hangups.build_user_conversation_list(
+                self._client, snapshot_path=self._snapshot_path
+            )
+        )
+        self._snapshot_future = asyncio.async(
+            hangups.snapshot.save_periodically(
+                self._snapshot_path, self._user_list, self._conv_list
+            )
         )
         self._conv_list.on_event.add_observer(self._on_event)
         if not self._disable_notifier:
@@ -147,6 +177,7 @@ class ChatUI(object):
         conv_picker = ConversationPickerWidget(self._conv_list,
                                                self.on_select_conversation,
                                                self._keys)
+        self._user_list.on_users_loaded.add_observer(conv_picker.update_labels)
         self._tabbed_window = TabbedWindowWidget(self._keys)
         self._tabbed_window.set_tab(conv_picker, switch=True,
                                     title='Conversations')
@@ -266,6 +297,10 @@ class ConversationButton(urwid.WidgetWrap):
 
     def _on_event(self, _):
         """Update the button's label when an event occurs."""
+        self.update_label()
+
+    def update_label(self):
+        """Update the button's label from the conversation."""
         self._button.set_label(self._get_label())
 
     @property
@@ -301,12 +336,18 @@ class ConversationPickerWidget(urwid.WidgetWrap):
     """ListBox widget for picking a conversation from a list."""
 
     def __init__(self, conversation_list, on_select, keybindings):
-        list_walker = ConversationListWalker(conversation_list, on_select)
-        list_box = urwid.ListBox(list_walker)
+        self._list_walker = ConversationListWalker(conversation_list,
+                                                   on_select)
+        list_box = urwid.ListBox(self._list_walker)
         widget = urwid.Padding(list_box, left=2, right=2)
         super().__init__(widget)
         self._keys = keybindings
 
+    def update_labels(self):
+        """Update the labels of all conversations from their details."""
+        for button in self._list_walker:
+            button.update_label()
+
     def keypress(self, size, key):
         # Handle alternate up/down keybindings
         key = super().keypress(size, key)
@@ -571,24 +612,24 @@ class ConversationEventListWalker(urwid.ListWalker):
             future = asyncio.async(self._load())
             future.add_done_callback(lambda future: future.result())
             return urwid.Text('Loading...', align='center')
-        # May return None if the event doesn't have a widget representation.
-        try:
-            # Get the previous displayable event, or None if it isn't loaded or
-            # doesn't exist.
-            prev_position = self._get_position(position, prev=True)
-            if prev_position == self.POSITION_LOADING:
-                prev_event = None
-            else:
-                prev_event = self._conversation.get_event(prev_position)
-
-            # When creating the widget, also pass the previous event so a
-            # timestamp can be shown if this event occurred on a different day.
-            widget = MessageWidget.from_conversation_event(
-                self._conversation, self._conversation.get_event(position),
-                prev_event
-            )
-        except KeyError:
+        # The event may not be in memory if it was evicted.
+        conv_event = self._conversation.get_event(position)
+        if conv_event is None:
             raise IndexError('Invalid position: {}'.format(position))
+        # Get the previous displayable event, or None if it isn't loaded or
+        # doesn't exist.
+        prev_position = self._get_position(position, prev=True)
+        if prev_position == self.POSITION_LOADING:
+            prev_event = None
+        else:
+            prev_event = self._conversation.get_event(prev_position)
+
+        # When creating the widget, also pass the previous event so a
+        # timestamp can be shown if this event occurred on a different day.
+        # May return None if the event doesn't have a widget representation.
+        widget = MessageWidget.from_conversation_event(
+            self._conversation, conv_event, prev_event
+        )
         if not widget:
             raise IndexError('Invalid position: {}'.format(position))
         return widget
@@ -828,6 +869,7 @@ def main():
     dirs = appdirs.AppDirs('hangups', 'hangups')
     default_log_path = os.path.join(dirs.user_log_dir, 'hangups.log')
     default_token_path = os.path.join(dirs.user_cache_dir, 'refresh_token.txt')
+    default_snapshot_path = os.path.join(dirs.user_cache_dir, 'snapshot')
     default_config_path = os.path.join(dirs.user_config_dir, 'hangups.conf')
 
     # Create a default empty config file if does not exist.
@@ -846,6 +888,9 @@ def main():
                       help='show this help message and exit')
     general_group.add('--token-path', default=default_token_path,
                       help='path used to store OAuth refresh token')
+    general_group.add('--snapshot-path', default=default_snapshot_path,
+                      help='path used to store conversations for faster '
+                      'startup')
     general_group.add('--col-scheme', choices=COL_SCHEMES.keys(),
                       default='default', help='colour scheme to use')
     general_group.add('-c', '--config', help='configuration file path',
@@ -875,7 +920,7 @@ def main():
     args = parser.parse_args()
 
     # Create all necessary directories.
-    for path in [args.log, args.token_path]:
+    for path in [args.log, args.token_path, args.snapshot_path]:
         dir_maker(path)
 
     log_level = logging.DEBUG if args.debug else logging.WARNING
@@ -892,7 +937,8 @@ def main():
             'menu': args.key_menu,
             'up': args.key_up,
             'down': args.key_down
-        }, COL_SCHEMES[args.col_scheme], args.disable_notifications)
+        }, COL_SCHEMES[args.col_scheme], args.disable_notifications,
+            args.snapshot_path)
     except KeyboardInterrupt:
         sys.exit('Caught KeyboardInterrupt, exiting abnormally')
     except:
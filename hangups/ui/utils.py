@@ -1,7 +1,5 @@
 """Shared UI utility function."""
 
-import hangups
-
 
 def get_conv_name(conv, truncate=False, show_unread=False):
     """Return a readable name for a conversation.
@@ -16,9 +14,7 @@ def get_conv_name(conv, truncate=False, show_unread=False):
     If show_unread is True, if there are unread chat messages, show the number
     of unread chat messages in parentheses after the conversation name.
     """
-    num_unread = len([conv_event for conv_event in conv.unread_events if
-                      isinstance(conv_event, hangups.ChatMessageEvent) and
-                      not conv.get_user(conv_event.user_id).is_self])
+    num_unread = conv.num_unread_chat_messages
     if show_unread and num_unread > 0:
         postfix = ' ({})'.format(num_unread)
     else:
@@ -1,11 +1,16 @@
 """User objects."""
 
 from collections import namedtuple
+import asyncio
 import logging
 
+from hangups import event, exceptions
+
 
 logger = logging.getLogger(__name__)
 DEFAULT_NAME = 'Unknown'
+# Maximum number of entities to request in each getentitybyid request:
+ENTITY_BATCH_SIZE = 100
 
 UserID = namedtuple('UserID', ['chat_id', 'gaia_id'])
 
@@ -19,8 +24,11 @@ class User(object):
     """
 
     def __init__(self, user_id, full_name, first_name, photo_url, emails,
-                 is_self):
-        """Initialize a User."""
+                 is_self, is_fallback=False):
+        """Initialize a User.
+
+        is_fallback is True if the details are not from an Entity.
+        """
         self.id_ = user_id
         self.full_name = full_name if full_name != '' else DEFAULT_NAME
         self.first_name = (first_name if first_name != ''
@@ -28,6 +36,19 @@ class User(object):
         self.photo_url = photo_url
         self.emails = emails
         self.is_self = is_self
+        self.is_fallback = is_fallback
+
+    def upgrade(self, user_):
+        """Replace this user's details with those of another User.
+
+        This allows a fallback User to be upgraded in place once its Entity
+        is available, so references to it see the new details.
+        """
+        self.full_name = user_.full_name
+        self.first_name = user_.first_name
+        self.photo_url = user_.photo_url
+        self.emails = user_.emails
+        self.is_fallback = user_.is_fallback
 
     @staticmethod
     def from_entity(entity, self_user_id):
@@ -52,7 +73,8 @@ class User(object):
         user_id = UserID(chat_id=conv_part_data.id.chat_id,
                          gaia_id=conv_part_data.id.gaia_id)
         return User(user_id, conv_part_data.fallback_name, None, None, [],
-                    (self_user_id == user_id) or (self_user_id is None))
+                    (self_user_id == user_id) or (self_user_id is None),
+                    is_fallback=True)
 
 
 class UserList(object):
@@ -72,8 +94,7 @@ class UserList(object):
         self._user_dict = {self._self_user.id_: self._self_user}
         # Add each entity as a new User.
         for entity in entities:
-            user_ = User.from_entity(entity, self._self_user.id_)
-            self._user_dict[user_.id_] = user_
+            self._add_user_from_entity(entity)
         # Add each conversation participant as a new User if we didn't already
         # add them from an entity.
         for participant in conv_parts:
@@ -81,7 +102,81 @@ class UserList(object):
         logger.info('UserList initialized with {} user(s)'
                     .format(len(self._user_dict)))
 
+        # Future for the task started by load_entities_in_background, the
+        # gaia IDs it loads, and whether it was cancelled by a disconnect:
+        self._load_entities_future = None
+        self._load_entities_gaia_ids = set()
+        self._load_entities_interrupted = False
+
         self._client.on_state_update.add_observer(self._on_state_update)
+        self._client.on_disconnect.add_observer(self._on_disconnect)
+        self._client.on_reconnect.add_observer(self._on_reconnect)
+
+        # Event fired when Users have been added or upgraded by load_entities
+        # with arguments ().
+        self.on_users_loaded = event.Event('UserList.on_users_loaded')
+
+    @property
+    def entities_future(self):
+        """Future for entities loading in the background, or None.
+
+        The future's exception is set if loading failed with an unexpected
+        error.
+        """
+        return self._load_entities_future
+
+    def load_entities_in_background(self, gaia_ids):
+        """Start loading entities with load_entities in a task.
+
+        If entities are already loading, their gaia IDs are loaded along with
+        the new ones. Unexpected errors are logged, and may be retrieved from
+        entities_future. Loading is cancelled when the client disconnects,
+        and started again when it reconnects.
+
+        Returns the task's future.
+        """
+        if (self._load_entities_future is not None and
+                not self._load_entities_future.done()):
+            self._load_entities_future.cancel()
+            gaia_ids = set(gaia_ids) | self._load_entities_gaia_ids
+        self._load_entities_gaia_ids = set(gaia_ids)
+        self._load_entities_interrupted = False
+        self._load_entities_future = asyncio.async(
+            self.load_entities(self._load_entities_gaia_ids)
+        )
+        self._load_entities_future.add_done_callback(
+            self._on_load_entities_done
+        )
+        return self._load_entities_future
+
+    @asyncio.coroutine
+    def load_entities(self, gaia_ids):
+        """Request entities for users and add or upgrade their Users.
+
+        The entities are requested in parallel batches of ENTITY_BATCH_SIZE.
+        Failed batches are logged and ignored, leaving any fallback Users in
+        place.
+        """
+        gaia_ids = list(gaia_ids)
+        batches = [gaia_ids[i:i + ENTITY_BATCH_SIZE]
+                   for i in range(0, len(gaia_ids), ENTITY_BATCH_SIZE)]
+        if not batches:
+            return
+        logger.info('Requesting {} entities in {} batches'
+                    .format(len(gaia_ids), len(batches)))
+        results = yield from asyncio.gather(*[
+            self._client.getentitybyid(batch) for batch in batches
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, exceptions.NetworkError):
+                logger.warning('Failed to request entities: {}'
+                               .format(result))
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                for entity in result.entity:
+                    self._add_user_from_entity(entity)
+        yield from self.on_users_loaded.fire()
 
     def get_user(self, user_id):
         """Return a User by their UserID.
@@ -93,12 +188,28 @@ class UserList(object):
         except KeyError:
             logger.warning('UserList returning unknown User for UserID {}'
                            .format(user_id))
-            return User(user_id, DEFAULT_NAME, None, None, [], False)
+            return User(user_id, DEFAULT_NAME, None, None, [], False,
+                        is_fallback=True)
+
+    def get_self_user(self):
+        """Return the User for the logged in user."""
+        return self._self_user
 
     def get_all(self):
         """Returns all the users known"""
         return self._user_dict.values()
 
+    def _add_user_from_entity(self, entity):
+        """Add new User from Entity, or upgrade the existing User."""
+        user_ = User.from_entity(entity, self._self_user.id_)
+        existing_user = self._user_dict.get(user_.id_)
+        if existing_user is None:
+            self._user_dict[user_.id_] = user_
+        else:
+            existing_user.upgrade(user_)
+            user_ = existing_user
+        return user_
+
     def add_user_from_conv_part(self, conv_part):
         """Add new User from ConversationParticipantData"""
         user_ = User.from_conv_part_data(conv_part, self._self_user.id_)
@@ -107,6 +218,25 @@ class UserList(object):
             self._user_dict[user_.id_] = user_
         return user_
 
+    def _on_load_entities_done(self, future):
+        """Log an unexpected error from loading entities in the background."""
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Failed to load entities: {!r}'
+                         .format(future.exception()))
+
+    def _on_disconnect(self):
+        """Cancel loading entities in the background."""
+        if (self._load_entities_future is not None and
+                not self._load_entities_future.done()):
+            logger.info('Cancelling loading entities')
+            self._load_entities_future.cancel()
+            self._load_entities_interrupted = True
+
+    def _on_reconnect(self):
+        """Start loading entities again if loading was cancelled."""
+        if self._load_entities_interrupted:
+            self.load_entities_in_background(self._load_entities_gaia_ids)
+
     def _on_state_update(self, state_update):
         """Receive a StateUpdate"""
         if state_update.HasField('conversation'):
@@ -30,7 +30,6 @@ install_requires = [
     'appdirs==1.4.0',
     'purplex==0.2.4',
     'readlike>=0.1',
-    'requests==2.6.0',
     'ReParser==1.4.3',
     # use alpha protobuf for official Python 3 support
     'protobuf==3.0.0a3',